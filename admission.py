@@ -0,0 +1,180 @@
+"""
+Admission control for work that uses the JVM, like parsing and realising.
+
+The parser and the realiser run in one JVM per process, so when many requests
+arrive at once, piling them all onto the JVM makes every response slow and
+can run it out of heap.  Instead, at most CHATBOT_JVM_CONCURRENCY threads use
+it at a time, up to CHATBOT_JVM_QUEUE_DEPTH more wait for their turn, and none
+waits longer than CHATBOT_JVM_DEADLINE seconds:
+
+>>> controller = AdmissionController(limit=1, queue_depth=0, deadline=0.1)
+>>> with controller.admit() as admitted:
+...     print admitted
+...     with controller.admit() as also_admitted:
+...         print also_admitted
+True
+False
+>>> sorted(controller.get_metrics()['shed'].items())
+[('deadline', 0), ('queue_full', 1)]
+
+Work that isn't admitted is shed.  Depending on CHATBOT_OVERLOAD_MODE, the
+chatbot then either answers more cheaply without the JVM ('degrade', the
+default) or refuses to answer by raising Overloaded ('reject'), which servers
+turn into a 503 response asking the client to retry after
+CHATBOT_RETRY_AFTER seconds.
+"""
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+JVM_CONCURRENCY = int(os.environ.get('CHATBOT_JVM_CONCURRENCY', 4))
+JVM_QUEUE_DEPTH = int(os.environ.get('CHATBOT_JVM_QUEUE_DEPTH', 16))
+JVM_DEADLINE = float(os.environ.get('CHATBOT_JVM_DEADLINE', 2.0))
+OVERLOAD_MODE = os.environ.get('CHATBOT_OVERLOAD_MODE', 'degrade')
+RETRY_AFTER = int(os.environ.get('CHATBOT_RETRY_AFTER', 5))
+
+
+class Overloaded(Exception):
+    """
+    Raised when a message isn't answered because the server is overloaded.
+    The client should retry after retry_after seconds.
+    """
+    def __init__(self, retry_after=RETRY_AFTER):
+        Exception.__init__(self, "Overloaded; retry after %i seconds" %
+                           retry_after)
+        self.retry_after = retry_after
+
+
+class AdmissionController(object):
+    """
+    Limits the number of threads doing some kind of work at once.  Threads
+    that can't start right away wait in a bounded queue, for a bounded time.
+    """
+
+    def __init__(self, limit=JVM_CONCURRENCY, queue_depth=JVM_QUEUE_DEPTH,
+                 deadline=JVM_DEADLINE, mode=OVERLOAD_MODE,
+                 retry_after=RETRY_AFTER):
+        """
+        Admit up to limit threads at once, and let up to queue_depth more
+        wait up to deadline seconds.  mode is 'degrade' or 'reject', and
+        says what should be done with work that's shed.
+        """
+        if mode not in ('degrade', 'reject'):
+            raise ValueError("Unknown overload mode %r" % mode)
+        self.limit = limit
+        self.queue_depth = queue_depth
+        self.deadline = deadline
+        self.reject = mode == 'reject'
+        self.retry_after = retry_after
+        self._condition = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+        self._admitted = 0
+        self._wait_time = 0.0
+        self._shed = {'queue_full': 0, 'deadline': 0}
+        self._degraded = {}
+        self._rejected = {}
+
+    def acquire(self):
+        """
+        Wait for a turn, and return True when it's admitted, or False if it
+        was shed because the queue was full or the deadline passed.  Work
+        that was admitted must call release() when it's done.
+        """
+        with self._condition:
+            if self._active < self.limit and not self._waiting:
+                self._active += 1
+                self._admitted += 1
+                return True
+            if self._waiting >= self.queue_depth:
+                self._shed['queue_full'] += 1
+                return False
+            started = time.time()
+            deadline = started + self.deadline
+            self._waiting += 1
+            try:
+                while self._active >= self.limit:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._shed['deadline'] += 1
+                        # Pass on a wakeup that was meant for this thread.
+                        if self._active < self.limit:
+                            self._condition.notify()
+                        return False
+                    self._condition.wait(remaining)
+            finally:
+                self._waiting -= 1
+            self._active += 1
+            self._admitted += 1
+            self._wait_time += time.time() - started
+            return True
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    @contextmanager
+    def admit(self):
+        """
+        Run a with statement when it's admitted or shed, giving whether it
+        was admitted.  A turn that was admitted is released afterwards.
+        """
+        admitted = self.acquire()
+        try:
+            yield admitted
+        finally:
+            if admitted:
+                self.release()
+
+    def count_shed(self, stage, may_reject=True):
+        """
+        Count a stage of a response that was shed, and raise Overloaded if
+        shed work should be rejected rather than degraded.  Stages that come
+        after work which can't be undone pass may_reject=False, and are
+        always degraded.
+        """
+        reject = self.reject and may_reject
+        with self._condition:
+            counts = reject and self._rejected or self._degraded
+            counts[stage] = counts.get(stage, 0) + 1
+        if reject:
+            raise Overloaded(self.retry_after)
+
+    def get_metrics(self):
+        """
+        Return the limits, the numbers of threads working and waiting, the
+        number of turns admitted and the seconds they waited in total, the
+        number of turns shed for each reason, and the number of stages that
+        were degraded or rejected.
+        """
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'queue_depth': self.queue_depth,
+                'deadline': self.deadline,
+                'active': self._active,
+                'waiting': self._waiting,
+                'admitted': self._admitted,
+                'wait_time': self._wait_time,
+                'shed': dict(self._shed),
+                'degraded': dict(self._degraded),
+                'rejected': dict(self._rejected),
+            }
+
+
+_jvm_admission = None
+_jvm_admission_lock = threading.Lock()
+
+
+def get_jvm_admission():
+    """
+    Return the AdmissionController for work using this process's JVM.
+    """
+    global _jvm_admission
+    if _jvm_admission is None:
+        with _jvm_admission_lock:
+            if _jvm_admission is None:
+                _jvm_admission = AdmissionController()
+    return _jvm_admission
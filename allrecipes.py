@@ -14,9 +14,13 @@ import glob
 import logging
 from optparse import OptionParser
 import os
-from progressbar import ProgressBar, Percentage, ETA, Bar
+from StringIO import StringIO
+from progressbar import ProgressBar, Percentage, ETA, Bar, Counter, Timer, \
+    UnknownLength
 import random
 import sys
+import tarfile
+import zipfile
 
 from nlu import time_to_minutes
 from database import Database, DuplicateRecipeException
@@ -95,11 +99,285 @@ def extract_recipe_parts(recipe_detail_page):
     return recipe
 
 
+# The ids and classes that extract_recipe_parts() looks for.  The single-pass
+# extractor keeps the subtrees of these elements around until they have been
+# completely parsed; everything else is discarded as soon as it's seen.
+CANONICAL_URL_ID = "ctl00_canonicalUrl"
+TITLE_ID = "itemTitle"
+AUTHOR_ID = "ctl00_CenterColumnPlaceHolder_recipe_lblSubmitter"
+DESCRIPTION_ID = "ctl00_CenterColumnPlaceHolder_recipe_divSubmitter"
+CAPTURED_IDS = frozenset([TITLE_ID, AUTHOR_ID, DESCRIPTION_ID])
+CAPTURED_CLASSES = ("ingredients", "directions")
+TIME_CLASSES = (("prepTime", "prep_time"), ("cookTime", "cook_time"),
+                ("totalTime", "total_time"))
+
+
+def _has_class(element, class_name):
+    """
+    Return True if the element's class attribute contains class_name, using
+    the same rule as lxml.html's find_class().
+
+    >>> _has_class(etree.fromstring('<p class=" yield  yieldform"/>'),
+    ...            'yield yieldform')
+    True
+    >>> _has_class(etree.fromstring('<p class="yields"/>'), 'yield')
+    False
+    """
+    classes = element.get('class')
+    if not classes:
+        return False
+    return (' %s ' % class_name) in (' %s ' % ' '.join(classes.split()))
+
+
+def _text_content(element):
+    """
+    The text of an element and its descendants, like lxml.html's
+    text_content().  Elements produced by iterparse() are plain lxml.etree
+    elements, which don't have that method.
+    """
+    return element.xpath('string()')
+
+
+def _is_captured(element):
+    """
+    Return True if the subtree rooted at element is needed by
+    extract_recipe_parts_single_pass() after the element has been parsed.
+    """
+    if element.get('id') in CAPTURED_IDS:
+        return True
+    return any(_has_class(element, c) for c in CAPTURED_CLASSES)
+
+
+def extract_recipe_parts_single_pass(recipe_detail_page):
+    """
+    Extract the same recipe parts as extract_recipe_parts(), but walk the page
+    once with iterparse() instead of building the whole document and then
+    searching it repeatedly.  Elements are released as soon as they have been
+    examined, so peak memory depends on the size of the largest recipe section
+    rather than the size of the page.
+    """
+    recipe = defaultdict(lambda: None)
+    servings = []
+    ingredient_lists = []
+    step_lists = []
+    times = defaultdict(list)
+    found_ids = set()
+    # The number of open elements whose subtrees must be kept intact.
+    capturing = 0
+    for event, element in etree.iterparse(recipe_detail_page,
+                                          events=("start", "end"), html=True):
+        if not isinstance(element.tag, basestring):
+            continue  # Skip comments and processing instructions
+        if event == "start":
+            if _is_captured(element):
+                capturing += 1
+            continue
+        element_id = element.get('id')
+        if element_id == CANONICAL_URL_ID:
+            recipe['url'] = element.attrib['href']
+        elif element_id == TITLE_ID:
+            recipe['title'] = _text_content(element).strip()
+        elif element_id == AUTHOR_ID:
+            recipe['author'] = _text_content(element).strip()
+        elif element_id == DESCRIPTION_ID:
+            author_names = [e for e in element.iter()
+                            if _has_class(e, 'author-name')]
+            description = author_names[0].getnext().text
+            if description:
+                recipe['description'] = description.strip()
+        if element_id:
+            found_ids.add(element_id)
+        if _has_class(element, "yield yieldform"):
+            servings.append(element.text)
+        if _has_class(element, "ingredients"):
+            ingredient_lists.append(
+                [i.text.strip() for i in element.iter("li") if i.text.strip()])
+        if _has_class(element, "directions"):
+            step_lists.append(
+                [_text_content(s).strip() for s in element.iter("li")])
+        # Times are stored in the element following the label.
+        label = element.getprevious()
+        is_label = False
+        for class_name, key in TIME_CLASSES:
+            if label is not None and _has_class(label, class_name):
+                times[key].append(element.text)
+            if _has_class(element, class_name):
+                is_label = True
+        if _is_captured(element):
+            capturing -= 1
+        if capturing == 0:
+            # Nothing above this element needs its contents, so release it
+            # and any siblings that came before it.  Time labels are kept
+            # until the element that follows them has been parsed.
+            if not is_label:
+                element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    for required_id in (CANONICAL_URL_ID, TITLE_ID, AUTHOR_ID, DESCRIPTION_ID):
+        if required_id not in found_ids:
+            raise KeyError(required_id)
+    if len(servings) == 1:
+        recipe['servings'] = servings[0].strip()
+    assert len(ingredient_lists) == 1
+    recipe['ingredients'] = ingredient_lists[0]
+    assert len(step_lists) == 1
+    recipe['steps'] = step_lists[0]
+    recipe['num_steps'] = len(step_lists[0])
+    for key, values in times.items():
+        if len(values) == 1:
+            recipe[key] = time_to_minutes(values[0])
+    return recipe
+
+
+def extract_canonical_url(recipe_detail_page):
+    """
+    Return the canonical url of an AllRecipes.com detail page, or None if the
+    page doesn't have one.  Only the page's head is parsed, so this is much
+    cheaper than extracting the whole recipe.
+    """
+    for (_, element) in etree.iterparse(recipe_detail_page, events=("start",),
+                                        html=True):
+        if element.get('id') == CANONICAL_URL_ID:
+            return element.get('href')
+        if element.tag == 'body':
+            break
+    return None
+
+
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2')
+ZIP_EXTENSIONS = ('.zip',)
+
+
+def _iter_tar_pages(archive_filename, wanted=None):
+    """
+    Yield (name, file) pairs for the regular files in a tar archive, in a
+    single forward pass over the (possibly compressed) stream.  If wanted is
+    given, only members whose names are in that set are yielded.  Each file
+    must be read before the next pair is requested.
+    """
+    archive = tarfile.open(archive_filename, 'r|*')
+    try:
+        for member in archive:
+            if not member.isfile():
+                continue
+            if wanted is not None and member.name not in wanted:
+                continue
+            yield ("%s:%s" % (archive_filename, member.name),
+                   archive.extractfile(member))
+    finally:
+        archive.close()
+
+
+def list_pages(filenames):
+    """
+    Yield an (archive_filename, name) pair for every page in the given files.
+    Tar and zip archives are expanded into one pair per member; plain files
+    are yielded as (None, filename).  Only a zip archive's index is read, but
+    tar archives have no index, so listing one decompresses all of it
+    (without extracting it to disk).
+    """
+    for filename in filenames:
+        if filename.endswith(ZIP_EXTENSIONS):
+            archive = zipfile.ZipFile(filename)
+            for info in archive.infolist():
+                if not info.filename.endswith('/'):
+                    yield (filename, info.filename)
+            archive.close()
+        elif filename.endswith(TAR_EXTENSIONS):
+            archive = tarfile.open(filename, 'r|*')
+            for member in archive:
+                if member.isfile():
+                    yield (filename, member.name)
+            archive.close()
+        else:
+            yield (None, filename)
+
+
+def iter_pages(filenames):
+    """
+    Yield (name, file) pairs for every page in the given files, streaming
+    archive members without extracting them to disk.  Each file must be read
+    before the next pair is requested.
+    """
+    for filename in filenames:
+        if filename.endswith(ZIP_EXTENSIONS):
+            archive = zipfile.ZipFile(filename)
+            for info in archive.infolist():
+                if not info.filename.endswith('/'):
+                    yield ("%s:%s" % (filename, info.filename),
+                           archive.open(info))
+            archive.close()
+        elif filename.endswith(TAR_EXTENSIONS):
+            for page in _iter_tar_pages(filename):
+                yield page
+        else:
+            yield (filename, open(filename))
+
+
+def open_pages(page_refs):
+    """
+    Yield (name, file) pairs for a list of (archive_filename, name) pairs
+    produced by list_pages().
+
+    Plain files and zip members support random access, so they are yielded in
+    the given order.  Compressed tar streams can't seek backwards cheaply, so
+    the selected members of each tar archive are read afterwards in a single
+    forward pass, in the order in which they're stored in the archive.
+    """
+    zip_archives = {}
+    tar_members = defaultdict(set)
+    tar_filenames = []
+    try:
+        for (archive_filename, name) in page_refs:
+            if archive_filename is None:
+                yield (name, open(name))
+            elif archive_filename.endswith(ZIP_EXTENSIONS):
+                if archive_filename not in zip_archives:
+                    zip_archives[archive_filename] = \
+                        zipfile.ZipFile(archive_filename)
+                yield ("%s:%s" % (archive_filename, name),
+                       zip_archives[archive_filename].open(name))
+            else:
+                if archive_filename not in tar_members:
+                    tar_filenames.append(archive_filename)
+                tar_members[archive_filename].add(name)
+    finally:
+        for archive in zip_archives.values():
+            archive.close()
+    for archive_filename in tar_filenames:
+        for page in _iter_tar_pages(archive_filename,
+                                    tar_members[archive_filename]):
+            yield page
+
+
+def reservoir_sample(iterable, size):
+    """
+    Return a uniformly random sample of up to size items from an iterable of
+    unknown length, in random order, using a single pass and O(size) memory.
+
+    >>> len(reservoir_sample(xrange(1000), 10))
+    10
+    >>> sorted(reservoir_sample('abc', 10))
+    ['a', 'b', 'c']
+    """
+    sample = []
+    for (i, item) in enumerate(iterable):
+        if i < size:
+            sample.append(item)
+        else:
+            j = random.randint(0, i)
+            if j < size:
+                sample[j] = item
+    random.shuffle(sample)
+    return sample
+
+
 def main():
     """
     A command-line interface for importing AllRecipes recipes into a database.
     """
-    usage = "usage: %prog [options] recipe_filenames"
+    usage = "usage: %prog [options] recipe_filenames_or_archives"
     parser = OptionParser(usage=usage)
     parser.add_option("--database", dest="database_url",
                       default='sqlite:///test_database.sqlite')
@@ -109,7 +387,10 @@ def main():
     parser.add_option("-r", "--random-order", action="store_true",
         dest="random_order", help="process the input files in random order")
     parser.add_option("-l", "--limit", type="int", dest="limit",
-        help="limit number of files to import")
+        help="limit number of files to import; with -r, import a random "
+             "sample of this many files, less any duplicates")
+    parser.add_option("--single-pass", action="store_true",
+        dest="single_pass", help="use the single-pass page extractor")
     (options, args) = parser.parse_args()
     # Setup the database
     db = Database(options.database_url)
@@ -122,30 +403,61 @@ def main():
         logging.getLogger().addHandler(console)
     if not args:
         sys.stderr.write("Please specify one or more pages downloaded from "
-                         "AllRecipes.com\n")
+                         "AllRecipes.com, or tar or zip archives of pages\n")
         parser.print_help()
         exit(-1)
     if len(args) > 1:
         filenames = args
     else:
-        filenames = glob.iglob(args[0])
+        filenames = list(glob.iglob(args[0]))
+    for filename in filenames:
+        if not os.path.isfile(filename):
+            sys.stderr.write("%s must be a valid filename\n" % filename)
+            exit(-1)
+    # Pages inside archives are streamed, never extracted to disk.  In random
+    # order, a sample of up to limit pages is chosen in one pass over the
+    # listings of the files, and only those pages are read, so a sampled page
+    # that turns out to be a duplicate isn't replaced by another one.  The
+    # sampled pages of a tar archive are read in the order they're stored
+    # in (see open_pages()).  Otherwise the number of pages isn't known
+    # until they've all been read.
     if options.random_order:
-        random.shuffle(filenames)
-    if options.limit:
-        print "Importing up to %i recipes" % options.limit
+        if options.limit:
+            page_refs = reservoir_sample(list_pages(filenames),
+                                         options.limit)
+        else:
+            page_refs = list(list_pages(filenames))
+            random.shuffle(page_refs)
+        max_to_import = max(len(page_refs), 1)
+        pages = open_pages(page_refs)
+    else:
+        max_to_import = options.limit
+        pages = iter_pages(filenames)
+    if max_to_import is None:
+        print "Importing all recipes"
+        widgets = [Counter(), ' recipes imported in ', Timer()]
+        max_to_import = UnknownLength
     else:
-        print "Importing up to %i recipes" % len(filenames)
-    widgets = [Percentage(), Bar(), ETA()]
-    max_to_import = options.limit or len(filenames)
+        print "Importing up to %i recipes" % max_to_import
+        widgets = [Percentage(), Bar(), ETA()]
     progress_bar = ProgressBar(widgets=widgets, maxval=max_to_import).start()
+    if options.single_pass:
+        extract = extract_recipe_parts_single_pass
+    else:
+        extract = extract_recipe_parts
+    # Build a filter of the urls already in the database, so that duplicate
+    # pages can be skipped before they're fully parsed.
+    db.load_url_filter()
     # Import the recipes
     imported_count = 0
-    for filename in filenames:
-        if not os.path.isfile(filename):
-            sys.stderr.write("%s must be a valid filename\n" % filename)
-            exit(-1)
-        recipe_file = open(filename)
-        recipe_parts = extract_recipe_parts(recipe_file)
+    for (filename, recipe_file) in pages:
+        page = recipe_file.read()
+        recipe_file.close()
+        url = extract_canonical_url(StringIO(page))
+        if url and db.has_recipe_url(url):
+            logging.warn("Duplicate recipe in %s; skipping." % filename)
+            continue
+        recipe_parts = extract(StringIO(page))
         try:
             db._add_from_recipe_parts(recipe_parts)
             logging.info("Imported recipe %s from %s" %
@@ -157,8 +469,8 @@ def main():
                 break
         except DuplicateRecipeException:
             logging.warn("Duplicate recipe in %s; skipping." % filename)
-        recipe_file.close()
     db._session.commit()
+    db.save_url_filter()
     progress_bar.finish()
     print "Imported %i recipes." % imported_count
 
@@ -0,0 +1,619 @@
+#!/usr/bin/env python
+"""
+Event-driven front end for the web chat server.
+
+One thread runs an asyncore event loop, which accepts connections and reads
+and writes the HTTP requests, so that many slow connections can be open at
+once.  The work of answering chat messages is done by bounded pools of
+worker threads, one for each stage of Chatbot.respond_in_stages(): parsing
+('nlu'), dialogue management and database queries ('dm'), and realisation
+('nlg').  Sessions are loaded and saved, and other requests are handled by
+the WebChatServer, in the 'dm' pool.  Messages for the same session are
+answered one at a time, in the order that they arrived, and the session's
+lock in the session store is held while each of them is answered.  Messages
+sent to /stream are answered the same way, with each piece of the response
+sent as a server-sent event as soon as it's realised.
+
+The pools record how long jobs wait for a thread separately from how long
+they take to run, and the server records how long messages wait behind
+earlier messages for the same session; see AsyncChatServer.get_metrics().
+
+For a demo, run this program and point your browser to
+http://localhost:8080.  Run it with --help for its options.
+"""
+import asynchat
+import asyncore
+import collections
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import urlparse
+import Queue
+from cStringIO import StringIO
+from optparse import OptionParser
+
+from admission import Overloaded
+from session_store import SessionBusy
+
+# The default number of threads in each pool.
+POOL_SIZES = {'nlu': 2, 'dm': 4, 'nlg': 2}
+
+
+class _Timings(object):
+    """
+    The number, total and maximum of a series of durations.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+        }
+
+
+class WorkerPool(object):
+    """
+    A fixed number of threads running jobs from a queue.  The pool records
+    how long jobs wait in the queue and how long they take to run.
+    """
+
+    def __init__(self, name, size, call_soon, logger=None):
+        """
+        Create a pool of size threads.  The callbacks of jobs are passed to
+        call_soon(callback, result, error), which should call them in the
+        event loop's thread.
+        """
+        self.name = name
+        self.size = size
+        self.log = logger or logging.getLogger('async_server')
+        self._call_soon = call_soon
+        self._jobs = Queue.Queue()
+        self._lock = threading.Lock()
+        self._queue_wait = _Timings()
+        self._service_time = _Timings()
+        self._errors = 0
+        self._threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self._work,
+                                      name='%s-%d' % (name, i))
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, function, callback):
+        """
+        Call function() in one of the pool's threads, and then
+        callback(result, error) in the event loop's thread.  error is None,
+        or the exception raised by function().
+        """
+        self._jobs.put((time.time(), function, callback))
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            queued, function, callback = job
+            started = time.time()
+            result, error = None, None
+            try:
+                result = function()
+            except Exception, e:
+                self.log.exception("Error in the %s pool" % self.name)
+                error = e
+            finished = time.time()
+            with self._lock:
+                self._queue_wait.add(started - queued)
+                self._service_time.add(finished - started)
+                if error is not None:
+                    self._errors += 1
+            self._call_soon(callback, result, error)
+
+    def get_metrics(self):
+        """
+        Return the pool's size, the number of queued jobs and of failed
+        jobs, and the count, mean and maximum of the jobs' queue wait and
+        service times, in seconds.
+        """
+        with self._lock:
+            return {
+                'threads': self.size,
+                'queued': self._jobs.qsize(),
+                'errors': self._errors,
+                'queue_wait': self._queue_wait.as_dict(),
+                'service_time': self._service_time.as_dict(),
+            }
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._jobs.put(None)
+
+
+class _Waker(asyncore.file_dispatcher):
+    """
+    Runs callbacks from other threads in the event loop's thread, waking the
+    loop up by writing to a pipe.
+    """
+
+    def __init__(self, socket_map, logger):
+        read_fd, self._write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, socket_map)
+        os.close(read_fd)  # file_dispatcher keeps a duplicate.
+        self.log = logger
+        self._callbacks = collections.deque()
+
+    def call_soon(self, callback, *args):
+        self._callbacks.append((callback, args))
+        os.write(self._write_fd, 'x')
+
+    def handle_read(self):
+        self.recv(4096)
+        while self._callbacks:
+            callback, args = self._callbacks.popleft()
+            try:
+                callback(*args)
+            except Exception:
+                self.log.exception("Error in a callback")
+
+    def writable(self):
+        return False
+
+
+class _SessionQueues(object):
+    """
+    Starts the work for each session's messages one at a time, in order.
+    Only used from the event loop's thread.
+    """
+
+    def __init__(self):
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def run(self, session_id, start):
+        """
+        Call start() now if no message for the session is being answered,
+        or else after the messages before it have been answered.
+        """
+        if session_id in self._pending:
+            self._pending[session_id].append(start)
+        else:
+            self._pending[session_id] = collections.deque()
+            start()
+
+    def done(self, session_id):
+        """
+        Start the work for the session's next message, if there is one.
+        """
+        pending = self._pending[session_id]
+        if pending:
+            pending.popleft()()
+        else:
+            del self._pending[session_id]
+
+
+class _HTTPChannel(asynchat.async_chat):
+    """
+    A connection from a client, which reads one HTTP request and writes the
+    response.
+    """
+
+    def __init__(self, server, sock, socket_map):
+        asynchat.async_chat.__init__(self, sock, socket_map)
+        self.server = server
+        self.closed = False
+        self._data = []
+        self._request = None
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        self._data.append(data)
+
+    def found_terminator(self):
+        data = ''.join(self._data)
+        self._data = []
+        if self._request is None:
+            lines = data.split('\r\n')
+            try:
+                method, path, _ = lines[0].split(' ', 2)
+            except ValueError:
+                self.send_response('400 Bad Request', [], '')
+                return
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            self._request = (method, path, headers)
+            length = int(headers.get('content-length') or 0)
+            if length > 0:
+                self.set_terminator(length)
+                return
+            data = ''
+        # Ignore anything the client sends after the request.
+        self.set_terminator(None)
+        method, path, headers = self._request
+        self.server.handle_request(self, method, path, headers, data)
+
+    def send_response(self, status, headers, body):
+        """
+        Send the response and close the connection.
+        """
+        if self.closed:
+            return
+        lines = ['HTTP/1.0 %s' % status]
+        lines.extend('%s: %s' % header for header in headers)
+        lines.extend(['Content-Length: %d' % len(body), 'Connection: close',
+                      '', ''])
+        self.push('\r\n'.join(lines) + body)
+        self.close_when_done()
+
+    def start_response(self, status, headers):
+        """
+        Send the status and headers of a response whose body is sent in
+        pieces by send_data(), until end_response() closes the connection.
+        """
+        if self.closed:
+            return
+        lines = ['HTTP/1.0 %s' % status]
+        lines.extend('%s: %s' % header for header in headers)
+        lines.extend(['Connection: close', '', ''])
+        self.push('\r\n'.join(lines))
+
+    def send_data(self, data):
+        if not self.closed:
+            self.push(data)
+
+    def end_response(self):
+        if not self.closed:
+            self.close_when_done()
+
+    def handle_close(self):
+        self.closed = True
+        self.close()
+
+
+class _ChatJob(object):
+    """
+    The answering of one chat message.  If stream is True, the response is
+    sent as server-sent events.
+    """
+
+    def __init__(self, channel, session_id, message, stream=False):
+        self.channel = channel
+        self.session_id = session_id
+        self.message = message
+        self.stream = stream
+        self.received = time.time()
+        # Whether a streamed response's headers and pieces have been sent.
+        self.response_started = False
+        self.streamed = False
+        self.lock_token = None
+        self.chatbot = None
+        self.stages = None
+        self.response = None
+
+
+class AsyncChatServer(asyncore.dispatcher):
+    """
+    Serves a WebChatServer from an event loop, answering chat messages in
+    pools of worker threads.
+    """
+
+    def __init__(self, app, address, pool_sizes=None, logger=None):
+        """
+        Listen for connections at address, a (host, port) pair.  pool_sizes
+        maps the names of the pools to their numbers of threads, and
+        defaults to POOL_SIZES.
+        """
+        self._map = {}
+        asyncore.dispatcher.__init__(self, map=self._map)
+        self.app = app
+        self.address = address
+        self.log = logger or logging.getLogger('async_server')
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(128)
+        self._waker = _Waker(self._map, self.log)
+        sizes = dict(POOL_SIZES)
+        sizes.update(pool_sizes or {})
+        self.pools = dict((name, WorkerPool(name, size,
+                                            self._waker.call_soon, self.log))
+                          for name, size in sizes.items())
+        self._sessions = _SessionQueues()
+        self._session_wait = _Timings()
+        self._response_time = _Timings()
+        if hasattr(app, 'metrics_sources'):
+            app.metrics_sources['server'] = self.get_metrics
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            _HTTPChannel(self, pair[0], self._map)
+
+    def handle_request(self, channel, method, path, headers, body):
+        """
+        Answer chat messages posted by the chat interface or sent to
+        /stream in stages, and pass any other request to the WebChatServer.
+        """
+        path_info, _, query = path.partition('?')
+        params = {}
+        if method == 'POST' and path_info in ('/', '/stream') and \
+                headers.get('content-type', '').startswith(
+                    'application/x-www-form-urlencoded'):
+            params = urlparse.parse_qs(body)
+        elif method == 'GET' and path_info == '/stream':
+            params = urlparse.parse_qs(query)
+        if 'session_id' in params and 'chat_message' in params:
+            job = _ChatJob(channel, params['session_id'][0],
+                           params['chat_message'][0],
+                           stream=path_info == '/stream')
+            self._sessions.run(job.session_id,
+                               lambda: self._start_chat_job(job))
+            return
+        environ = self._environ(method, path, headers, body)
+        self.pools['dm'].submit(lambda: self._call_app(environ),
+            lambda result, error: self._send_app_response(channel, result,
+                                                          error))
+
+    def _environ(self, method, path, headers, body):
+        path, _, query = path.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': path,
+            'QUERY_STRING': query,
+            'CONTENT_TYPE': headers.get('content-type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'SERVER_NAME': self.address[0],
+            'SERVER_PORT': str(self.address[1]),
+            'SERVER_PROTOCOL': 'HTTP/1.0',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': StringIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in headers.items():
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+        return environ
+
+    def _call_app(self, environ):
+        response = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+        body = ''.join(self.app(environ, start_response))
+        return (response[0], response[1], body)
+
+    def _send_app_response(self, channel, result, error):
+        if error is not None:
+            channel.send_response('500 Internal Server Error', [], '')
+        else:
+            channel.send_response(*result)
+
+    def _start_chat_job(self, job):
+        self._session_wait.add(time.time() - job.received)
+        self.pools['dm'].submit(
+            lambda: self._load_session(job),
+            lambda chatbot, error: self._chatbot_loaded(job, chatbot, error))
+
+    def _load_session(self, job):
+        """
+        Lock the job's session and return a chatbot continuing it.
+        """
+        job.lock_token = self.app.state_datastore.lock(job.session_id)
+        return self.app._continue_session(job.session_id)
+
+    def _save_session(self, job):
+        """
+        Save the job's session and unlock it.
+        """
+        try:
+            self.app._save_chatbot(job.chatbot, job.session_id)
+        finally:
+            self._unlock_session(job)
+
+    def _unlock_session(self, job):
+        if job.lock_token is not None:
+            self.app.state_datastore.unlock(job.session_id, job.lock_token)
+            job.lock_token = None
+
+    def _chatbot_loaded(self, job, chatbot, error):
+        if error is not None:
+            return self._fail(job, error)
+        job.chatbot = chatbot
+        job.stages = chatbot.respond_in_stages(job.message,
+                                               incremental=job.stream)
+        self._run_stage(job, job.stages.next)
+
+    def _run_stage(self, job, next_stage):
+        """
+        Submit the chatbot's next stage to its pool, or save the session
+        once the chatbot has responded.
+        """
+        if job.stream and job.channel.closed:
+            # The client has gone away, so the session is left as it was.
+            job.stages.close()
+            return self._fail(job)
+        try:
+            stage, value = next_stage()
+        except Exception:
+            self.log.exception("Error while answering a message")
+            return self._fail(job)
+        if stage is None:
+            job.response = value
+            if job.stream and not job.streamed:
+                self._send_event(job, value)
+            self.pools['dm'].submit(lambda: self._save_session(job),
+                lambda result, error: self._finish(job, error))
+        else:
+            self.pools[stage].submit(value,
+                lambda result, error: self._stage_done(job, stage, result,
+                                                       error))
+
+    def _stage_done(self, job, stage, result, error):
+        if error is not None:
+            return self._fail(job, error)
+        if job.stream and stage == 'nlg':
+            job.streamed = True
+            self._send_event(job, result)
+        self._run_stage(job, lambda: job.stages.send(result))
+
+    def _send_event(self, job, data, event=None):
+        """
+        Send a server-sent event of a streamed response, starting the
+        response if it hasn't been started.
+        """
+        from web_server import server_sent_event
+        if not job.response_started:
+            job.channel.start_response('200 OK',
+                [('Content-Type', 'text/event-stream'),
+                 ('Cache-Control', 'no-cache')])
+            job.response_started = True
+        job.channel.send_data(server_sent_event(data, event))
+
+    def _finish(self, job, error):
+        if error is not None:
+            return self._fail(job)
+        self._response_time.add(time.time() - job.received)
+        if job.stream:
+            self._send_event(job, '', 'done')
+            job.channel.end_response()
+        else:
+            job.channel.send_response('200 OK',
+                                      [('Content-Type', 'text/plain')],
+                                      job.response)
+        self._sessions.done(job.session_id)
+
+    def _fail(self, job, error=None):
+        if job.response_started:
+            # It's too late to change the status, so the stream ends without
+            # its 'done' event.
+            job.channel.end_response()
+        elif isinstance(error, (Overloaded, SessionBusy)):
+            # The session isn't saved, so the message can be sent again.
+            job.channel.send_response('503 Service Unavailable',
+                [('Content-Type', 'text/plain'),
+                 ('Retry-After', str(error.retry_after))], str(error))
+        else:
+            job.channel.send_response('500 Internal Server Error', [], '')
+        if job.lock_token is None:
+            self._sessions.done(job.session_id)
+        else:
+            # Start the session's next message once the lock is released.
+            self.pools['dm'].submit(lambda: self._unlock_session(job),
+                lambda result, error: self._sessions.done(job.session_id))
+
+    def get_metrics(self):
+        """
+        Return the metrics of each pool, the time that messages waited behind
+        earlier messages for the same session, the time taken to answer
+        messages, and the numbers of open connections and of sessions with
+        messages being answered.
+        """
+        return {
+            'pools': dict((name, pool.get_metrics())
+                          for name, pool in self.pools.items()),
+            'session_wait': self._session_wait.as_dict(),
+            'response_time': self._response_time.as_dict(),
+            'connections': sum(1 for dispatcher in self._map.values()
+                               if isinstance(dispatcher, _HTTPChannel)),
+            'busy_sessions': len(self._sessions),
+        }
+
+    def serve_forever(self, metrics_interval=None):
+        """
+        Run the event loop, logging the metrics every metrics_interval
+        seconds if it's given.
+        """
+        last_report = time.time()
+        while self._map:
+            asyncore.loop(timeout=1, use_poll=True, map=self._map, count=1)
+            if metrics_interval and \
+                    time.time() - last_report >= metrics_interval:
+                self.log.info("Metrics: %s" % self.get_metrics())
+                last_report = time.time()
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown()
+        asyncore.close_all(self._map)
+
+
+PARSER = OptionParser()
+PARSER.add_option("--database", dest="database_url",
+                  default='sqlite:///test_database.sqlite')
+PARSER.add_option("--port", dest="port", type="int", default=8080)
+PARSER.add_option("--sessions", dest="session_store", default='memory',
+                  choices=['memory', 'sqlite', 'socket'],
+                  help="where to keep sessions: memory, sqlite or socket")
+PARSER.add_option("--session-file", dest="session_file",
+                  default='sessions.sqlite',
+                  help="database file of the sqlite session store")
+for _name in sorted(POOL_SIZES):
+    PARSER.add_option("--%s-threads" % _name, dest="%s_threads" % _name,
+                      type="int", default=POOL_SIZES[_name],
+                      help="number of threads for the %s stage" % _name)
+PARSER.add_option("--metrics-interval", dest="metrics_interval",
+                  type="float", default=60,
+                  help="seconds between logging the metrics")
+
+
+def main():
+    """
+    Run the chat server with the event-driven front end.
+    """
+    (options, args) = PARSER.parse_args()
+    logger = logging.getLogger('chatbot_server')
+    logging.basicConfig(level=logging.DEBUG)
+    # These imports are performed after the logging setup because basicConfig
+    # will not work if other modules call logging functions before it's called.
+    from database import Database
+    from nlg import warm_up as warm_up_nlg
+    from nlu.stanford_utils import warm_up as warm_up_nlu
+    from session_store import start_session_store_server
+    from web_server import WebChatServer, make_session_store
+    session_server = None
+    if options.session_store == 'socket':
+        session_server = start_session_store_server()
+    db = Database(options.database_url)
+    chat_app = WebChatServer(db, logger, make_session_store(
+        options.session_store, logger, options.session_file))
+    # Launch the parser and realiser now, so the first user doesn't wait.
+    warm_up_nlu()
+    warm_up_nlg()
+    pool_sizes = dict((name, getattr(options, '%s_threads' % name))
+                      for name in POOL_SIZES)
+    server = AsyncChatServer(chat_app, ('0.0.0.0', options.port), pool_sizes,
+                             logger.getChild('async'))
+    try:
+        print "Started chatbot web server."
+        server.serve_forever(options.metrics_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        if session_server is not None:
+            session_server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,13 +3,21 @@ Chatbot application object.
 """
 from greeter import *
 import code
+import json
 import logging
-from nlg import NaturalLanguageGenerator
+import threading
+import time
+import tracing
+from admission import get_jvm_admission
+from data_structures import state_property
+from nlg import NaturalLanguageGenerator, ContentPlanMessage
 from nlu import NaturalLanguageUnderstander
 from nlu.messages import *
-from dm import DialogueManager
+from dm import DialogueManager, DialogueState
+from response_cache import ResponseCache
 from creative import CreativeManager
 from nlu.messages.parsed_input_message import ParsedInputMessage
+from nlu.stanford_utils import without_parser, recording_fallbacks
 
 # Monkey-patch the Python 2.7 logger.getChild() method into the logger class,
 # to maintain backwards-compatibility with Python 2.6.
@@ -25,57 +33,293 @@ if not hasattr(logging.Logger, "getChild"):
     logging.Logger.getChild = _getChild
 
 
+class ChatbotServices(object):
+    """
+    The parts of the chatbot that are shared by all conversations: the
+    database, NLU, NLG and the cache of responses to opening messages.  They
+    don't keep any state of a conversation, so they're created once per
+    process; see get_services().
+    """
+
+    def __init__(self, db, logger):
+        self.db = db
+        self.log = logger
+        self.response_cache = ResponseCache(db)
+        self.nlg = NaturalLanguageGenerator(logger.getChild('nlg'))
+        self.nlu = NaturalLanguageUnderstander(0.5, logger.getChild('nlu'),
+                                               db)
+        # Register the NLU messages we want
+        self.nlu.register_message(YesNoMessage)
+        self.nlu.register_message(SearchMessage)
+        self.nlu.register_message(SystemMessage)
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_services(db, logger):
+    """
+    Return the ChatbotServices shared by every chatbot using db.
+    """
+    with _services_lock:
+        key = id(db)
+        if key not in _services or _services[key].db is not db:
+            _services[key] = ChatbotServices(db, logger)
+        return _services[key]
+
+
+class SessionState(object):
+    """
+    Everything the chatbot remembers about one conversation.  This is all a
+    chatbot needs to keep between messages; the rest is shared.
+
+    Session states can be pickled, or serialized as JSON with encode_state(),
+    so that they can be kept outside of the process serving them.
+
+    >>> state = SessionState()
+    >>> state.dialogue.query = {'include_cuisines': ['Thai']}
+    >>> state.expected_message = 'YesNoMessage'
+    >>> copy = decode_state(encode_state(state))
+    >>> copy.dialogue.query, copy.expected_message, copy.creative
+    ({'include_cuisines': ['Thai']}, 'YesNoMessage', (None, None))
+    >>> import cPickle
+    >>> cPickle.loads(cPickle.dumps(state)).dialogue.query
+    {'include_cuisines': ['Thai']}
+    """
+    __slots__ = ('prompt', 'creative_mode', 'tone', 'last_user_input',
+                 'last_bot_output', 'expected_message', 'dialogue',
+                 'creative')
+
+    def __init__(self):
+        self.prompt = '-> '
+        # Enables creative mode, temporarily.  Creative mode allows
+        # concurrent activity between the creative subgroup and lev1, lev2.
+        self.creative_mode = False
+        self.tone = 'normal'
+        self.last_user_input = None
+        self.last_bot_output = ""
+        # The name of the message class that the NLU should expect, if any.
+        self.expected_message = None
+        self.dialogue = DialogueState()
+        # The CreativeManager's (current_state, user_name).
+        self.creative = (None, None)
+
+    def to_dict(self):
+        """
+        Return the state as a dictionary of strings, numbers, lists and
+        dictionaries, which can be serialized as JSON.
+        """
+        state_dict = dict((name, getattr(self, name))
+                          for name in self.__slots__)
+        state_dict['dialogue'] = self.dialogue.to_dict()
+        state_dict['creative'] = list(self.creative)
+        return state_dict
+
+    @classmethod
+    def from_dict(cls, state_dict):
+        """
+        Create a SessionState from a dictionary returned by to_dict().
+        """
+        state = cls()
+        state.__setstate__(state_dict)
+        return state
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state_dict):
+        self.__init__()
+        for name in self.__slots__:
+            if name in state_dict:
+                setattr(self, name, state_dict[name])
+        self.dialogue = DialogueState.from_dict(self.dialogue) \
+            if isinstance(self.dialogue, dict) else self.dialogue
+        self.creative = tuple(self.creative)
+
+
+def _to_str(value):
+    """
+    Convert the unicode strings that JSON decodes to UTF-8 strs.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif isinstance(value, list):
+        return [_to_str(item) for item in value]
+    elif isinstance(value, dict):
+        return dict((_to_str(key), _to_str(item))
+                    for key, item in value.iteritems())
+    return value
+
+
+def encode_state(state):
+    """
+    Serialize a SessionState as JSON.
+    """
+    return json.dumps(state.to_dict(), separators=(',', ':'))
+
+
+def decode_state(data):
+    """
+    Create a SessionState from JSON returned by encode_state().
+    """
+    return SessionState.from_dict(_to_str(json.loads(data)))
+
+
+def run_stages(stages, timings=None, results=None):
+    """
+    Run the stages yielded by Chatbot.respond_in_stages() one after the other
+    in this thread, and return the output string.  If they're given, the
+    seconds spent in each stage are added to timings, and the result of each
+    stage is stored in results, both dictionaries keyed by stage.
+    """
+    stage, value = stages.next()
+    while stage is not None:
+        started = time.time()
+        result = value()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + time.time() - started
+        if results is not None:
+            results[stage] = result
+        stage, value = stages.send(result)
+    return value
+
+
+def stream_stages(stages):
+    """
+    Run the stages yielded by Chatbot.respond_in_stages(incremental=True)
+    one after the other in this thread, generating the pieces of the output
+    string: the result of each 'nlg' stage as soon as it's ready, or the whole
+    output if there weren't any.
+    """
+    streamed = False
+    stage, value = stages.next()
+    while stage is not None:
+        result = value()
+        if stage == 'nlg':
+            streamed = True
+            yield result
+        stage, value = stages.send(result)
+    if not streamed:
+        yield value
+
+
+def _is_plain_data(value):
+    """
+    Return True if value only contains strings, numbers, lists and
+    dictionaries, and so can be shared by conversations.
+
+    >>> _is_plain_data([ContentPlanMessage('echo', message='Hi'), None])
+    True
+    >>> _is_plain_data({'recipe': object()})
+    False
+    """
+    if value is None or isinstance(value, (basestring, int, long, float)):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(_is_plain_data(item) for item in value)
+    if isinstance(value, dict):
+        return all(_is_plain_data(key) and _is_plain_data(item)
+                   for key, item in value.items())
+    return False
+
+
 class Chatbot(object):
     """
     Object that represents an instance of the chatbot application.
     This object coordinates the flow of information through the
     different modules of the application, as well as configuration
     settings.
+
+    A chatbot keeps the state of its conversation in a SessionState and
+    shares everything else with the other chatbots, so creating one is cheap.
+    A conversation can be continued by a new chatbot created with its state.
     """
 
-    def __init__(self, db, logger, enable_debug=True):
+    prompt = state_property('prompt')
+    creative_mode = state_property('creative_mode')
+    last_user_input = state_property('last_user_input')
+    last_bot_output = state_property('last_bot_output')
+
+    def __init__(self, db, logger, enable_debug=True, state=None):
         """
-        Create a new instance of the chatbot application.
+        Create a new instance of the chatbot application, continuing the
+        conversation in state or starting a new one.
 
         >>> from database import Database
         >>> db = Database('sqlite:///:memory:')
         >>> bot = Chatbot(db, logging.getLogger())
         >>> response = bot.handle_input("Hi!")
+        >>> Chatbot(db, logging.getLogger(), state=bot.state).nlu is bot.nlu
+        True
         """
-        self.prompt = '-> '
-        self.creative_mode = False          # enables creative mode, temporarilly.
-                                            # creative mode allows concurrent activity
-                                            # between creative subgroup and lev1, lev2
+        if state is None:
+            state = SessionState()
+        self.state = state
         self.enable_debug = enable_debug
         self.db = db
         self.log = logger
-        self.nlg = NaturalLanguageGenerator(logger.getChild('nlg'))
-        self.nlu = NaturalLanguageUnderstander(0.5, logger.getChild('nlu'))
-        self.dm = DialogueManager(db, logger.getChild('dm'))
-        #
-        self.creative_nlp = CreativeManager(db, logger.getChild('creative'), self.nlu, self.nlg, self.dm)
-        #
+        services = get_services(db, logger)
+        self.nlu = services.nlu
+        self.nlg = services.nlg.with_tone(state.tone)
+        self.dm = DialogueManager(db, logger.getChild('dm'), state.dialogue)
+        self.response_cache = services.response_cache
+        # Whether the last input was understood without parsing all of it,
+        # in which case the response isn't cached.
+        self._understood_without_parser = False
         self.log.debug("Chatbot instantiated")
-        self.last_bot_output = ""
 
-        # Register the NLU messages we want
-        self.nlu.register_message(YesNoMessage)
-        self.nlu.register_message(SearchMessage)
-        self.nlu.register_message(SystemMessage)
+    def login(self):
+        """
+        Ask the user to log in and choose an agent at the console.  The agent
+        sets the tone of the conversation.
+        """
         startup(self.nlg)
+        self.state.tone = self.nlg.tone
+
+    def _creative_manager(self):
+        manager = CreativeManager(self.db, self.log.getChild('creative'),
+                                  self.nlu, self.nlg, self.dm)
+        manager.current_state, manager.user_name = self.state.creative
+        return manager
 
     def handle_input(self, user_input):
         """
         Given a string of user input, return the output string.
         """
+        with tracing.span('chatbot.handle_input'):
+            return run_stages(self.respond_in_stages(user_input))
+
+    def respond_incrementally(self, user_input):
+        """
+        Like handle_input(), but a generator which yields the output in
+        pieces, realising each content plan as soon as it's planned.
+        """
+        return stream_stages(self.respond_in_stages(user_input,
+                                                    incremental=True))
+
+    def respond_in_stages(self, user_input, incremental=False):
+        """
+        Respond to user input in stages, so that a server can run each stage
+        somewhere else.  This is a generator which yields (stage, function)
+        pairs, where stage is 'nlu', 'dm' or 'nlg', and must be sent the
+        result of calling function() for each of them.  It finishes by
+        yielding (None, the output string).  See run_stages().
+
+        If incremental is True, the content plans are planned and realised
+        one at a time, in alternating 'dm' and 'nlg' stages, and each 'nlg'
+        stage's result is a piece of the output.  See stream_stages().
+        """
         if user_input == "creative on":
             self.prompt = '+> '   # change the prompt to creative mode.
             self.creative_mode = True
-            return 'Ok, creative mode is on.'
+            yield (None, 'Ok, creative mode is on.')
+            return
         elif user_input == "creative off":
             self.creative_mode = False
             self.prompt = '-> '   # change the prompt back to regular mode.
-            return 'Ok, creative mode is off.'
+            yield (None, 'Ok, creative mode is off.')
+            return
 
         if self.enable_debug and user_input == "/debug":
             # allow going into debug - command interpretive state.
@@ -83,7 +327,8 @@ class Chatbot(object):
             self.debug_prompt()
             # Return the chatbot's last output utterance, to remind the user
             # where they were before they entered the debugging prompt.
-            return self.last_bot_output
+            yield (None, self.last_bot_output)
+            return
 
         self.log.info('%12s = "%s"' % ('user_input', user_input))
         self.last_user_input = user_input
@@ -93,21 +338,161 @@ class Chatbot(object):
         if (self.creative_mode):
             # This mode bypasses nlu, dm and nlg allowing separate experiments
             # within the same framework.
-            bot_response = self.creative_nlp.respond(user_input)
+            creative_nlp = self._creative_manager()
+            bot_response = yield ('nlu',
+                                  lambda: creative_nlp.respond(user_input))
+            self.state.creative = (creative_nlp.current_state,
+                                   creative_nlp.user_name)
             ####################################################
         else:
-            parsed_input = self.nlu.parse_input(user_input)
-            # If the input could not be parsed, we could include code here to
-            # use a general-purpose chatbot that can guide the user back to the
-            # topic.
-            #
-            self.log.debug('%12s = "%s"' % ('parsed_input', parsed_input))
-            content_plan = self.dm.plan_response(parsed_input)
-            self.log.debug('%12s = "%s"' % ('content_plan', content_plan))
-            bot_response = self.nlg.generate_response(content_plan)
+            # Messages that open a conversation, which other conversations
+            # have sent before, are answered from the response cache without
+            # being parsed or searched for; see response_cache.
+            self._understood_without_parser = False
+            fingerprint = self._response_cache_fingerprint()
+            cached = None
+            if fingerprint is not None:
+                cached = yield ('nlu', lambda:
+                    self.response_cache.get(user_input, fingerprint))
+            if cached is None:
+                expected_message = None
+                if self.state.expected_message:
+                    expected_message = \
+                        self.nlu.get_message_type(self.state.expected_message)
+                parsed_input = yield ('nlu', lambda:
+                    self._understand(user_input, expected_message))
+                # If the input could not be parsed, we could include code here
+                # to use a general-purpose chatbot that can guide the user back
+                # to the topic.
+                #
+                self.log.debug('%12s = "%s"' % ('parsed_input', parsed_input))
+            if incremental:
+                if cached is None:
+                    content_plans = \
+                        self.dm.plan_response_incrementally(parsed_input)
+                else:
+                    content_plans = iter(self._recall_response(cached))
+                planned = []
+                responses = []
+                while True:
+                    content_plan = yield ('dm',
+                        lambda: self._plan_next(content_plans))
+                    if content_plan is None:
+                        break
+                    planned.append(content_plan)
+                    self.log.debug('%12s = "%s"' % ('content_plan',
+                                                    content_plan))
+                    response = yield ('nlg',
+                        lambda: self._realise(content_plan))
+                    responses.append(response)
+                bot_response = '\n'.join(responses)
+                if cached is None and fingerprint is not None:
+                    yield ('dm', lambda: self._remember_response(
+                        user_input, fingerprint, planned))
+            else:
+                if cached is None:
+                    content_plan = yield ('dm', lambda: self._plan_response(
+                        parsed_input, user_input, fingerprint))
+                else:
+                    content_plan = yield ('dm',
+                        lambda: self._recall_response(cached))
+                self.log.debug('%12s = "%s"' % ('content_plan', content_plan))
+                bot_response = yield ('nlg',
+                    lambda: self._realise(content_plan))
         self.log.info('%12s = "%s"' % ('bot_response', bot_response))
         self.last_bot_output = bot_response
-        return bot_response
+        yield (None, bot_response)
+
+    def _understand(self, user_input, expected_message):
+        """
+        Parse user input, if the JVM admits the work in time.  Otherwise,
+        either understand it from its tokens and keywords alone, or raise
+        admission.Overloaded, depending on the overload mode.  Notes whether
+        any of the input wasn't parsed, whatever the reason.
+        """
+        admission = get_jvm_admission()
+        with admission.admit() as admitted:
+            if admitted:
+                with recording_fallbacks() as fallbacks:
+                    parsed_input = self.nlu.parse_input(user_input,
+                                                        expected_message)
+                self._understood_without_parser = bool(fallbacks)
+                return parsed_input
+        admission.count_shed('nlu')
+        self._understood_without_parser = True
+        with without_parser():
+            return self.nlu.parse_input(user_input, expected_message)
+
+    def _realise(self, content_plan):
+        """
+        Generate the response to a content plan, if the JVM admits the work
+        in time, or otherwise from templates.  The response is never
+        rejected, since the dialogue manager has already acted on the input.
+        """
+        admission = get_jvm_admission()
+        with admission.admit() as admitted:
+            if admitted:
+                return self.nlg.generate_response(content_plan)
+        admission.count_shed('nlg', may_reject=False)
+        return self.nlg.templates_only().generate_response(content_plan)
+
+    def _plan_response(self, parsed_input, user_input, fingerprint):
+        """
+        Plan the response to parsed input, and cache it if fingerprint isn't
+        None.
+        """
+        content_plan = self.dm.plan_response(parsed_input)
+        if fingerprint is not None:
+            self._remember_response(user_input, fingerprint, content_plan)
+        return content_plan
+
+    def _response_cache_fingerprint(self):
+        """
+        Return a fingerprint of the conversation's state, if the response to
+        the next message can be cached, or None.  Only responses in the start
+        state are cached, since they don't depend on earlier messages.
+        """
+        if self.state.dialogue.current_state != 'start':
+            return None
+        state = self.state.dialogue.to_dict()
+        del state['user_name']  # It doesn't affect the response.
+        state['expected_message'] = self.state.expected_message
+        return json.dumps(state, sort_keys=True)
+
+    def _remember_response(self, user_input, fingerprint, content_plans):
+        """
+        Cache the content plans planned in response to user input, and the
+        dialogue state that followed, unless the plans refer to objects from
+        the database or the parser fell back on any of the input, say because
+        it was busy or the input was too long.
+        """
+        if self._understood_without_parser:
+            return
+        if isinstance(content_plans, ContentPlanMessage):
+            content_plans = [content_plans]
+        content_plans = list(content_plans or [])
+        if not _is_plain_data(content_plans):
+            return
+        self.response_cache.put(user_input, fingerprint, content_plans,
+                                self.state.dialogue.to_dict())
+
+    def _recall_response(self, cached):
+        """
+        Continue the conversation with a response from the cache, returning
+        its content plans.
+        """
+        content_plans, dialogue = cached
+        self.state.dialogue = DialogueState.from_dict(dialogue)
+        self.dm.state = self.state.dialogue
+        return content_plans
+
+    def _plan_next(self, content_plans):
+        """
+        Return the next content plan from plan_response_incrementally(), or
+        None if there are no more.
+        """
+        with tracing.span('dm.plan_response_incrementally'):
+            return next(content_plans, None)
 
     def debug_prompt(self):
         """
@@ -120,7 +505,7 @@ class Chatbot(object):
             'dm': self.dm,
             'nlg': self.nlg,
             'nlu': self.nlu,
-            'create': self.creative_nlp,
+            'create': self._creative_manager(),
             'chatbot': self
         }
         banner = "Debugging Console (db, dm, nlg, nlu, chatbot)"
@@ -3,6 +3,7 @@
 Command line interface to the chatbot.
 """
 import logging
+import sys
 
 from optparse import OptionParser
 
@@ -32,6 +33,7 @@ def main():
     # Setup the chatbot
     logger = logging.getLogger('chatbot')
     bot = Chatbot(db, logger)
+    bot.login()
     greeting = bot.get_greeting()
 
     print greeting
@@ -44,8 +46,10 @@ def main():
             user_input = raw_input(PROMPT)
         except EOFError:
             return
-        bot_output = bot.handle_input(user_input)
-        print bot_output
+        # Print each part of the output as soon as it's ready.
+        for bot_output in bot.respond_incrementally(user_input):
+            print bot_output
+            sys.stdout.flush()
 
 
 if __name__ == "__main__":
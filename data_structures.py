@@ -22,3 +22,28 @@ class Message(object):
         # Frame implements frame-and-slot semantics.
         self.frame = {}
         # Additional metadata attributes could be added.
+
+
+def state_property(name):
+    """
+    Return a property that reads and writes an attribute of an object's
+    state, so that the state can be kept apart from the object.
+
+    >>> class State(object):
+    ...     pass
+    >>> class Counter(object):
+    ...     count = state_property('count')
+    ...     def __init__(self, state):
+    ...         self.state = state
+    >>> state = State()
+    >>> counter = Counter(state)
+    >>> counter.count = 1
+    >>> state.count
+    1
+    """
+    def getter(self):
+        return getattr(self.state, name)
+
+    def setter(self, value):
+        setattr(self.state, name, value)
+    return property(getter, setter)
@@ -99,21 +99,40 @@ For the full details on the search capabilities, see the documentation for the
 get_recipes() method.
 """
 from collections import defaultdict
+import logging
 import re
 import types
 
 from sqlalchemy import create_engine, Table, Column, Integer, \
     String, ForeignKey, UniqueConstraint
-from sqlalchemy.sql.expression import between, desc
+from sqlalchemy.sql.expression import between, desc, bindparam
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import deferred, relationship, sessionmaker, join, \
-    backref, scoped_session
+    backref, scoped_session, object_session, aliased, undefer_group, \
+    joinedload
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.interfaces import PoolListener
+from sqlalchemy.sql import func
+
+import tracing
 
 from nlu import extract_ingredient_parts, normalize_ingredient_name
 from nltk import word_tokenize
 from RecipeCategorizer import get_cuisine
+from url_filter import build_url_filter, save_url_filter, url_filter_filename
+
+# The ontology's files were made from Wikipedia's lists, so some of the nodes
+# below 'ingredient' are the lists themselves, like 'List_of_Indian_spices'
+# or 'Kampo_herb_list', rather than ingredients.  Nodes whose (normalized)
+# names have one of these prefixes or suffixes aren't ingredient names; see
+# Database.get_ingredient_names().
+LIST_NODE_PREFIXES = ('list of',)
+LIST_NODE_SUFFIXES = (' list',)
+
+# Ontology nodes whose subtypes are grouped by the country or region that
+# they come from, like ('ingredient', 'cheese', 'Scotland', 'Caboc').  The
+# groups aren't ingredient names either.
+GROUPED_BY_REGION = frozenset(['cheese'])
 
 
 Base = declarative_base()
@@ -151,6 +170,7 @@ class Database(object):
         self._session = self._sessionmaker
         self.create_database_schema()
         self._ontology_match_order = None  # This is cached for performance.
+        self._url_filter = None  # Set by load_url_filter() during imports.
 
     def create_database_schema(self):
         """
@@ -190,11 +210,11 @@ class Database(object):
         """
         # First, make sure that we're not inserting a duplicate record.
         # Duplicates are considered to be recipes with the same url.
-        duplicate = self._session.query(Recipe).\
-                        filter_by(url=recipe_parts['url'])
-        if duplicate.first():
+        if self.has_recipe_url(recipe_parts['url']):
             raise DuplicateRecipeException(
                 "Recipe with url %s already exists." % recipe_parts['url'])
+        if self._url_filter is not None:
+            self._url_filter.add(recipe_parts['url'])
         recipe = Recipe()
         recipe_parts = defaultdict(str, recipe_parts)
         recipe.title = recipe_parts['title']
@@ -245,6 +265,57 @@ class Database(object):
 
         self._session.add(recipe)
 
+    def has_recipe_url(self, url):
+        """
+        Return True if a recipe with the given url is in the database.
+
+        If a url filter has been loaded, urls that it rules out are rejected
+        without a query; possible matches are confirmed using the unique index
+        on the recipes' urls.
+
+        >>> db = Database("sqlite:///:memory:")
+        >>> db.load_url_filter()
+        >>> db.add_from_recipe_parts({'title': 'cake', 'url': 'cake'})
+        >>> db.has_recipe_url('cake'), db.has_recipe_url('pie')
+        (True, False)
+        """
+        if self._url_filter is not None and url not in self._url_filter:
+            return False
+        return self._session.query(Recipe.id).filter_by(url=url).first() \
+            is not None
+
+    def _url_filter_fingerprint(self):
+        """
+        A summary of the recipes table, used to tell whether a saved url
+        filter is up to date.
+        """
+        return tuple(self._session.query(func.count(Recipe.id),
+                                         func.max(Recipe.id)).one())
+
+    def load_url_filter(self):
+        """
+        Build a filter of the recipe urls in the database, so that
+        has_recipe_url() and recipe imports can skip the duplicate-checking
+        query for urls that aren't present.  Large databases use a Bloom
+        filter, which is loaded from a file next to the database if it's
+        up to date.  Call save_url_filter() after importing to update it.
+        """
+        fingerprint = self._url_filter_fingerprint()
+        urls = (url for (url, ) in
+                self._session.query(Recipe.url).yield_per(10000))
+        self._url_filter = build_url_filter(urls, fingerprint[0],
+            fingerprint, url_filter_filename(self._database_url))
+
+    def save_url_filter(self):
+        """
+        Save the url filter next to the database, if it's a Bloom filter.
+        This should be called after the imported recipes are committed.
+        """
+        save_url_filter(self._url_filter,
+                        url_filter_filename(self._database_url),
+                        self._url_filter_fingerprint())
+
+    @tracing.traced('db.get_recipes')
     def get_recipes(self, include_ingredients=(), exclude_ingredients=(),
                     include_cuisines=(), exclude_cuisines=(),
                     prep_time=None, cook_time=None, total_time=None,
@@ -322,6 +393,35 @@ class Database(object):
                 num_ingredients))
         return query.all()
 
+    def close_session(self):
+        """
+        Close the calling thread's database session.  Threads that use the
+        database briefly should call this when they're done with it.
+        """
+        self._sessionmaker.remove()
+
+    def get_recipe(self, recipe_id):
+        """
+        Get the recipe with the given id, or None if there isn't one.
+
+        The recipe is loaded with its text and cuisines, and detached from
+        this thread's session, so that it can be shown by another thread
+        (like the NLG's, in the async server) without using the database.
+        Its other relationships, like ingredients, can't be loaded.
+
+        >>> db = Database("sqlite:///:memory:")
+        >>> db.get_recipe(1) is None
+        True
+        """
+        query = self._session.query(Recipe).options(
+            undefer_group('recipe_text'), joinedload('cuisines'))
+        recipe = query.get(recipe_id)
+        if recipe is not None:
+            for cuisine in recipe.cuisines:
+                self._session.expunge(cuisine)
+            self._session.expunge(recipe)
+        return recipe
+
     def get_ingredients(self, name=None):
         """
         Get ingredients matching the given criteria.
@@ -332,6 +432,94 @@ class Database(object):
             query = query.filter_by(name=name)
         return query
 
+    def get_ingredient_generation(self):
+        """
+        A summary of the ingredients and ontology nodes, which changes when
+        either is added to.  It's used to tell whether data derived from
+        their names, like the NLU's ingredient phrases, is up to date.
+        """
+        ingredients = self._session.query(func.count(Ingredient.id),
+                                          func.max(Ingredient.id)).one()
+        nodes = self._session.query(func.count(OntologyNode.id),
+                                    func.max(OntologyNode.id)).one()
+        return tuple(ingredients) + tuple(nodes)
+
+    def get_generation(self):
+        """
+        A summary of the recipes, ingredients and ontology nodes, which
+        changes when any of them is added to, or changed in place, like when
+        ingredients are relinked to the ontology.  It's used to tell whether
+        cached search results are up to date.
+
+        >>> db = Database("sqlite:///:memory:")
+        >>> db.add_from_recipe_parts({'title': 'toast', 'url': 'toast',
+        ...                           'ingredients': ['2 slices bread']})
+        >>> db.bulk_add_ontology_nodes([('ingredient', 'bread')])
+        2
+        >>> generation = db.get_generation()
+        >>> coverage = db.relink_ingredients(['bread'])
+        >>> db.get_generation() == generation
+        False
+        """
+        recipes = self._session.query(func.count(Recipe.id),
+                                      func.max(Recipe.id)).one()
+        changes = self._session.query(DataGeneration.changes).first()
+        return tuple(recipes) + self.get_ingredient_generation() + \
+            tuple(changes or (0, ))
+
+    def _count_change(self):
+        """
+        Count a change to the data that get_generation() wouldn't otherwise
+        notice, like ingredients being linked to other ontology nodes.  The
+        caller commits it along with the change.
+        """
+        table = DataGeneration.__table__
+        connection = self._session.connection()
+        result = connection.execute(
+            table.update().values(changes=table.c.changes + 1))
+        if not result.rowcount:
+            connection.execute(table.insert(), {'id': 1, 'changes': 1})
+
+    def get_ingredient_names(self):
+        """
+        Return the names of all ingredients, and of the nodes below the root
+        of the ingredient ontology.  Nodes that only group other nodes, like
+        the countries that cheeses are grouped by (see GROUPED_BY_REGION),
+        and lists of ingredients (see LIST_NODE_PREFIXES), aren't
+        ingredients, so their names are left out.
+
+        >>> db = Database("sqlite:///:memory:")
+        >>> db.bulk_add_ontology_nodes([
+        ...     ('ingredient', 'cheese', 'england', 'stilton'),
+        ...     ('ingredient', 'spice', 'list of indian spice', 'ajwain'),
+        ...     ('cuisine', 'italian')])
+        9
+        >>> sorted(db.get_ingredient_names())
+        ['ajwain', 'cheese', 'spice', 'stilton']
+        """
+        names = set(name for (name, ) in self._session.query(Ingredient.name))
+        root = aliased(OntologyNode)
+        nodes = (self._session.query(OntologyNode.id, OntologyNode.name,
+                                     OntologyNode._supertype_id)
+                 .join((OntologyClosure,
+                        OntologyClosure._descendant_id == OntologyNode.id))
+                 .join((root, root.id == OntologyClosure._ancestor_id))
+                 .filter(root.name == 'ingredient')
+                 .filter(root._supertype_id == None)
+                 .filter(OntologyClosure.distance > 0)
+                 .all())
+        node_names = dict((node_id, name) for (node_id, name, _) in nodes)
+        parent_ids = set(supertype_id for (_, _, supertype_id) in nodes)
+        for (node_id, name, supertype_id) in nodes:
+            if name.startswith(LIST_NODE_PREFIXES) or \
+                    name.endswith(LIST_NODE_SUFFIXES):
+                continue
+            if node_id in parent_ids and \
+                    node_names.get(supertype_id) in GROUPED_BY_REGION:
+                continue
+            names.add(name)
+        return names
+
     def get_cuisines(self, name=None):
         """
         Get cuisines matching the given criteria.
@@ -402,36 +590,194 @@ class Database(object):
         Raises a DuplicateOntologyNodeException when adding a duplicate node.
         """
         root_name = ontology_tuple[0]
-        depth = 0
         try:
             root = self._session.query(OntologyNode).filter_by(name=root_name,
                 supertype=None).one()
+            new_nodes = []
         except NoResultFound:
             root = OntologyNode(root_name)
             root.depth = 0
-            #self._session.add(OntologyNode)
-        added_nodes = False
-        last_node = root
-        depth = 1
-        for node_name in ontology_tuple[1:]:
+            new_nodes = [root]
+        path = [root]
+        for (depth, node_name) in enumerate(ontology_tuple[1:]):
             try:
                 node = self._session.query(OntologyNode).filter_by(
-                    name=node_name, supertype=last_node).one()
+                    name=node_name, supertype=path[-1]).one()
             except NoResultFound:
                 node = OntologyNode(node_name)
-                node.supertype = last_node
-                node.depth = depth
-                depth += 1
-                added_nodes = True
-            last_node = node
-        if added_nodes:
-            self._session.add(last_node)
+                node.supertype = path[-1]
+                node.depth = depth + 1
+                new_nodes.append(node)
+            path.append(node)
+        if new_nodes and len(path) > 1:
+            self._session.add(path[-1])
+            # Flush to assign ids to the new nodes before adding their
+            # closure rows.
+            self._session.flush()
+            for (i, node) in enumerate(path):
+                if node not in new_nodes:
+                    continue
+                for (j, ancestor) in enumerate(path[:i + 1]):
+                    self._session.add(OntologyClosure(ancestor.id, node.id,
+                                                      i - j))
+            self._count_change()
             self._session.commit()
             self._ontology_match_order = None  # Expire cached due to new node.
         else:
             raise DuplicateOntologyNodeException(
                 'OntologyNode %s already exists.' % str(ontology_tuple))
 
+    def bulk_add_ontology_nodes(self, ontology_tuples):
+        """
+        Add many ontology nodes at once, from tuples like those accepted by
+        add_ontology_node().  The whole forest is built in memory and then
+        inserted in a single transaction, along with each node's depth and
+        closure rows.  Nodes that already exist are kept (their depths are
+        corrected if necessary), so loading the same tuples again only costs
+        a few queries.
+
+        The new nodes' ids follow the largest existing id, so SQLite's write
+        lock is held from before the existing nodes are read until the new
+        ones are committed, and other writers wait for it.  (Other databases
+        don't take a lock for this, so only one process may add nodes to
+        them at a time.)
+
+        Returns the number of nodes that were added.
+
+        >>> db = Database("sqlite:///:memory:")
+        >>> db.bulk_add_ontology_nodes([('ingredient', 'fruit', 'apple'),
+        ...                             ('ingredient', 'fruit', 'orange')])
+        4
+        >>> db.bulk_add_ontology_nodes([('ingredient', 'fruit', 'apple')])
+        0
+        >>> [n.name for n in db.get_ontology_node('fruit').descendants]
+        ['apple', 'orange']
+        """
+        # An update that changes nothing takes SQLite's write lock for the
+        # rest of the transaction.
+        table = OntologyNode.__table__
+        connection = self._session.connection()
+        connection.execute(table.update().where(table.c.id == None)
+                           .values(depth=table.c.depth))
+        # Map (name, supertype id) to the existing nodes' ids and depths.
+        node_ids = {}
+        depths = {}
+        max_id = 0
+        for (node_id, name, supertype_id, depth) in self._session.query(
+                OntologyNode.id, OntologyNode.name, OntologyNode._supertype_id,
+                OntologyNode.depth):
+            node_ids[(name, supertype_id)] = node_id
+            depths[node_id] = depth
+            max_id = max(max_id, node_id)
+        closure = set((a, d) for (a, d) in self._session.query(
+            OntologyClosure._ancestor_id, OntologyClosure._descendant_id))
+        new_nodes = []
+        new_depths = {}
+        new_closure = []
+        for ontology_tuple in ontology_tuples:
+            path = []
+            for (depth, name) in enumerate(ontology_tuple):
+                if path:
+                    key = (name, path[-1])
+                else:
+                    key = (name, None)
+                if key not in node_ids:
+                    max_id += 1
+                    node_ids[key] = max_id
+                    depths[max_id] = depth
+                    new_nodes.append({'id': max_id, 'name': name,
+                        '_supertype_id': key[1], 'depth': depth})
+                node_id = node_ids[key]
+                if depths[node_id] != depth:
+                    depths[node_id] = new_depths[node_id] = depth
+                path.append(node_id)
+                for (distance, ancestor_id) in enumerate(reversed(path)):
+                    if (ancestor_id, node_id) not in closure:
+                        closure.add((ancestor_id, node_id))
+                        new_closure.append({'_ancestor_id': ancestor_id,
+                            '_descendant_id': node_id, 'distance': distance})
+        changed = new_nodes or new_depths or new_closure
+        if new_nodes:
+            connection.execute(table.insert(), new_nodes)
+        if new_depths:
+            connection.execute(
+                table.update().where(table.c.id == bindparam('node_id')),
+                [{'node_id': i, 'depth': d} for (i, d) in new_depths.items()])
+        if new_closure:
+            connection.execute(OntologyClosure.__table__.insert(),
+                               new_closure)
+        if changed:
+            self._count_change()
+        # Committing releases the write lock, even if nothing was added.
+        self._session.commit()
+        if changed:
+            self._session.expire_all()
+            self._ontology_match_order = None  # Expire cached due to new nodes.
+        return len(new_nodes)
+
+    def relink_ingredients(self, changed_nodes=None, batch_size=1000):
+        """
+        Re-run the ontology matcher for the ingredients whose links could
+        have been affected by changes to the ontology, and update their links
+        in batches.  The candidates are the ingredients that aren't linked to
+        any node, plus, if changed_nodes (a list of OntologyNodes or names) is
+        given, the ingredients whose names share a word with a changed node.
+
+        Returns a dictionary with the number of ingredients and the number
+        that were linked to the ontology before and after relinking.
+
+        >>> db = Database("sqlite:///:memory:")
+        >>> db.add_from_recipe_parts({'title': 'toast', 'url': 'toast',
+        ...                           'ingredients': ['2 slices bread']})
+        >>> db.get_ingredients('bread').one().ontology_node == None
+        True
+        >>> db.add_ontology_node(('ingredient', 'bread'))
+        >>> sorted(db.relink_ingredients(['bread']).items())
+        [('ingredients', 1), ('matched_after', 1), ('matched_before', 0)]
+        >>> db.get_ingredients('bread').one().ontology_node.name
+        'bread'
+        """
+        linked = self._session.query(Ingredient).filter(
+            Ingredient._ontology_node_id != None)
+        coverage = {'ingredients': self._session.query(Ingredient).count(),
+                    'matched_before': linked.count()}
+        changed_words = set()
+        for node in changed_nodes or ():
+            if isinstance(node, OntologyNode):
+                node = node.name
+            changed_words.update(node.split())
+        candidates = []
+        for (ingredient_id, name, node_id) in self._session.query(
+                Ingredient.id, Ingredient.name, Ingredient._ontology_node_id):
+            if node_id is None or changed_words.intersection(name.split()):
+                candidates.append((ingredient_id, name, node_id))
+        self._ontology_match_order = None  # Make sure new nodes are matched.
+        table = Ingredient.__table__
+        update = table.update().where(table.c.id == bindparam('ingredient_id'))
+        for start in range(0, len(candidates), batch_size):
+            updates = []
+            for (ingredient_id, name, old_node_id) in \
+                    candidates[start:start + batch_size]:
+                node = self._get_closest_ontology_node(name)
+                if node:
+                    node_id = node.id
+                else:
+                    node_id = None
+                if node_id != old_node_id:
+                    updates.append({'ingredient_id': ingredient_id,
+                                    '_ontology_node_id': node_id})
+            if updates:
+                self._session.connection().execute(update, updates)
+                self._count_change()
+                self._session.commit()
+        self._session.expire_all()
+        coverage['matched_after'] = linked.count()
+        logging.info("Relinked %i candidate ingredients; %i of %i ingredients "
+            "were matched with OntologyNodes before, %i after." %
+            (len(candidates), coverage['matched_before'],
+             coverage['ingredients'], coverage['matched_after']))
+        return coverage
+
     def get_ontology_node(self, name):
         """
         Get the ontology node for the given name.  Rather that performing
@@ -623,6 +969,20 @@ class OntologyNode(Base):
             lines.extend("    " + l for l in subtype.tree_diagram.split('\n'))
         return '\n'.join(lines)
 
+    @property
+    def descendants(self):
+        """
+        A list of every OntologyNode in the subtree rooted at this
+        OntologyNode, excluding the node itself, ordered by name.
+        """
+        return (object_session(self).query(OntologyNode)
+                .join((OntologyClosure,
+                       OntologyClosure._descendant_id == OntologyNode.id))
+                .filter(OntologyClosure._ancestor_id == self.id)
+                .filter(OntologyClosure.distance > 0)
+                .order_by(OntologyNode.name)
+                .all())
+
     @property
     def siblings(self):
         """
@@ -636,6 +996,41 @@ class OntologyNode(Base):
             return []
 
 
+class OntologyClosure(Base):
+    """
+    The transitive closure of the ontology's supertype relation: there is one
+    row for every (ancestor, descendant) pair, including a row pairing each
+    node with itself, so subtrees can be queried without recursion.
+    """
+    __tablename__ = 'ontology_closure'
+    _ancestor_id = Column(Integer, ForeignKey('ontology_nodes.id'),
+                          primary_key=True)
+    _descendant_id = Column(Integer, ForeignKey('ontology_nodes.id'),
+                            primary_key=True)
+    # The number of edges between the ancestor and the descendant.
+    distance = Column(Integer, nullable=False)
+
+    def __init__(self, ancestor_id, descendant_id, distance):
+        self._ancestor_id = ancestor_id
+        self._descendant_id = descendant_id
+        self.distance = distance
+
+    def __repr__(self):
+        return "<OntologyClosure(%s, %s)>" % \
+            (self._ancestor_id, self._descendant_id)
+
+
+class DataGeneration(Base):
+    """
+    A single row counting the changes to the data that can't be seen from
+    the numbers of rows, like ingredients being relinked to the ontology; see
+    Database.get_generation().
+    """
+    __tablename__ = 'data_generation'
+    id = Column(Integer, primary_key=True)
+    changes = Column(Integer, nullable=False)
+
+
 class Ingredient(Base):
     """
     Represents a single ingredient as the food item itself, not a quantity of a
@@ -3,28 +3,108 @@ Dialogue manager.
 """
 from copy import deepcopy
 import logging
+import sys
+import threading
+import tracing
+from data_structures import state_property
 from nlg import ContentPlanMessage
 from nlu.messages import SearchMessage, YesNoMessage, SystemMessage
 
 
-class DialogueManager(object):
+class _BackgroundCall(object):
     """
-    Object that performs dialogue management.
+    Calls a function in another thread.
     """
 
-    def __init__(self, db, logger):
+    def __init__(self, function):
+        self._function = function
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self._result = self._function()
+        except Exception:
+            self._error = sys.exc_info()
+
+    def result(self):
         """
-        Create a new DialogueManager.
+        Wait for the function to return, and return its result or raise its
+        exception.
         """
-        self.db = db
-        self.log = logger
+        self._thread.join()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+
+class DialogueState(object):
+    """
+    The state of a conversation kept by the DialogueManager.  Search results
+    are kept as recipe ids, so the state stays small.
+    """
+    __slots__ = ('user_name', 'current_state', 'query', 'prev_query',
+                 'search_result_ids')
+
+    def __init__(self):
         self.user_name = None
-        self.current_state = 'start'
         # Possible states include 'start' and 'recipe_search'.
+        self.current_state = 'start'
         self.query = {}  # The current recipe search query.
         self.prev_query = {}
-        self.search_results = []
-        self._go_to_start_state()
+        self.search_result_ids = None
+
+    def to_dict(self):
+        """
+        Return the state as a dictionary of strings, numbers, lists and
+        dictionaries, which can be serialized as JSON.
+        """
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    @classmethod
+    def from_dict(cls, state_dict):
+        """
+        Create a DialogueState from a dictionary returned by to_dict().
+
+        >>> state = DialogueState()
+        >>> state.query = {'include_ingredients': ['chicken']}
+        >>> state.search_result_ids = [3, 5]
+        >>> copy = DialogueState.from_dict(state.to_dict())
+        >>> copy.query, copy.search_result_ids, copy.current_state
+        ({'include_ingredients': ['chicken']}, [3, 5], 'start')
+        """
+        state = cls()
+        for name in cls.__slots__:
+            if name in state_dict:
+                setattr(state, name, state_dict[name])
+        return state
+
+
+class DialogueManager(object):
+    """
+    Object that performs dialogue management.
+    """
+
+    user_name = state_property('user_name')
+    current_state = state_property('current_state')
+    query = state_property('query')
+    prev_query = state_property('prev_query')
+    search_result_ids = state_property('search_result_ids')
+
+    def __init__(self, db, logger, state=None):
+        """
+        Create a new DialogueManager.  The conversation's state is kept in
+        state, a DialogueState, so a DialogueManager can be created for each
+        message of a conversation.
+        """
+        self.db = db
+        self.log = logger
+        if state is None:
+            state = DialogueState()
+        self.state = state
 
     def _go_to_start_state(self):
         """
@@ -32,8 +112,9 @@ class DialogueManager(object):
         """
         self.query = {}
         self.current_state = 'start'
-        self.search_results = None
+        self.search_result_ids = None
 
+    @tracing.traced('dm.plan_response')
     def plan_response(self, parsed_input):
         """
         Given a list of parsed representations of user input, return a content
@@ -70,10 +151,11 @@ class DialogueManager(object):
                     message="TODO: EXIT HERE")
 
         # If the user answers 'yes', show them the recipes:
-        elif isinstance(parsed_input[0], YesNoMessage) and self.search_results:
+        elif isinstance(parsed_input[0], YesNoMessage) and \
+                self.search_result_ids:
             if parsed_input[0].getDecision():
-                return ContentPlanMessage("show_recipe",
-                                          recipe=self.search_results[0])
+                recipe = self.db.get_recipe(self.search_result_ids[0])
+                return ContentPlanMessage("show_recipe", recipe=recipe)
             else:
                 return ContentPlanMessage("echo",
                     message="Okay.  You can specify additional criteria or" \
@@ -84,10 +166,34 @@ class DialogueManager(object):
             return ContentPlanMessage("echo",
                 message="Ask me about recipes and ingredients!")
 
+    def plan_response_incrementally(self, parsed_input):
+        """
+        Generate the content plans that plan_response() returns one at a
+        time, so that each can be realised before the next is planned.
+        """
+        if parsed_input and isinstance(parsed_input[0], SearchMessage):
+            content_plans = self._plan_search_message(parsed_input[0])
+        else:
+            content_plans = self.plan_response(parsed_input)
+            if content_plans is None:
+                content_plans = []
+            elif isinstance(content_plans, ContentPlanMessage):
+                content_plans = [content_plans]
+        for content_plan in content_plans:
+            yield content_plan
+
     def _handle_search_message(self, search_message):
         """
         Perform a query based on the most recent SearchMessage.
         """
+        return list(self._plan_search_message(search_message))
+
+    def _plan_search_message(self, search_message):
+        """
+        Generate the content plans for the most recent SearchMessage.  The
+        query runs in another thread while the summary of the query is
+        realised.
+        """
         # If there's not a recipe search in progress, begin a new search:
         if not self.query:
             self.log.info("Starting new recipe search.")
@@ -108,27 +214,36 @@ class DialogueManager(object):
             self.query['include_cuisines'].append(cuisine_dict['name'])
             self.new_criteria['include_cuisines'].append(cuisine_dict['name'])
         self.log.debug('database_query = \n%s' % str(self.query))
-        content_plans = []
         # Check whether the query specifies no criteria.  If the query is
         # empty, display an error message.
         if not any(self.query.values()):
             content_plan = ContentPlanMessage("echo")
             content_plan['message'] = "I didn't understand your query."
-            content_plans.append(content_plan)
             self._go_to_start_state()
-            return content_plans
+            yield content_plan
+            return
+        # Search the database in the background, while the summary is
+        # realised.  Only recipe ids are passed between the threads.
+        query = deepcopy(self.query)
+
+        def search_recipes():
+            try:
+                return [recipe.id for recipe in self.db.get_recipes(**query)]
+            finally:
+                self.db.close_session()
+        search = _BackgroundCall(search_recipes)
         # Start building up the content plan to send to the NLG.
         # Summarize the query as a form of grounding.
-        content_plans.append(ContentPlanMessage('summarize_query',
-                             query=self.query))
-        # Search the database and remember the search results.
-        self.search_results = self.db.get_recipes(**self.query)
+        yield ContentPlanMessage('summarize_query', query=self.query)
+        # Remember the search results.
+        self.search_result_ids = search.result()
         # Handle query success and failure:
-        if not self.search_results:
-            content_plans.extend(self._handle_search_failure())
+        if not self.search_result_ids:
+            content_plans = self._handle_search_failure()
         else:
-            content_plans.extend(self._handle_search_success())
-        return content_plans
+            content_plans = self._handle_search_success()
+        for content_plan in content_plans:
+            yield content_plan
 
     def _handle_search_failure(self):
         """
@@ -198,5 +313,5 @@ class DialogueManager(object):
             "  If you want to start a new search, please say so."  \
             "  You can refine your query by specifying additional" \
             " criteria." % \
-            len(self.search_results)
+            len(self.search_result_ids)
         return [content_plan]
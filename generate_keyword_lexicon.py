@@ -0,0 +1,28 @@
+"""
+Generates the keyword lexicon used by the messages' keyword checks, so that
+short replies are understood without searching WordNet.  Rerun this after
+changing the messages' keywords.
+"""
+from nlu.messages import YesNoMessage, SystemMessage, PreferenceMessage, \
+    SearchMessage
+from nlu.messages.keyword_lexicon import build_lexicon, save_lexicon, \
+    LEXICON_FILENAME
+
+
+def main():
+    keyword_lists = [
+        YesNoMessage.yes_keywords,
+        YesNoMessage.no_keywords,
+        SystemMessage.exit_keywords,
+        SystemMessage.restart_keywords,
+        SystemMessage.keywords,
+        PreferenceMessage.keywords,
+        SearchMessage.keywords,
+    ]
+    lexicon = build_lexicon(keyword_lists)
+    save_lexicon(lexicon)
+    print "Saved the keyword lexicon in %s" % LEXICON_FILENAME
+
+
+if __name__ == "__main__":
+    main()
@@ -47,15 +47,45 @@ For example, this would be instantiated as
 'search_fail'
 
 """
+import copy
 import random
 import logging
+import threading
+import tracing
 from simplenlg import NPPhraseSpec, PPPhraseSpec, SPhraseSpec, Realiser, \
     gateway, InterrogativeType, TextSpec, Tense, Form
 
 
 HORIZONTAL_LINE = '-' * 70
 
-REALISER = Realiser()
+# The Realiser is created on first use, so importing this module doesn't
+# launch the JVM.  It's recreated if the JVM is relaunched.
+_realiser = None
+_realiser_generation = None
+_realiser_lock = threading.Lock()
+
+
+def get_realiser():
+    """
+    Return the shared SimpleNLG Realiser, launching the JVM the first time
+    this is called or after the JVM is relaunched.
+    """
+    global _realiser, _realiser_generation
+    gateway.get()  # Relaunches the JVM if it has died.
+    if _realiser_generation != gateway.generation:
+        with _realiser_lock:
+            if _realiser_generation != gateway.generation:
+                _realiser = Realiser()
+                _realiser_generation = gateway.generation
+    return _realiser
+
+
+def warm_up():
+    """
+    Launch the JVM and create the Realiser now, rather than when the first
+    response is generated.
+    """
+    get_realiser()
 
 
 class ContentPlanMessage(dict):
@@ -96,6 +126,12 @@ class NaturalLanguageGenerator(object):
                              'bring you',
                              'seek',
                              'find']
+        # The same verbs, for sentences that are realised without SimpleNLG.
+        self.search_gerunds = ['looking for',
+                               'searching for',
+                               'bringing you',
+                               'seeking',
+                               'finding']
 
         self.conf_responses = ['You got it',
                               'As you wish',
@@ -131,6 +167,9 @@ class NaturalLanguageGenerator(object):
                       'include_cuisines': ['Mexican', 'Chinese', 'Thai']}
 
         self.tone = 'normal'
+        # If False, every utterance is made from templates, without using
+        # SimpleNLG's realiser (and the JVM); see templates_only().
+        self.use_realiser = True
 
         self.cruel_words = {
             'names': ['maggot', 'little snot', 'jerk', 'weakling'],
@@ -173,12 +212,17 @@ class NaturalLanguageGenerator(object):
         Hello
         World
         """
-        if isinstance(content_plan_or_plans, ContentPlanMessage):
-            return self.handle_content_plan_message(content_plan_or_plans)
-        response = []
-        for plan in content_plan_or_plans:
-            response.append(self.handle_content_plan_message(plan))
-        return '\n'.join(response)
+        with tracing.span('nlg.generate_response'):
+            if isinstance(content_plan_or_plans, ContentPlanMessage):
+                return self._realise(content_plan_or_plans)
+            response = []
+            for plan in content_plan_or_plans:
+                response.append(self._realise(plan))
+            return '\n'.join(response)
+
+    def _realise(self, content_plan):
+        with tracing.span('nlg.generate_response.%s' % content_plan.msg_type):
+            return self.handle_content_plan_message(content_plan)
 
     def handle_content_plan_message(self, content_plan):
         """
@@ -320,7 +364,7 @@ class NaturalLanguageGenerator(object):
                 utterance.addModifier(modifier)
         utterance.addComplement(target)
 
-        output = self.clean_str(REALISER.realiseDocument(utterance).strip())
+        output = self.clean_str(get_realiser().realiseDocument(utterance).strip())
         return output
 
     def acknowledge(self):
@@ -376,6 +420,10 @@ class NaturalLanguageGenerator(object):
         Returns an utterance that tells the user the last input was not
         understood.
         """
+        if not self.use_realiser:
+            return random.choice(["I didn't understand what you just said.",
+                                  "What did you say?",
+                                  "Please rephrase what you just said."])
 
         output = SPhraseSpec()
         output.setSubject('I')
@@ -398,7 +446,7 @@ class NaturalLanguageGenerator(object):
             output.setComplement('what you')
             output.setPostmodifier('just said')
 
-        return self.clean_str(REALISER.realiseDocument(output).strip())
+        return self.clean_str(get_realiser().realiseDocument(output).strip())
 
     def clarify(self, keywords):
         """
@@ -409,8 +457,15 @@ class NaturalLanguageGenerator(object):
         if 'clarify_cat' not in keywords or 'clarify_list' not in keywords:
             raise NLGException('Not enough information in keywords')
 
+        attention = 'Hey ' + random.choice([random.choice([self.tone_str('adjectives') + ' ', '']) + self.tone_str('names'), ''])
+        if not self.use_realiser:
+            return '%s, I know you wanted a type of %s, but please specify ' \
+                'if you meant %s.' % (attention.strip(),
+                    keywords['clarify_cat'],
+                    self._list_str(keywords['clarify_list'], 'or'))
+
         # the first clause gets the user's attention
-        stat1 = SPhraseSpec('Hey ' + random.choice([random.choice([self.tone_str('adjectives') + ' ', '']) + self.tone_str('names'), '']), '')
+        stat1 = SPhraseSpec(attention, '')
         # the second clause acknowledges that a specification was given
         stat2 = SPhraseSpec('I', 'know', 'you wanted a type of %s' % (keywords['clarify_cat']))
         # the third clause asks the user to provide a more narrow scope
@@ -435,7 +490,7 @@ class NaturalLanguageGenerator(object):
         clarification.addSpec(stat3)
         clarification.setListConjunct(',')
 
-        return self.clean_str(REALISER.realiseDocument(clarification).strip())
+        return self.clean_str(get_realiser().realiseDocument(clarification).strip())
 
     def summarize_query(self, query):
         """
@@ -447,6 +502,8 @@ class NaturalLanguageGenerator(object):
         # will be searched
         if query == {}:
             return 'I will just look for every recipe we have.'
+        if not self.use_realiser:
+            return self._summarize_query_template(query)
 
         summary = SPhraseSpec()
         summary.setSubject('I')
@@ -489,18 +546,7 @@ class NaturalLanguageGenerator(object):
             steps.setProgressive(gateway.jvm.java.lang.Boolean.TRUE)
             steps.addPremodifier('also')
 
-            steps_list = []
-            if 'prep_time' in query and query['prep_time'] != None:
-                steps_list.append('%i minutes to prepare' % query['prep_time'])
-            if 'cook_time' in query and query['cook_time'] != None:
-                steps_list.append('%i minutes to cook' % (query['cook_time']))
-            if 'total_time' in query and query['total_time'] != None:
-                steps_list.append('%i total minutes to make' %
-                                  (query['total_time']))
-            if 'num_steps' in query and query['num_steps'] != None:
-                steps_list.append('%i steps to complete' % (query['num_steps']))
-            if 'num_ingredients' in query and query['num_ingredients'] != None:
-                steps_list.append('%i ingredients' % (query['num_ingredients']))
+            steps_list = self._query_requirements(query)
             for step in steps_list:
                 if step == steps_list[0]:
                     steps.addComplement('recipes that require ' + step)
@@ -513,7 +559,70 @@ class NaturalLanguageGenerator(object):
         final.addSpec(steps)
         final.setListConjunct('.')
 
-        return self.clean_str(REALISER.realiseDocument(final).strip())
+        return self.clean_str(get_realiser().realiseDocument(final).strip())
+
+    def _query_requirements(self, query):
+        """
+        Returns phrases describing the times and numbers of steps and
+        ingredients required by a query.
+        """
+        steps_list = []
+        if 'prep_time' in query and query['prep_time'] != None:
+            steps_list.append('%i minutes to prepare' % query['prep_time'])
+        if 'cook_time' in query and query['cook_time'] != None:
+            steps_list.append('%i minutes to cook' % (query['cook_time']))
+        if 'total_time' in query and query['total_time'] != None:
+            steps_list.append('%i total minutes to make' %
+                              (query['total_time']))
+        if 'num_steps' in query and query['num_steps'] != None:
+            steps_list.append('%i steps to complete' % (query['num_steps']))
+        if 'num_ingredients' in query and query['num_ingredients'] != None:
+            steps_list.append('%i ingredients' % (query['num_ingredients']))
+        return steps_list
+
+    def _summarize_query_template(self, query):
+        """
+        Like summarize_query(), but made from templates.
+
+        >>> nlg = NaturalLanguageGenerator(logging.getLogger())
+        >>> nlg.search_gerunds = ['looking for']
+        >>> print nlg._summarize_query_template({
+        ...     'include_cuisines': ['Thai'],
+        ...     'include_ingredients': ['chicken', 'basil', 'rice'],
+        ...     'exclude_ingredients': ['peanuts'], 'total_time': 30})
+        I am looking for Thai dishes that contain chicken, basil and rice but do not contain peanuts. I am also looking for recipes that require 30 total minutes to make.
+        """
+        summary = 'I am %s ' % random.choice(self.search_gerunds)
+        if query.get('include_cuisines'):
+            summary += self._list_str(query['include_cuisines']) + ' dishes'
+        else:
+            summary += 'recipes'
+        if query.get('include_ingredients'):
+            summary += ' that contain ' + \
+                self._list_str(query['include_ingredients'])
+        if query.get('exclude_ingredients'):
+            summary += ' but do not contain ' + \
+                self._list_str(query['exclude_ingredients'])
+        summary += '.'
+        steps_list = self._query_requirements(query)
+        if steps_list:
+            summary += ' I am also %s recipes that require %s.' % \
+                (random.choice(self.search_gerunds),
+                 self._list_str(steps_list))
+        return summary
+
+    def _list_str(self, items, conjunction='and'):
+        """
+        Joins a list of words into a phrase like "a, b and c".
+
+        >>> nlg = NaturalLanguageGenerator(logging.getLogger())
+        >>> nlg._list_str(['beef', 'pork', 'chicken'], 'or')
+        'beef, pork or chicken'
+        """
+        items = list(items)
+        if len(items) <= 1:
+            return ''.join(items)
+        return '%s %s %s' % (', '.join(items[:-1]), conjunction, items[-1])
 
     def specify_recipe(self, keywords):
         """
@@ -568,6 +677,49 @@ class NaturalLanguageGenerator(object):
 
         self.tone = tone
 
+    def with_tone(self, tone):
+        """
+        Returns a generator that uses the given tone and shares everything
+        else with this one, except for its own copies of the word lists and
+        dictionaries, so that conversations with different tones can share a
+        generator without changing each other's words (greeting a user adds
+        their name to the names, for instance).
+
+        >>> nlg = NaturalLanguageGenerator(logging.getLogger())
+        >>> cruel_nlg = nlg.with_tone('cruel')
+        >>> cruel_nlg.tone, nlg.tone
+        ('cruel', 'normal')
+        >>> normal_nlg = nlg.with_tone('normal')
+        >>> greeting = normal_nlg.generate('greet', {'name': 'Al'})
+        >>> ('Al' in normal_nlg.normal_words['names'],
+        ...  'Al' in nlg.normal_words['names'])
+        (True, False)
+        """
+        generator = copy.copy(self)
+        generator.tone = tone
+        for (name, value) in vars(self).items():
+            if isinstance(value, list):
+                setattr(generator, name, list(value))
+            elif isinstance(value, dict):
+                setattr(generator, name, dict(
+                    (key, copy.copy(item)) for (key, item) in value.items()))
+        return generator
+
+    def templates_only(self):
+        """
+        Returns a generator that makes every utterance from templates,
+        without the realiser, and shares everything else with this one.
+        It's used when the JVM is too busy to realise a response.
+
+        >>> nlg = NaturalLanguageGenerator(logging.getLogger())
+        >>> nlg.templates_only().clarify({'clarify_cat': 'meat',
+        ...     'clarify_list': ['beef', 'pork']}).endswith('beef or pork.')
+        True
+        """
+        generator = copy.copy(self)
+        generator.use_realiser = False
+        return generator
+
     def tone_str(self, key):
         """
         Helper function used to extract a random word or phrase
@@ -10,28 +10,30 @@ or read the tutorial in the SimpleNLG 3.8 download at
 You can access static methods and classes through the gateway.jvm object, or
 you can add a line like
 
-    NPPhraseSpec = gateway.jvm.NPPhraseSpec
+    NPPhraseSpec = gateway.java_class("NPPhraseSpec")
 
-to this module to create a short alias.  Run this file for a demo.
+to this module to create a short alias.  SimpleNLG runs in the JVM shared with
+the Stanford parser, which is launched the first time the gateway or one of
+these aliases is used, not when this module is imported.  Run this file for a
+demo.
 """
-from py4j_server import launch_py4j_server
-from py4j.java_gateway import java_import
-
-gateway = launch_py4j_server()
+from py4j_server import get_shared_gateway
 
 # Import the SimpleNLG classes
-java_import(gateway.jvm, "simplenlg.features.*")
-java_import(gateway.jvm, "simplenlg.realiser.*")
+gateway = get_shared_gateway([
+    "simplenlg.features.*",
+    "simplenlg.realiser.*",
+])
 
 # Define aliases so that we don't have to use the gateway.jvm prefix.
-NPPhraseSpec = gateway.jvm.NPPhraseSpec
-PPPhraseSpec = gateway.jvm.PPPhraseSpec
-SPhraseSpec = gateway.jvm.SPhraseSpec
-InterrogativeType = gateway.jvm.InterrogativeType
-Realiser = gateway.jvm.Realiser
-TextSpec = gateway.jvm.TextSpec
-Tense = gateway.jvm.Tense
-Form = gateway.jvm.Form
+NPPhraseSpec = gateway.java_class("NPPhraseSpec")
+PPPhraseSpec = gateway.java_class("PPPhraseSpec")
+SPhraseSpec = gateway.java_class("SPhraseSpec")
+InterrogativeType = gateway.java_class("InterrogativeType")
+Realiser = gateway.java_class("Realiser")
+TextSpec = gateway.java_class("TextSpec")
+Tense = gateway.java_class("Tense")
+Form = gateway.java_class("Form")
 
 
 def main():
@@ -6,10 +6,12 @@ import re
 import logging
 from operator import itemgetter
 
+import tracing
 from data_structures import Message
 from ingredients import is_ingredient, normalize_ingredient_name, \
     extract_ingredient_parts
 from nlu.generators import *
+from nlu.ingredient_spotter import get_ingredient_spotter
 
 
 def time_to_minutes(time):
@@ -77,9 +79,11 @@ class NaturalLanguageUnderstander(object):
 
     CACHE_SIZE = 16
 
-    def __init__(self, confidenceThreshold, logger):
+    def __init__(self, confidenceThreshold, logger, db=None):
         """
-        Create a new NaturalLanguageUnderstander.
+        Create a new NaturalLanguageUnderstander.  If a database is given,
+        the names of its ingredients are recognized in the input, including
+        names with several words.
         """
         # set logger
         self.log = logger
@@ -96,21 +100,36 @@ class NaturalLanguageUnderstander(object):
         self.generators = Generators()
         self.generators.add(Generate_Tokenized_String, self.CACHE_SIZE)
         self.generators.add(Generate_Stanford_Parse_Tree, self.CACHE_SIZE)
+        self.generators.add(Generate_Sentence_Parses, self.CACHE_SIZE)
+        if db is not None:
+            self.generators.ingredient_spotter = get_ingredient_spotter(db)
 
-    def parse_input(self, user_input):
+    def parse_input(self, user_input, ExpectedMessage=None):
         """
-        Given a string of user input, return a ParsedInputMessage.
+        Given a string of user input, return a ParsedInputMessage.  If
+        ExpectedMessage is given, it's expected instead of the message set
+        by expect_message(), so conversations sharing the NLU can expect
+        different messages.
         """
+        with tracing.span('nlu.parse_input'):
+            return self._parse_input(user_input, ExpectedMessage)
+
+    def _parse_input(self, user_input, ExpectedMessage):
+        if ExpectedMessage is None:
+            ExpectedMessage = self.ExpectedMessage
         validMessages = []
         # If expecting a message, generate it not matter what
-        if self.ExpectedMessage != None:
-            message = self.ExpectedMessage(user_input, self.generators)
+        if ExpectedMessage != None:
+            message = self._parse(ExpectedMessage, user_input)
             validMessages.append(message)
         else:
             # Figure out what type of message the user_input is
-            messageTuples = [(MessageType,
-                        MessageType.confidence(user_input, self.generators))
-                        for MessageType in self.messageTypes]
+            messageTuples = []
+            for MessageType in self.messageTypes:
+                with tracing.span('nlu.confidence.%s' % MessageType.__name__):
+                    confidence = MessageType.confidence(user_input,
+                                                        self.generators)
+                messageTuples.append((MessageType, confidence))
             messages = sorted(messageTuples, key=itemgetter(1))
             
             self.log.debug('%12s [Confidence] = "%s"' % ('nlu.parse_input', messages))
@@ -118,11 +137,19 @@ class NaturalLanguageUnderstander(object):
             # Return sorted confident messages which are above threshold
             for MessageType, confidence in messages:
                 if confidence >= self.confidenceThreshold:
-                    message = MessageType(user_input, self.generators)
+                    message = self._parse(MessageType, user_input)
                     self.log.debug('%12s [Parse] = "%s"' % ('nlu.parse_input', message))
                     validMessages.append(message)
             
         return validMessages
+
+    def _parse(self, MessageType, user_input):
+        """
+        Construct a message of the given type from user input, which parses
+        it, tracing the parse.
+        """
+        with tracing.span('nlu.parse.%s' % MessageType.__name__):
+            return MessageType(user_input, self.generators)
         
     def acknowledge_message(self):
         """
@@ -154,6 +181,15 @@ class NaturalLanguageUnderstander(object):
         assert issubclass(MessageClass, Message)
 
         self.messageTypes.append(MessageClass)
+
+    def get_message_type(self, name):
+        """
+        Returns the registered message class with the given name, or None.
+        """
+        for MessageClass in self.messageTypes:
+            if MessageClass.__name__ == name:
+                return MessageClass
+        return None
         
 class NaturalLanguageUnderstanderError(Exception):
     """
@@ -7,16 +7,41 @@ Motivation: The NLU does not have to keep track of what each Message requires
 nor execute utility functions which are not needed. Speed.
 """
 
-from nlu.stanford_utils import get_parse_tree
+from nlu.stanford_utils import get_parse_tree, parse_sentences, \
+    recording_fallbacks, record_fallback, ParserUnavailable, \
+    TRANSIENT_FALLBACKS
 
 import nltk
 import collections
+import re
+import threading
+
+# Sentences end with a period, or with ! or ?, followed by whitespace.  An
+# ellipsis doesn't end a sentence.
+SENTENCE_BOUNDARY = re.compile(r'(?<=[^.][.!?])\s+')
+
+
+def split_sentences(raw_input_string):
+    """
+    Split user input into sentences.
+
+    >>> split_sentences("I have chicken. I don't want rice!  Something quick?")
+    ['I have chicken.', "I don't want rice!", 'Something quick?']
+    >>> split_sentences("Hmmm... No thanks.")
+    ['Hmmm... No thanks.']
+    """
+    return [sentence for sentence in
+            SENTENCE_BOUNDARY.split(raw_input_string.strip()) if sentence]
+
 
 class Generators:
     """
     Simplifies using the generator classes by initializing them and providing
     easier access.
     """
+    # Finds multiword ingredient names; see nlu.ingredient_spotter.
+    ingredient_spotter = None
+
     def add(self, GeneratorClass, cache_size):
         # get class name and lowercase since instance
         name = GeneratorClass.__name__.lower()
@@ -25,32 +50,49 @@ class Generators:
 
 class Generator:
     """
-    Class to cache calls to _generate.
+    Class to cache calls to _generate.  The cache can be shared by threads.
+    Results that fell back because the parser was busy, slow, broken or shed
+    (see stanford_utils.TRANSIENT_FALLBACKS) aren't cached, since the input
+    may be parsed later.  Other fallbacks are cached with the result, and
+    recorded again whenever it's reused.
     """
     def __init__(self, cache_size, generators):
         self.cache = collections.deque(maxlen=cache_size)
+        self.cache_lock = threading.Lock()
         self.generators = generators
 
     def _getCached(self, raw_input_string):
-        for key, value in self.cache:
-            if key == raw_input_string:
-                return value
-        return None
+        """
+        Returns (True, (result, fallbacks)) if raw_input_string is cached,
+        otherwise (False, None).  Results can be None.
+        """
+        with self.cache_lock:
+            for key, value in self.cache:
+                if key == raw_input_string:
+                    return (True, value)
+        return (False, None)
         
-    def _putCached(self, raw_input_string, result):
-        assert(self._getCached(raw_input_string) == None)
-        self.cache.append((raw_input_string, result))
+    def _putCached(self, raw_input_string, result, fallbacks):
+        # Another thread may have generated the same result meanwhile.
+        if not self._getCached(raw_input_string)[0]:
+            with self.cache_lock:
+                self.cache.append((raw_input_string, (result, fallbacks)))
         
     def generate(self, raw_input_string):
         # try and lookup cache
-        cached_result = self._getCached(raw_input_string)
-        if cached_result:
+        found, cached = self._getCached(raw_input_string)
+        if found:
             # return cached result
-            return cached_result
+            (result, fallbacks) = cached
+            for reason in fallbacks:
+                record_fallback(reason)
+            return result
         else:
             # generate, insert into cache, return result
-            result = self._generate(raw_input_string, self.generators)
-            self._putCached(raw_input_string, result)
+            with recording_fallbacks() as fallbacks:
+                result = self._generate(raw_input_string, self.generators)
+            if not TRANSIENT_FALLBACKS.intersection(fallbacks):
+                self._putCached(raw_input_string, result, tuple(fallbacks))
             return result
 
     def _generate(self, raw_input_string, generators):
@@ -58,16 +100,53 @@ class Generator:
 
 
 class Generate_Tokenized_String(Generator):
+    """
+    Generates the tokens of the input, tokenizing each sentence separately so
+    that the periods ending sentences become tokens of their own.
+    """
     def __init__(self, cache_size, generators):
         Generator.__init__(self, cache_size, generators)
         self.tokenizer = nltk.TreebankWordTokenizer()
         
     def _generate(self, raw_input_string, generators):
-        return self.tokenizer.tokenize(raw_input_string)
+        tokens = []
+        for sentence in split_sentences(raw_input_string):
+            tokens.extend(self.tokenizer.tokenize(sentence))
+        return tokens
 
 
 class Generate_Stanford_Parse_Tree(Generator):
+    """
+    Generates the parse tree, or None if the input couldn't be parsed (see
+    stanford_utils.ParserUnavailable).  Messages must fall back to token-based
+    features when there isn't a tree.
+    """
     def _generate(self, raw_input_string, generators):
         generate_tokenized_string = generators.generate_tokenized_string
         tokenized_string = generate_tokenized_string(raw_input_string)
-        return get_parse_tree(tokenized_string)
+        try:
+            return get_parse_tree(tokenized_string)
+        except ParserUnavailable:
+            return None
+
+
+class Generate_Sentence_Parses(Generator):
+    """
+    Generates a list of (offset, tokens, parse tree) for each sentence of the
+    input, where offset is the index of the sentence's first token in the
+    input's tokenized string.  The sentences are parsed independently, which
+    is faster than parsing long input as a whole and keeps negations from
+    spilling into other sentences.  The tree is None for sentences that
+    couldn't be parsed.
+    """
+    def _generate(self, raw_input_string, generators):
+        generate_tokenized_string = generators.generate_tokenized_string
+        sentences = [generate_tokenized_string(sentence)
+                     for sentence in split_sentences(raw_input_string)]
+        trees = parse_sentences(sentences)
+        results = []
+        offset = 0
+        for (tokens, tree) in zip(sentences, trees):
+            results.append((offset, tokens, tree))
+            offset += len(tokens)
+        return results
@@ -0,0 +1,91 @@
+"""
+Spots ingredient names, including multiword names like "olive oil" or "green
+onions", in tokenized user input.
+
+The names come from the database's ingredients and ingredient ontology nodes
+(see Database.get_ingredient_names) and from the ingredients wordlist.
+They're lemmatized and compiled into a phrase trie, which is rebuilt when the
+database's ingredient generation or the wordlists change.  Tokens that aren't
+part of a known name can still be checked with is_ingredient().
+"""
+import threading
+import time
+
+import wordlists
+from nlu.ingredients import normalize_ingredient_name
+from nlu.phrase_trie import PhraseTrie
+
+
+class IngredientSpotter(object):
+    """
+    Finds the ingredient names in a database in tokenized strings.
+    """
+
+    def __init__(self, db, refresh_interval=60):
+        """
+        Create a spotter for the ingredients in db.  The database is checked
+        for new ingredients at most once every refresh_interval seconds.
+        """
+        self._db = db
+        self.refresh_interval = refresh_interval
+        self._trie = None
+        self._generation = None
+        self._last_refresh = 0
+        self._lock = threading.Lock()
+
+    def _current_generation(self):
+        wordlists.refresh()
+        return (self._db.get_ingredient_generation(), wordlists.generation)
+
+    def _build(self):
+        names = self._db.get_ingredient_names()
+        names.update(getattr(wordlists, 'ingredients', ()))
+        trie = PhraseTrie()
+        for name in names:
+            normalized = normalize_ingredient_name(name)
+            if normalized:
+                trie.add(normalized.split(), normalized)
+        return trie
+
+    def trie(self):
+        """
+        Return the trie of normalized ingredient names, rebuilding it if the
+        ingredients have changed.
+        """
+        now = time.time()
+        if self._trie is not None and \
+                now - self._last_refresh < self.refresh_interval:
+            return self._trie
+        with self._lock:
+            if self._trie is None or \
+                    now - self._last_refresh >= self.refresh_interval:
+                generation = self._current_generation()
+                if generation != self._generation:
+                    self._trie = self._build()
+                    self._generation = generation
+                self._last_refresh = now
+        return self._trie
+
+    def find(self, tokenized_string):
+        """
+        Return (start, end, normalized name) for the longest ingredient names
+        in a tokenized string, from left to right.
+        """
+        normalized = [normalize_ingredient_name(token)
+                      for token in tokenized_string]
+        return self.trie().find(normalized)
+
+
+_spotters = {}
+_spotters_lock = threading.Lock()
+
+
+def get_ingredient_spotter(db):
+    """
+    Return the IngredientSpotter shared by everything using db.
+    """
+    with _spotters_lock:
+        key = id(db)
+        if key not in _spotters or _spotters[key]._db is not db:
+            _spotters[key] = IngredientSpotter(db)
+        return _spotters[key]
@@ -1,6 +1,9 @@
 """
 Parsing for ingredient lines of recipes.
 """
+import collections
+import threading
+
 from nltk.stem.wordnet import WordNetLemmatizer
 from nltk.corpus import wordnet
 import wordlists
@@ -11,10 +14,64 @@ import pyparsing
 LEMMATIZER = WordNetLemmatizer()
 
 
+# Nouns under these synsets are ingredients, unless they're also under one of
+# the rejected synsets.
+ACCEPT_SYNSETS = ['food.n.01', 'food.n.02']
+REJECT_SYNSETS = ['meal.n.01', 'meal.n.02', 'dish.n.02', 'vitamin.n.01']
+# The maximum number of words whose results are remembered by is_ingredient.
+IS_INGREDIENT_CACHE_SIZE = 10000
+
+_food_synsets = None
+_food_synsets_lock = threading.Lock()
+_is_ingredient_cache = {}
+_is_ingredient_cache_order = collections.deque()
+_is_ingredient_cache_generation = None
+# Guards the cache, which is shared by every thread using the NLU.
+_is_ingredient_cache_lock = threading.Lock()
+
+
+def _descendants(synset_names):
+    """
+    Return the set of the named synsets and all of their hyponyms.
+    """
+    synsets = set(wordnet.synset(name) for name in synset_names)
+    return synsets.union(*[s.closure(lambda s: s.hyponyms())
+                           for s in list(synsets)])
+
+
+def _get_food_synsets():
+    """
+    Return (accepted, rejected): the sets of synsets under ACCEPT_SYNSETS
+    and under REJECT_SYNSETS.  They're computed on first use.
+    """
+    global _food_synsets
+    if _food_synsets is None:
+        with _food_synsets_lock:
+            if _food_synsets is None:
+                _food_synsets = (_descendants(ACCEPT_SYNSETS),
+                                 _descendants(REJECT_SYNSETS))
+    return _food_synsets
+
+
+def _is_ingredient(word):
+    accepted, rejected = _get_food_synsets()
+    for word_synset in wordnet.synsets(word, wordnet.NOUN):
+        if word_synset in rejected:
+            return False
+        if word_synset in accepted:
+            return True
+    return word in wordlists.ingredients
+
+
 def is_ingredient(word):
     """
     Return True if the word is an ingredient, False otherwise.
 
+    The word's noun senses are checked in order against the precomputed
+    sets of synsets under food and under the rejected synsets, like meals.
+    Results are remembered for the most recent IS_INGREDIENT_CACHE_SIZE
+    words, until the wordlists change.
+
     >>> is_ingredient('milk')
     True
     >>> is_ingredient('blackberries')
@@ -26,20 +83,28 @@ def is_ingredient(word):
     >>> is_ingredient('dish')
     False
     """
-    reject_synsets = ['meal.n.01', 'meal.n.02', 'dish.n.02', 'vitamin.n.01']
-    reject_synsets = set(wordnet.synset(w) for w in reject_synsets)
-    accept_synsets = ['food.n.01', 'food.n.02']
-    accept_synsets = set(wordnet.synset(w) for w in accept_synsets)
-    for word_synset in wordnet.synsets(word, wordnet.NOUN):
-        all_synsets = set(word_synset.closure(lambda s: s.hypernyms()))
-        all_synsets.add(word_synset)
-        for synset in reject_synsets:
-            if synset in all_synsets:
-                return False
-        for synset in accept_synsets:
-            if synset in all_synsets:
-                return True
-    return word in wordlists.ingredients
+    global _is_ingredient_cache_generation
+    wordlists.refresh()
+    with _is_ingredient_cache_lock:
+        if _is_ingredient_cache_generation != wordlists.generation:
+            _is_ingredient_cache.clear()
+            _is_ingredient_cache_order.clear()
+            _is_ingredient_cache_generation = wordlists.generation
+        generation = _is_ingredient_cache_generation
+        result = _is_ingredient_cache.get(word)
+    if result is not None:
+        return result
+    result = _is_ingredient(word)
+    with _is_ingredient_cache_lock:
+        # Another thread may have cached the word meanwhile, or the
+        # wordlists may have changed.
+        if word not in _is_ingredient_cache and \
+                generation == _is_ingredient_cache_generation:
+            if len(_is_ingredient_cache_order) >= IS_INGREDIENT_CACHE_SIZE:
+                del _is_ingredient_cache[_is_ingredient_cache_order.popleft()]
+            _is_ingredient_cache[word] = result
+            _is_ingredient_cache_order.append(word)
+    return result
 
 
 def normalize_ingredient_name(ingredient_name):
@@ -0,0 +1,268 @@
+"""
+Precompiled WordNet distances between common words and the message keyword
+synsets, so that short replies like "yes", "no thanks", "ok" or "bye" can be
+understood without walking the WordNet graph.
+
+The lexicon is built by generate_keyword_lexicon.py and stored in a pickle.
+It has a table for each list of keywords, mapping words to their distances
+from each keyword.  Words that aren't in the lexicon fall back to WordNet, and
+so do lists of keywords that have changed since the lexicon was built.  The
+lookups give the same results as the WordNet functions that they replace.
+
+>>> lexicon = KeywordLexicon({('a.n.01', 'b.n.01'): {
+...     'yes': (2, [2, 1]), 'please': (None, [None, None]),
+...     'the': (NO_SYNSETS, [None, None])}})
+>>> lexicon.min_synset_distance(['a.n.01', 'b.n.01'], ['the', 'yes', '!'])
+(True, (('yes', 1), 1))
+>>> lexicon.min_synset_distance(['a.n.01', 'b.n.01'], ['yes', 'sir'])
+(False, None)
+>>> lexicon.best_distance(['a.n.01', 'b.n.01'], ['please', 'yes'])
+(True, 1)
+"""
+import cPickle
+import logging
+import os
+import threading
+
+from nltk.corpus import wordnet
+
+import utils
+
+LEXICON_FILENAME = os.path.join(os.path.dirname(__file__),
+                                'keyword_lexicon.pkl')
+
+# Stands in for the first distance of words without any synsets.
+NO_SYNSETS = 'no synsets'
+
+# Common words in short replies, which are added to the lexicon along with the
+# keywords' WordNet neighbours.
+COMMON_WORDS = """
+    a all alright am an and are at be bye cancel can course definitely do done
+    exit fine for good goodbye great i is it it's let's me my nah no nope not
+    now of ok okay on please quit really restart right s sounds start stop sure
+    thank thanks that that's the then this to totally want we well yeah yep yes
+    you
+""".split()
+
+
+def _is_word(token):
+    """
+    Returns False for tokens without letters or digits, like punctuation,
+    which never have synsets.
+    """
+    return any(c.isalnum() for c in token)
+
+
+class KeywordLexicon(object):
+    """
+    Lookups of the distances between tokens and keyword synsets.
+    """
+
+    def __init__(self, tables):
+        """
+        Create a lexicon from a dictionary mapping tuples of keyword synset
+        names to tables.  Each table maps words to (first distance, distances)
+        where distances has the smallest distance from each keyword to one of
+        the word's synsets (or None), and first distance is the distance
+        between the first keyword and the word's first synset (or
+        NO_SYNSETS).
+        """
+        self._tables = tables
+
+    def _entries(self, keywords, tokens):
+        """
+        Returns the table entries for the tokens, with None for tokens
+        without letters or digits, or returns None if any token is unknown.
+        """
+        table = self._tables.get(tuple(keywords))
+        if table is None:
+            return None
+        entries = []
+        for token in tokens:
+            if not _is_word(token):
+                entries.append(None)
+                continue
+            entry = table.get(token.lower())
+            if entry is None:
+                return None
+            entries.append(entry)
+        return entries
+
+    def recognizes(self, keywords, tokens):
+        """
+        Returns True if every token is in the table for keywords.
+        """
+        return self._entries(keywords, tokens) is not None
+
+    def min_synset_distance(self, keywords, tokens):
+        """
+        Returns (True, result), where result is what
+        utils.min_synset_distance_in_sentence(keywords, tokens) returns, or
+        (False, None) if the tokens aren't all in the lexicon.
+        """
+        entries = self._entries(keywords, tokens)
+        if entries is None:
+            return (False, None)
+        # min_synset_distance_in_sentence keeps the first distance that it
+        # computes if that distance is None.
+        for i, entry in enumerate(entries):
+            if entry is not None and entry[0] != NO_SYNSETS:
+                if entry[0] is None:
+                    return (True, ((tokens[i], i), None))
+                break
+        # Otherwise it finds the smallest distance, checking the keywords in
+        # order and then the tokens in order.
+        best = None
+        for k in range(len(keywords)):
+            for i, entry in enumerate(entries):
+                if entry is None:
+                    continue
+                distance = entry[1][k]
+                if distance is not None and (best is None or
+                                             distance < best[1]):
+                    best = ((tokens[i], i), distance)
+        return (True, best)
+
+    def best_distance(self, keywords, tokens):
+        """
+        Returns (True, the smallest distance between a keyword and a synset
+        of a token, or infinity), or (False, None) if the tokens aren't all in
+        the lexicon.
+        """
+        entries = self._entries(keywords, tokens)
+        if entries is None:
+            return (False, None)
+        distances = [distance for entry in entries if entry is not None
+                     for distance in entry[1] if distance is not None]
+        return (True, min(distances or [float('inf')]))
+
+
+def _neighbours(synset, max_distance):
+    """
+    Returns the synsets that may be within max_distance of synset, going up
+    through hypernyms and then down through hyponyms.
+    """
+    ancestors = {synset: 0}
+    frontier = [synset]
+    for distance in range(1, max_distance + 1):
+        frontier = [hypernym for s in frontier
+                    for hypernym in s.hypernyms() + s.instance_hypernyms()
+                    if hypernym not in ancestors]
+        for hypernym in frontier:
+            ancestors[hypernym] = distance
+    neighbours = set()
+    for ancestor, distance in ancestors.items():
+        frontier = [ancestor]
+        neighbours.add(ancestor)
+        for _ in range(max_distance - distance):
+            frontier = [hyponym for s in frontier
+                        for hyponym in s.hyponyms() + s.instance_hyponyms()]
+            neighbours.update(frontier)
+    return neighbours
+
+
+def _table_entry(keyword_synsets, word):
+    """
+    Returns the (first distance, distances) table entry for a word.
+    """
+    word_synsets = wordnet.synsets(word)
+    if word_synsets:
+        first = keyword_synsets[0].shortest_path_distance(word_synsets[0])
+    else:
+        first = NO_SYNSETS
+    distances = []
+    for keyword_synset in keyword_synsets:
+        keyword_distances = [keyword_synset.shortest_path_distance(s)
+                             for s in word_synsets]
+        keyword_distances = [d for d in keyword_distances if d is not None]
+        distances.append(min(keyword_distances or [None]))
+    return (first, distances)
+
+
+def build_lexicon(keyword_lists, max_distance=3, extra_words=COMMON_WORDS):
+    """
+    Builds a KeywordLexicon with a table for each list of keyword synset
+    names.  The tables hold the extra words and the words of every synset
+    that may be within max_distance of a keyword.
+    """
+    words = set(extra_words)
+    keyword_synsets = {}
+    for keywords in keyword_lists:
+        keyword_synsets[tuple(keywords)] = [wordnet.synset(keyword)
+                                            for keyword in keywords]
+        for synset in keyword_synsets[tuple(keywords)]:
+            for neighbour in _neighbours(synset, max_distance):
+                words.update(name.lower() for name in neighbour.lemma_names
+                             if '_' not in name)
+    tables = {}
+    for keywords, synsets in keyword_synsets.items():
+        tables[keywords] = dict((word, _table_entry(synsets, word))
+                                for word in words)
+    return KeywordLexicon(tables)
+
+
+def save_lexicon(lexicon, filename=LEXICON_FILENAME):
+    with open(filename, 'wb') as pickle_file:
+        cPickle.dump(lexicon._tables, pickle_file, -1)
+
+
+def load_lexicon(filename=LEXICON_FILENAME):
+    """
+    Loads the lexicon, or returns an empty lexicon if it hasn't been built.
+    """
+    try:
+        with open(filename, 'rb') as pickle_file:
+            return KeywordLexicon(cPickle.load(pickle_file))
+    except IOError:
+        logging.warn("Couldn't load the keyword lexicon from %s; run "
+                     "generate_keyword_lexicon.py to build it." % filename)
+        return KeywordLexicon({})
+
+
+_lexicon = None
+_lexicon_lock = threading.Lock()
+
+
+def get_lexicon():
+    """
+    Returns the shared lexicon, loading it on first use.
+    """
+    global _lexicon
+    if _lexicon is None:
+        with _lexicon_lock:
+            if _lexicon is None:
+                _lexicon = load_lexicon()
+    return _lexicon
+
+
+def min_synset_distance_in_sentence(synset_strings, tokenized_string):
+    """
+    Same as utils.min_synset_distance_in_sentence, using the lexicon when it
+    knows every token.
+    """
+    found, result = get_lexicon().min_synset_distance(synset_strings,
+                                                      tokenized_string)
+    if found:
+        return result
+    return utils.min_synset_distance_in_sentence(synset_strings,
+                                                 tokenized_string)
+
+
+def best_keyword_distance(keywords, tokenized_string):
+    """
+    Returns the smallest distance between a keyword synset and a synset of a
+    token, or infinity if they aren't connected, using the lexicon when it
+    knows every token.
+    """
+    found, best = get_lexicon().best_distance(keywords, tokenized_string)
+    if found:
+        return best
+    best = float('inf')
+    for keyword in keywords:
+        keywordSyn = wordnet.synset(keyword)
+        for word in tokenized_string:
+            for wordSyn in wordnet.synsets(word):
+                distance = keywordSyn.shortest_path_distance(wordSyn)
+                if distance != None:
+                    best = min(best, distance)
+    return best
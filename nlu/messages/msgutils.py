@@ -6,6 +6,13 @@ from nlu.stanford_utils import extract_junction_node
 from nlu.stanford_utils import get_node_string
 from nlu.stanford_utils import extract_subject_nodes
 from nlu.stanford_utils import extract_negation_nodes
+from nlu.messages.keyword_lexicon import best_keyword_distance
+
+# Token-based fallbacks for sentences without a parse tree.
+NEGATION_WORDS = frozenset(["not", "n't", "no", "never", "without", "nothing",
+                            "none", "nor"])
+CLAUSE_BOUNDARIES = frozenset([".", ";", ":", "!", "?", "but"])
+JUNCTION_WORDS = frozenset(["and", "or"])
 
 def extract_subjects(parse_tree, enum=True):
     """
@@ -90,6 +97,51 @@ def extract_junction(parse_tree, word):
                 return 'and'
     return None
     
+def is_negated_in_tokens(tokenized_string, index):
+    """
+    Token-based version of is_negated, used when the sentence couldn't be
+    parsed: the word at index is negated if a negation word precedes it in
+    the same clause.
+
+    >>> tokens = "I don't want ugly fish , but I like carrots .".split()
+    >>> is_negated_in_tokens(tokens, 4)
+    True
+    >>> is_negated_in_tokens(tokens, 9)
+    False
+    """
+    for token in reversed(tokenized_string[:index]):
+        token = token.lower()
+        if token in CLAUSE_BOUNDARIES:
+            return False
+        if token in NEGATION_WORDS or token.endswith("n't"):
+            return True
+    return False
+
+
+def extract_junction_from_tokens(tokenized_string, index):
+    """
+    Token-based version of extract_junction, used when the sentence couldn't
+    be parsed: returns the closest 'and' or 'or' in the same clause as the
+    word at index, preferring the one before it, or 'and' if there isn't one.
+
+    >>> tokens = "carrots and children or celery ?".split()
+    >>> [extract_junction_from_tokens(tokens, i) for i in (0, 2, 4)]
+    ['and', 'and', 'or']
+    """
+    def closest(tokens):
+        for distance, token in enumerate(tokens):
+            token = token.lower()
+            if token in CLAUSE_BOUNDARIES:
+                break
+            if token in JUNCTION_WORDS:
+                return (distance, token)
+        return (float('inf'), None)
+    before = closest(reversed(tokenized_string[:index]))
+    after = closest(tokenized_string[index + 1:])
+    junction = min(before, after, key=lambda x: x[0])[1]
+    return junction or 'and'
+
+
 def extract_close_keywords(keywords, tokenized_string, minDistance):
     """
     >>> raw_input_string = 'I like fish.'
@@ -124,19 +176,11 @@ def extract_words_from_list(word_list, string_list, enum=False):
                 yield word
                 
 def get_keyword_confidence(raw_input_string, keywords, minDistance):
-    bestDistance = float('inf')
-
     tokenizer = nltk.WordPunctTokenizer()
     tokenized_string = tokenizer.tokenize(raw_input_string)
 
     # Find the best keyword synset distance to input string
-    for keyword in keywords:
-        keywordSyn = wordnet.synset(keyword)
-        for word in tokenized_string:
-            for wordSyn in wordnet.synsets(word):
-                distance = keywordSyn.shortest_path_distance(wordSyn)
-                if distance != None:
-                    bestDistance = min(bestDistance, distance)
+    bestDistance = best_keyword_distance(keywords, tokenized_string)
                 
     if bestDistance <= minDistance:
         return (1-(float(bestDistance)/minDistance)) * .5 + .5
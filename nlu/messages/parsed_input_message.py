@@ -1,4 +1,5 @@
-from nlu.stanford_utils import extract_sentence_type
+from nlu.stanford_utils import extract_sentence_type_from_tree
+from nlu.stanford_utils import extract_sentence_type_from_tokens
 from data_structures import Message
 
 class ParsedInputMessage(Message):
@@ -25,11 +26,29 @@ class ParsedInputMessage(Message):
         
         # set meta:sentence
         #TODO: Figure out why py4j calls Exception TypeError: "'NoneType' object is not callable" in...
-        sentence_type, sentence_word = extract_sentence_type(raw_input_string)
+        sentence_type, sentence_word = \
+            self._extract_sentence_type(raw_input_string, generators)
         self.meta['sentence'] = {'type':sentence_type, 'word':sentence_word}
         # call implemented parse method
         self._parse(raw_input_string, generators)
 
+    def _extract_sentence_type(self, raw_input_string, generators):
+        """
+        Returns ('question', question word) or (None, None) for the input.
+        Messages that don't need a parse can override this to avoid parsing.
+        """
+        for offset, tokens, parse_tree in \
+                generators.generate_sentence_parses(raw_input_string):
+            if parse_tree is None: # Couldn't parse; use the tokens instead.
+                sentence_type, sentence_word = \
+                    extract_sentence_type_from_tokens(tokens)
+            else:
+                sentence_type, sentence_word = \
+                    extract_sentence_type_from_tree(parse_tree)
+            if sentence_type is not None:
+                return (sentence_type, sentence_word)
+        return (None, None)
+
     def _parse(self, raw_input_string, generators):
         """
         Fills out the message meta and frame attributes.
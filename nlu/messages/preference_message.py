@@ -16,6 +16,7 @@ class PreferenceMessage(ParsedInputMessage):
     >>> generators = Generators()
     >>> generators.add(Generate_Tokenized_String, cache_size)
     >>> generators.add(Generate_Stanford_Parse_Tree, cache_size)
+    >>> generators.add(Generate_Sentence_Parses, cache_size)
     
     >>> pm = PreferenceMessage('I like Japanese food.', generators)
     >>> print pm.frame
@@ -47,12 +48,17 @@ class PreferenceMessage(ParsedInputMessage):
         Fills out message meta and frame attributes.
         """
         tokenized_string = g.generate_tokenized_string(raw_input_string)
-        parseTree = g.generate_stanford_parse_tree(raw_input_string)
         
-        subjects = extract_subject_nodes(parseTree)
-        if subjects:
-            self.frame['subject'] = [get_node_string(subject)
-                                     for subject in subjects]
+        # Use the subject of the first sentence that has one.
+        for offset, tokens, parseTree in \
+                g.generate_sentence_parses(raw_input_string):
+            if parseTree is None: # Couldn't parse; skip the subject.
+                continue
+            subjects = [get_node_string(subject)
+                        for subject in extract_subject_nodes(parseTree)]
+            if subjects:
+                self.frame['subject'] = subjects
+                break
         words_temporary_pos = extract_close_keywords(
                                        PreferenceMessage.keywords_temporary_pos,
                                        tokenized_string,
@@ -1,29 +1,52 @@
 from __future__ import absolute_import
 from nlu.messages.parsed_input_message import ParsedInputMessage
 import nltk
-from nltk.corpus import wordnet
+
+import threading
 
 import wordlists
 import utils
 from nlu import is_ingredient, normalize_ingredient_name
+from nlu.phrase_trie import PhraseTrie
 from nlu.stanford_utils import get_node_string
 from nlu.stanford_utils import get_parse_tree
-from nlu.messages.msgutils import extract_words_from_list
 from nlu.messages.msgutils import extract_junction
 from nlu.messages.msgutils import extract_subjects
 from nlu.messages.msgutils import is_negated
+from nlu.messages.msgutils import is_negated_in_tokens
+from nlu.messages.msgutils import extract_junction_from_tokens
+from nlu.messages.keyword_lexicon import best_keyword_distance
 
-def get_preference_range(parseTree, word):
-    if is_negated(parseTree, word):
+def get_preference_range(parseTree, word, tokenized_string=None, index=None):
+    """
+    Returns -1 if word is negated, otherwise 1.  If parseTree is None, the
+    negation is guessed from the tokens before tokenized_string[index].
+    """
+    if parseTree is None:
+        negated = is_negated_in_tokens(tokenized_string, index)
+    else:
+        negated = is_negated(parseTree, word)
+    if negated:
         return -1
     else:
         return 1
-        
 
-def get_ingredients(tokenized_string, enum=False):
+
+def get_junction(parseTree, word, tokenized_string, index):
+    """
+    Returns 'and' or 'or' for a word, using the tokens if parseTree is None.
+    """
+    if parseTree is None:
+        return extract_junction_from_tokens(tokenized_string, index)
+    return extract_junction(parseTree, word)
+
+
+def get_ingredients(tokenized_string, enum=False, spotter=None):
     """
     Returns a tuple of (index, ingredient) or a list of ingredients from a
-    tokenized string.
+    tokenized string.  If an IngredientSpotter is given, the ingredient names
+    that it knows are found first, so that names with several words are kept
+    together; the remaining tokens are checked with is_ingredient.
 
     >>> raw_input_string = "I like apples, cinnamon, and pepper."
     >>> tokenizer = nltk.WordPunctTokenizer()
@@ -32,13 +55,77 @@ def get_ingredients(tokenized_string, enum=False):
     2 apples
     4 cinnamon
     7 pepper
+
+    >>> from database import Database
+    >>> from nlu.ingredient_spotter import IngredientSpotter
+    >>> db = Database('sqlite:///:memory:')
+    >>> db.add_from_recipe_parts({'title': 'dressing',
+    ...     'ingredients': ['1 cup olive oil', '2 cloves garlic']})
+    >>> spotter = IngredientSpotter(db)
+    >>> tokenized_string = tokenizer.tokenize("Olive oil and garlic, please")
+    >>> get_ingredients(tokenized_string, spotter=spotter)
+    ['Olive oil', 'garlic']
     """
-    words = [normalize_ingredient_name(x) for x in tokenized_string]
-    results = [x for x in enumerate(words) if is_ingredient(x[1])]
+    results = []
+    covered = set()
+    if spotter is not None:
+        for start, end, name in spotter.find(tokenized_string):
+            results.append((start, ' '.join(tokenized_string[start:end])))
+            covered.update(range(start, end))
+    for i, token in enumerate(tokenized_string):
+        if i not in covered and is_ingredient(normalize_ingredient_name(token)):
+            results.append((i, token))
+    results.sort()
     if enum:
-        return [(i, tokenized_string[i]) for i, w in results]
+        return results
     else:
-        return [tokenized_string[i] for i, w in results]
+        return [w for i, w in results]
+
+
+class _StemmedPhrases(object):
+    """
+    A trie of the stemmed phrases in some wordlists, rebuilt when the
+    wordlists change.
+    """
+    def __init__(self, get_phrases):
+        """
+        get_phrases returns the phrases from the wordlists module.
+        """
+        self._get_phrases = get_phrases
+        self._trie = None
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def trie(self):
+        wordlists.refresh()
+        if self._generation != wordlists.generation:
+            with self._lock:
+                if self._generation != wordlists.generation:
+                    generation = wordlists.generation
+                    self._trie = PhraseTrie(
+                        (utils.stem_words(phrase.split()), phrase)
+                        for phrase in self._get_phrases())
+                    self._generation = generation
+        return self._trie
+
+    def find(self, tokenized_string):
+        """
+        Returns (index, phrase) for the phrases in a tokenized string, where
+        phrase is the matching tokens joined by spaces.
+        """
+        stemmed_string = utils.stem_words(tokenized_string)
+        return [(start, ' '.join(tokenized_string[start:end]))
+                for start, end, _ in self.trie().find(stemmed_string)]
+
+
+def _cuisine_phrases():
+    cuisines = set(getattr(wordlists, 'cuisines', ()))
+    cuisines.difference_update(wordlists.meal_types)
+    return cuisines.union(wordlists.list_of_adjectivals)
+
+
+_MEALS = _StemmedPhrases(lambda: wordlists.meal_types)
+_CUISINES = _StemmedPhrases(_cuisine_phrases)
 
 
 def get_meals(tokenized_string, enum=False):
@@ -53,14 +140,11 @@ def get_meals(tokenized_string, enum=False):
     4 breakfast
     8 dinner
     """
-    
-    stemmed_string = utils.stem_words(tokenized_string)
-    stemmed_meals = utils.stem_words(wordlists.meal_types)
-    results = extract_words_from_list(stemmed_meals, stemmed_string, True)
+    results = _MEALS.find(tokenized_string)
     if enum:
-        return [(i, tokenized_string[i]) for i, w in results]
+        return results
     else:
-        return [tokenized_string[i] for i, w in results]
+        return [w for i, w in results]
     
 def get_cuisines(tokenized_string, enum=False):
     """
@@ -73,17 +157,18 @@ def get_cuisines(tokenized_string, enum=False):
     >>> for i,w in get_cuisines(tokenized_string, enum=True): print i,w
     3 chinese
     5 mexican
+
+    Cuisines with several words are matched as a whole:
+
+    >>> tokenized_string = tokenizer.tokenize("Any Costa Rican dishes?")
+    >>> get_cuisines(tokenized_string)
+    ['Costa Rican']
     """
-    
-    stemmed_string = utils.stem_words(tokenized_string)
-    cuisines = set.difference(wordlists.cuisines, wordlists.meal_types)
-    cuisines = cuisines.union(wordlists.list_of_adjectivals)
-    stemmed_cuisines = utils.stem_words(cuisines)
-    results = extract_words_from_list(stemmed_cuisines, stemmed_string, True)
+    results = _CUISINES.find(tokenized_string)
     if enum:
-        return [(i, tokenized_string[i]) for i, w in results]
+        return results
     else:
-        return [tokenized_string[i] for i, w in results]
+        return [w for i, w in results]
 
 
 class SearchMessage(ParsedInputMessage):
@@ -93,6 +178,7 @@ class SearchMessage(ParsedInputMessage):
     >>> generators = Generators()
     >>> generators.add(Generate_Tokenized_String, cache_size)
     >>> generators.add(Generate_Stanford_Parse_Tree, cache_size)
+    >>> generators.add(Generate_Sentence_Parses, cache_size)
     
     >>> # Test Confidence
     >>> SearchMessage.confidence('I like apples and carrots.', generators)
@@ -132,6 +218,11 @@ class SearchMessage(ParsedInputMessage):
     breakfast
     >>> sm.frame['ingredient']
     []
+    >>> sm = SearchMessage("I have chicken. I don't want rice.", generators)
+    >>> for ingredient in sm.frame['ingredient']:
+    ...     print ingredient['id'], ingredient['name'], ingredient['preference']
+    2 chicken 1
+    7 rice -1
     """
     # attributes in the frame
     #frame_keys = ['ingredientients', 'cost', 'callories', 'time_total', 'time_prep',
@@ -143,43 +234,66 @@ class SearchMessage(ParsedInputMessage):
     
     def _parse(self, raw_input_string, g):
         """
-        Fills out message meta and frame attributes.
+        Fills out message meta and frame attributes.  Each sentence is parsed
+        separately, and its frame items are added to the message's frame.
+        """
+        for offset, tokenized_string, parseTree in \
+                g.generate_sentence_parses(raw_input_string):
+            self._parse_sentence(offset, tokenized_string, parseTree,
+                                 g.ingredient_spotter)
+
+    def _parse_sentence(self, offset, tokenized_string, parseTree,
+                        spotter=None):
+        """
+        Adds the frame items for one sentence, whose first token is at index
+        offset in the whole input.  parseTree may be None.
         """
-        tokenized_string = g.generate_tokenized_string(raw_input_string)
-        parseTree = g.generate_stanford_parse_tree(raw_input_string)
         
         # Ingredients
-        for i, ingredient in get_ingredients(tokenized_string, enum=True):
+        for i, ingredient in get_ingredients(tokenized_string, enum=True,
+                                             spotter=spotter):
+            # Look up names with several words by their last word.
+            head = ingredient.split()[-1]
             frameItem = {}
-            frameItem['id'] = i
+            frameItem['id'] = offset + i
             frameItem['name'] = ingredient
             frameItem['descriptor'] = [] # TODO: siblings JJ
-            frameItem['preference'] = get_preference_range(parseTree, ingredient)
-            frameItem['relationship'] = extract_junction(parseTree, ingredient)
+            frameItem['preference'] = get_preference_range(parseTree,
+                head, tokenized_string, i)
+            frameItem['relationship'] = get_junction(parseTree, head,
+                                                     tokenized_string, i)
             self.frame['ingredient'].append(frameItem)
             
         # Meals
         for i, meal in get_meals(tokenized_string, enum=True):
-            meal = tokenized_string[i]
+            # Look up names with several words by their last word.
+            head = meal.split()[-1]
             frameItem = {}
-            frameItem['id'] = i
+            frameItem['id'] = offset + i
             frameItem['name'] = meal
             frameItem['descriptor'] = [] # TODO: siblings JJ
-            frameItem['preference'] = extract_junction(parseTree, meal)
-            frameItem['relationship'] = extract_junction(parseTree, meal)
+            frameItem['preference'] = get_junction(parseTree, head,
+                                                   tokenized_string, i)
+            frameItem['relationship'] = get_junction(parseTree, head,
+                                                     tokenized_string, i)
             self.frame['meal'].append(frameItem)
             
         # Cuisine
         for i, cuisine in get_cuisines(tokenized_string, enum=True):
+            head = cuisine.split()[-1]
             frameItem = {}
-            frameItem['id'] = i
+            frameItem['id'] = offset + i
             frameItem['name'] = cuisine
             frameItem['descriptor'] = [] # TODO: siblings JJ
-            frameItem['preference'] = extract_junction(parseTree, cuisine)
-            frameItem['relationship'] = extract_junction(parseTree, cuisine)
+            frameItem['preference'] = get_junction(parseTree, head,
+                                                   tokenized_string, i)
+            frameItem['relationship'] = get_junction(parseTree, head,
+                                                     tokenized_string, i)
             self.frame['cuisine'].append(frameItem)
             
         # Dish
+        if parseTree is None:
+            return # Dishes are only found with the parser.
         dishesSet = []
         # add sentence subjects which aren't already ingredients or meals
         #TODO: Set extract_subject_nodes to hanle multiple phrases by splitting on and/or
@@ -194,7 +308,7 @@ class SearchMessage(ParsedInputMessage):
                           
         for i, dish in dishesSet:
             frameItem = {}
-            frameItem['id'] = i
+            frameItem['id'] = offset + i
             frameItem['name'] = dish
             frameItem['descriptor'] = [] # TODO: siblings JJ
             frameItem['preference'] = extract_junction(parseTree, dish)
@@ -205,16 +319,10 @@ class SearchMessage(ParsedInputMessage):
     def confidence(raw_input_string, generators):
         # TODO: configure minDistance on a per-keyword basis
         minDistance = 3
-        bestDistance = float('inf')
         
         # Find the best keyword synset distance to input string
-        for keyword in SearchMessage.keywords:
-            keywordSyn = wordnet.synset(keyword)
-            for word in raw_input_string.split(' '):
-                for wordSyn in wordnet.synsets(word):
-                    distance = keywordSyn.shortest_path_distance(wordSyn)
-                    if distance != None:
-                        bestDistance = min(bestDistance, distance)
+        bestDistance = best_keyword_distance(SearchMessage.keywords,
+                                             raw_input_string.split(' '))
                     
         if bestDistance <= minDistance:
             # TODO: determine best metric for this
@@ -2,9 +2,10 @@ import nltk
 from nltk.corpus import wordnet
 
 from nlu.messages.parsed_input_message import ParsedInputMessage
-from nlu.messages.msgutils import extract_close_keywords
 from nlu.messages.msgutils import get_keyword_confidence
-import utils
+from nlu.messages.keyword_lexicon import best_keyword_distance
+from nlu.messages.keyword_lexicon import get_lexicon
+from nlu.stanford_utils import extract_sentence_type_from_tokens
 
 class SystemMessage(ParsedInputMessage):
     frame_keys = ['action']
@@ -12,6 +13,18 @@ class SystemMessage(ParsedInputMessage):
     restart_keywords = ['restart.v.01', 'reload.v.02']
     keywords = exit_keywords + restart_keywords
 
+    def _extract_sentence_type(self, raw_input_string, g):
+        """
+        Skips parsing commands made up of words in the keyword lexicon.
+        """
+        tokenized_string = g.generate_tokenized_string(raw_input_string)
+        lexicon = get_lexicon()
+        if lexicon.recognizes(self.exit_keywords, tokenized_string) and \
+                lexicon.recognizes(self.restart_keywords, tokenized_string):
+            return extract_sentence_type_from_tokens(tokenized_string)
+        return ParsedInputMessage._extract_sentence_type(self,
+            raw_input_string, g)
+
     def _parse(self, raw_input_string, g):
         """
         Fills out message meta and frame attributes
@@ -20,8 +33,8 @@ class SystemMessage(ParsedInputMessage):
 
         wordActionMap = {'exit':SystemMessage.exit_keywords, 'restart':SystemMessage.restart_keywords}
         for action, keywords in wordActionMap.items():
-            matches = extract_close_keywords(keywords, tokenized_string, 3)
-            if matches: # synset of keyword was found in the sentence
+            distance = best_keyword_distance(keywords, tokenized_string)
+            if distance <= 3: # synset of keyword was found in the sentence
                 self.frame['action'] = action
          
     @staticmethod
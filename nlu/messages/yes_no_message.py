@@ -2,7 +2,9 @@ import nltk
 from nltk.corpus import wordnet
 
 from nlu.messages.parsed_input_message import ParsedInputMessage
-import utils
+from nlu.messages.keyword_lexicon import get_lexicon
+from nlu.messages.keyword_lexicon import min_synset_distance_in_sentence
+from nlu.stanford_utils import extract_sentence_type_from_tokens
 
 class YesNoMessage(ParsedInputMessage):
     """
@@ -11,6 +13,7 @@ class YesNoMessage(ParsedInputMessage):
     >>> generators = Generators()
     >>> generators.add(Generate_Tokenized_String, cache_size)
     >>> generators.add(Generate_Stanford_Parse_Tree, cache_size)
+    >>> generators.add(Generate_Sentence_Parses, cache_size)
     
     >>> YesNoMessage.confidence("Hmmm... No thanks.", generators)
     1.0
@@ -49,13 +52,25 @@ class YesNoMessage(ParsedInputMessage):
     minDistance = 3
         
     
+    def _extract_sentence_type(self, raw_input_string, g):
+        """
+        Skips parsing replies made up of words in the keyword lexicon.
+        """
+        tokenized_string = g.generate_tokenized_string(raw_input_string)
+        lexicon = get_lexicon()
+        if lexicon.recognizes(self.yes_keywords, tokenized_string) and \
+                lexicon.recognizes(self.no_keywords, tokenized_string):
+            return extract_sentence_type_from_tokens(tokenized_string)
+        return ParsedInputMessage._extract_sentence_type(self,
+            raw_input_string, g)
+
     def _parse(self, raw_input_string, g):
         tokenized_string = g.generate_tokenized_string(raw_input_string)
         
-        yesDistanceSet = utils.min_synset_distance_in_sentence(
+        yesDistanceSet = min_synset_distance_in_sentence(
                             YesNoMessage.yes_keywords,
                             tokenized_string)
-        noDistanceSet = utils.min_synset_distance_in_sentence(
+        noDistanceSet = min_synset_distance_in_sentence(
                             YesNoMessage.no_keywords,
                             tokenized_string)
                             
@@ -97,10 +112,10 @@ class YesNoMessage(ParsedInputMessage):
     def confidence(raw_input_string, g):
         tokenized_string = g.generate_tokenized_string(raw_input_string)
         
-        yesDistanceSet = utils.min_synset_distance_in_sentence(
+        yesDistanceSet = min_synset_distance_in_sentence(
                             YesNoMessage.yes_keywords,
                             tokenized_string)
-        noDistanceSet = utils.min_synset_distance_in_sentence(
+        noDistanceSet = min_synset_distance_in_sentence(
                             YesNoMessage.no_keywords,
                             tokenized_string)
                             
@@ -4,28 +4,28 @@ Python interface to the Stanford Parser.
 You can access static methods and classes through the gateway.jvm object, or
 you can add a line like
 
-    LexicalizedParser = gateway.jvm.LexicalizedParser
+    LexicalizedParser = gateway.java_class("LexicalizedParser")
 
-to this module to create a short alias.  Run this file for a demo.
+to this module to create a short alias.  The parser runs in the JVM shared with
+SimpleNLG, which is launched the first time the gateway or one of these aliases
+is used, not when this module is imported.  Run this file for a demo.
 """
 import os
 
-from py4j_server import launch_py4j_server
-from py4j.java_gateway import java_import
+from py4j_server import get_shared_gateway
 
 
-gateway = launch_py4j_server()
-
-# Import the SimpleNLG classes
-java_import(gateway.jvm, "edu.stanford.nlp.parser.lexparser.LexicalizedParser")
-java_import(gateway.jvm, "edu.stanford.nlp.trees.*")
-java_import(gateway.jvm, "java.util.*")
+gateway = get_shared_gateway([
+    "edu.stanford.nlp.parser.lexparser.LexicalizedParser",
+    "edu.stanford.nlp.trees.*",
+    "java.util.*",
+])
 
 # Define aliases so that we don't have to use the gateway.jvm prefix.
-LexicalizedParser = gateway.jvm.LexicalizedParser
-Tree = gateway.jvm.Tree
-Arrays = gateway.jvm.Arrays
-ArrayList = Arrays = gateway.jvm.ArrayList
+LexicalizedParser = gateway.java_class("LexicalizedParser")
+Tree = gateway.java_class("Tree")
+Arrays = gateway.java_class("Arrays")
+ArrayList = Arrays = gateway.java_class("ArrayList")
 
 
 def main():
@@ -0,0 +1,100 @@
+"""
+A trie of phrases, used to spot multiword names like "middle eastern" or
+"olive oil" in tokenized user input.
+
+>>> trie = PhraseTrie()
+>>> trie.add(['olive', 'oil'], 'olive oil')
+>>> trie.add(['olive'], 'olive')
+>>> trie.add(['oil'], 'oil')
+>>> trie.find('i like olive oil and olive bread'.split())
+[(2, 4, 'olive oil'), (5, 6, 'olive')]
+>>> ['olive', 'oil'] in trie, ['olive', 'bread'] in trie
+(True, False)
+>>> len(trie)
+3
+"""
+
+# Key marking the end of a phrase in a trie node.  Tokens are strings, so
+# this can't clash with them.
+_END = None
+
+
+class PhraseTrie(object):
+    """
+    Maps phrases (sequences of tokens) to values.
+    """
+
+    def __init__(self, phrases=()):
+        """
+        Create a trie holding (tokens, value) pairs.
+        """
+        self._root = {}
+        self._size = 0
+        for tokens, value in phrases:
+            self.add(tokens, value)
+
+    def add(self, tokens, value=True):
+        """
+        Add a phrase, replacing its value if it's already in the trie.
+        """
+        if not tokens:
+            return
+        node = self._root
+        for token in tokens:
+            node = node.setdefault(token, {})
+        if _END not in node:
+            self._size += 1
+        node[_END] = value
+
+    def _node(self, tokens):
+        node = self._root
+        for token in tokens:
+            node = node.get(token)
+            if node is None:
+                return None
+        return node
+
+    def __contains__(self, tokens):
+        node = self._node(tokens)
+        return node is not None and _END in node
+
+    def __len__(self):
+        return self._size
+
+    def get(self, tokens, default=None):
+        node = self._node(tokens)
+        if node is None:
+            return default
+        return node.get(_END, default)
+
+    def longest_match(self, tokens, start=0):
+        """
+        Return (end, value) for the longest phrase that starts at
+        tokens[start], or None if no phrase starts there.
+        """
+        node = self._root
+        match = None
+        for i in xrange(start, len(tokens)):
+            node = node.get(tokens[i])
+            if node is None:
+                break
+            if _END in node:
+                match = (i + 1, node[_END])
+        return match
+
+    def find(self, tokens):
+        """
+        Return a list of (start, end, value) for the phrases in tokens, found
+        from left to right, preferring the longest phrase at each position.
+        The phrases don't overlap.
+        """
+        matches = []
+        i = 0
+        while i < len(tokens):
+            match = self.longest_match(tokens, i)
+            if match is None:
+                i += 1
+            else:
+                matches.append((i, match[0], match[1]))
+                i = match[0]
+        return matches
@@ -1,16 +1,197 @@
 """
 Methods which work on the nodes/tree of the stanford parser.
+
+Parsing is bounded: sentences longer than MAX_PARSE_TOKENS aren't parsed, and
+a parse that takes longer than PARSE_TIMEOUT seconds, including the time to
+load the grammar when a parser is created, is abandoned.  In both cases, and
+when the parser can't be started, get_parse_tree() raises
+ParserUnavailable and callers fall back to token-based features.  The number
+of fallbacks of each kind is available from get_fallback_counts(), and the
+fallbacks in a thread can be followed with recording_fallbacks().
+
+Each parser parses one sentence at a time.  Up to PARSER_POOL_SIZE parsers are
+created, so that parse_sentences() can parse several sentences concurrently;
+each parser holds its own copy of the grammar in the JVM's heap.
+
+Sentences are parsed in threads of their own, and the Py4J calls they make
+are counted as calls by the thread that asked for the parse, so that tracing
+spans include them.
+
+Inside a without_parser() block, get_parse_tree() raises ParserUnavailable
+without using the JVM, so that messages are understood from their tokens and
+the keyword lexicon alone; servers do this when they're overloaded.
 """
 
 import os
 import collections
+from contextlib import contextmanager
 import itertools
+import logging
+import threading
+import time
 
 from nlu.nluserver import *
+from py4j_server import get_call_count, add_call_count
+
+# Limits on parsing, which can be overridden by environment variables.
+PARSE_TIMEOUT = float(os.environ.get('NLU_PARSE_TIMEOUT', 5.0))
+MAX_PARSE_TOKENS = int(os.environ.get('NLU_MAX_PARSE_TOKENS', 50))
+PARSER_POOL_SIZE = int(os.environ.get('NLU_PARSER_POOL_SIZE', 1))
+
+QUESTION_WORDS = frozenset(['what', 'which', 'who', 'whom', 'whose', 'where',
+                            'when', 'why', 'how'])
+
+LOG = logging.getLogger('nlu.stanford_utils')
 
-# generate parser
+# "ant grammar" in py4j_server decompresses the grammar, which loads faster.
+_fastTrainerFile = os.path.join(os.path.dirname(__file__), 'englishPCFG.ser')
 _trainerFile = os.path.join(os.path.dirname(__file__), 'englishPCFG.ser.gz')
-lexical_parser = LexicalizedParser(_trainerFile)
+# Parsers are created on first use, since loading the grammar is slow.  They're
+# recreated if the JVM is relaunched.  A parse that timed out keeps its parser
+# busy until it finishes in the background.
+_free_parsers = []
+_parser_count = 0
+_parser_generation = None
+# The generation of the JVM that the grammar was last loaded in.
+_grammar_generation = None
+_parser_condition = threading.Condition()
+
+_fallback_counts = collections.defaultdict(int)
+_fallback_counts_lock = threading.Lock()
+
+# Set in threads that are running without the parser; see without_parser().
+_without_parser = threading.local()
+# The reasons that parsing fell back in each thread; see recording_fallbacks().
+_recorded_fallbacks = threading.local()
+
+# Reasons for falling back that depend on the load rather than the input, so
+# that the input may well be parsed if it's tried again.
+TRANSIENT_FALLBACKS = frozenset(['busy', 'timeout', 'error', 'shed'])
+
+
+class ParserUnavailable(Exception):
+    """
+    Raised when a sentence can't be parsed in time, is too long to parse, or
+    the parser can't be started, or inside without_parser().  The reason is
+    one of 'too_long', 'busy', 'timeout', 'error' or 'shed'.
+    """
+    def __init__(self, reason, detail=''):
+        Exception.__init__(self, reason, detail)
+        self.reason = reason
+        self.detail = detail
+
+
+def _count_fallback(reason):
+    with _fallback_counts_lock:
+        _fallback_counts[reason] += 1
+    record_fallback(reason)
+
+
+def record_fallback(reason):
+    """
+    Record a fallback in the current thread (see recording_fallbacks())
+    without counting it, for fallbacks that were counted elsewhere, like in
+    another thread, or when a result that fell back is reused.
+    """
+    reasons = getattr(_recorded_fallbacks, 'reasons', None)
+    if reasons is not None:
+        reasons.append(reason)
+
+
+def get_fallback_counts():
+    """
+    Return a dictionary mapping reasons to the number of times that parsing
+    was skipped for that reason.
+    """
+    with _fallback_counts_lock:
+        return dict(_fallback_counts)
+
+
+def reset_fallback_counts():
+    with _fallback_counts_lock:
+        _fallback_counts.clear()
+
+
+@contextmanager
+def recording_fallbacks():
+    """
+    Record the reasons that parsing fell back in the current thread inside a
+    with statement, which is given the list of them.  Fallbacks recorded in
+    a nested with statement are also recorded by the enclosing one.
+
+    >>> with recording_fallbacks() as outer:
+    ...     with recording_fallbacks() as inner:
+    ...         _count_fallback('too_long')
+    >>> outer, inner
+    (['too_long'], ['too_long'])
+    >>> reset_fallback_counts()
+    """
+    previous = getattr(_recorded_fallbacks, 'reasons', None)
+    reasons = []
+    _recorded_fallbacks.reasons = reasons
+    try:
+        yield reasons
+    finally:
+        _recorded_fallbacks.reasons = previous
+        if previous is not None:
+            previous.extend(reasons)
+
+
+@contextmanager
+def without_parser():
+    """
+    Don't parse anything in the current thread inside a with statement.
+    """
+    previous = parser_disabled()
+    _without_parser.active = True
+    try:
+        yield
+    finally:
+        _without_parser.active = previous
+
+
+def parser_disabled():
+    """
+    Return True if the current thread is inside a without_parser() block.
+    """
+    return getattr(_without_parser, 'active', False)
+
+
+def grammar_filename():
+    """
+    Return the filename of the parser's grammar, preferring the decompressed
+    grammar if it has been built.
+    """
+    if os.path.exists(_fastTrainerFile):
+        return _fastTrainerFile
+    return _trainerFile
+
+
+def warm_up():
+    """
+    Launch the JVM and load the parser's grammar now, rather than when the
+    first sentence is parsed.  Servers can call this at startup so that the
+    first user doesn't wait for it.
+    """
+    (parser, generation) = _acquire_parser()
+    if parser is None:
+        try:
+            parser = _create_parser(generation)
+        except Exception, e:
+            raise _unavailable('error', e)
+    _release_parser(parser, generation)
+
+
+def _load_grammar():
+    """
+    Create the first parser, like warm_up(), unless one has been created
+    since the JVM was launched.  Parses call this before their timeouts
+    start, so that loading the grammar, which takes seconds, isn't counted
+    against them.
+    """
+    if _grammar_generation != gateway.generation:
+        warm_up()
+
 
 def _iterator_first(iterator):
     try:
@@ -18,9 +199,111 @@ def _iterator_first(iterator):
     except StopIteration:
         return None
 
-def get_parse_tree(tokenized_string, lexical_parser=lexical_parser):
+def _unavailable(reason, detail=''):
+    _count_fallback(reason)
+    LOG.info("Not parsing (%s) %s" % (reason, detail))
+    return ParserUnavailable(reason, detail)
+
+
+def _acquire_parser(deadline=None):
     """
-    Generates a java parse tree from a tokenized string.
+    Take a parser from the pool and return (parser, generation).  If no
+    parser is free but fewer than PARSER_POOL_SIZE exist, a place in the pool
+    is taken for a new parser instead, and parser is None; the caller must
+    then create it with _create_parser().  Raises ParserUnavailable if no
+    parser is free by the deadline.
+    """
+    global _parser_count, _parser_generation
+    try:
+        gateway.get()  # Relaunches the JVM if it has died.
+    except Exception, e:
+        raise _unavailable('error', e)
+    with _parser_condition:
+        if _parser_generation != gateway.generation:
+            # The JVM was relaunched, so the old parsers are gone.
+            del _free_parsers[:]
+            _parser_count = 0
+            _parser_generation = gateway.generation
+        while not _free_parsers and _parser_count >= PARSER_POOL_SIZE:
+            if deadline is None:
+                _parser_condition.wait()
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise _unavailable('busy')
+            _parser_condition.wait(remaining)
+        generation = _parser_generation
+        if _free_parsers:
+            return (_free_parsers.pop(), generation)
+        _parser_count += 1
+        return (None, generation)
+
+
+def _create_parser(generation):
+    """
+    Create a parser in the place taken by _acquire_parser().  The JVM loads
+    the grammar for its first parser, which takes seconds, and shares it with
+    the others (and with other processes' parsers, in a shared daemon).  If
+    the parser can't be created, the place is given up and the exception is
+    raised.
+    """
+    global _parser_count, _grammar_generation
+    try:
+        parser = gateway.get().entry_point.newParser(grammar_filename())
+        _grammar_generation = generation
+        return parser
+    except Exception:
+        with _parser_condition:
+            if generation == _parser_generation:
+                _parser_count -= 1
+            _parser_condition.notify()
+        raise
+
+
+def _release_parser(parser, generation):
+    """
+    Return a parser to the pool, unless the JVM has been relaunched since it
+    was created.
+    """
+    with _parser_condition:
+        if generation == _parser_generation:
+            _free_parsers.append(parser)
+        _parser_condition.notify()
+
+
+def _parse(lexical_parser, tokenized_string):
+    # build up the java array
+    stringArray = ArrayList()
+    for word in tokenized_string: stringArray.append(word)
+    # parse and return
+    lexical_parser.parse(stringArray)
+    return lexical_parser.getBestParse()
+
+
+def _parse_with_pool(parser, generation, tokenized_string):
+    """
+    Parse with a parser from _acquire_parser(), creating it first if it's
+    None, and return the parser to the pool afterwards.
+    """
+    if parser is None:
+        parser = _create_parser(generation)
+    try:
+        return _parse(parser, tokenized_string)
+    finally:
+        _release_parser(parser, generation)
+
+
+def get_parse_tree(tokenized_string, lexical_parser=None, timeout=None,
+                   max_tokens=None):
+    """
+    Generates a java parse tree from a tokenized string, using a parser from
+    the pool unless lexical_parser is given.
+
+    Raises ParserUnavailable if the string has more than max_tokens tokens,
+    if waiting for a parser and parsing take longer than timeout seconds, or
+    if the parser can't be started.  The defaults are MAX_PARSE_TOKENS and
+    PARSE_TIMEOUT; pass 0 for no limit.  The timeout doesn't include loading
+    the grammar, if this is the first parse (see warm_up()).
     
     >>> import nltk
     >>> raw_input_string = "Two by two, hands of blue."
@@ -32,12 +315,110 @@ def get_parse_tree(tokenized_string, lexical_parser=lexical_parser):
     (NNS [6.958] hands)) (PP [14.189] (IN [0.612] of) (NP [13.150] (NN [11.011]
     blue)))) (. [0.013] .)))
     """
-    # build up the java array
-    stringArray = ArrayList()
-    for word in tokenized_string: stringArray.append(word)
-    # parse and return
-    lexical_parser.parse(stringArray)
-    return lexical_parser.getBestParse()
+    if parser_disabled():
+        raise _unavailable('shed', '%i tokens' % len(tokenized_string))
+    if max_tokens is None:
+        max_tokens = MAX_PARSE_TOKENS
+    if timeout is None:
+        timeout = PARSE_TIMEOUT
+    if max_tokens and len(tokenized_string) > max_tokens:
+        raise _unavailable('too_long', '%i tokens' % len(tokenized_string))
+    if lexical_parser is not None:
+        return _parse(lexical_parser, tokenized_string)
+    if not timeout:
+        (parser, generation) = _acquire_parser()
+        try:
+            return _parse_with_pool(parser, generation, tokenized_string)
+        except Exception, e:
+            raise _unavailable('error', e)
+
+    # Parse in another thread, so that we can stop waiting for it.  A new
+    # parser is created in the thread too, which is quick once the grammar
+    # has been loaded.  If it times out, the thread keeps its parser until
+    # the parse finishes.
+    _load_grammar()
+    deadline = time.time() + timeout
+    (parser, generation) = _acquire_parser(deadline)
+    result = {}
+    finished = threading.Event()
+
+    def parse():
+        calls = get_call_count()
+        try:
+            result['tree'] = _parse_with_pool(parser, generation,
+                                              tokenized_string)
+        except Exception, e:
+            result['error'] = e
+        finally:
+            result['calls'] = get_call_count() - calls
+            finished.set()
+    thread = threading.Thread(target=parse, name='parser')
+    thread.setDaemon(True)
+    thread.start()
+    finished.wait(max(0, deadline - time.time()))
+    if not finished.isSet():
+        raise _unavailable('timeout', '%i tokens' % len(tokenized_string))
+    add_call_count(result['calls'])
+    if 'error' in result:
+        raise _unavailable('error', result['error'])
+    return result['tree']
+
+
+def parse_sentences(sentences, timeout=None, max_tokens=None):
+    """
+    Parse a list of tokenized sentences, concurrently when the parser pool
+    has more than one parser, and return a list of parse trees.  Sentences
+    that couldn't be parsed (see get_parse_tree) have None instead of a tree.
+    The timeout applies to the whole batch, once the grammar has been loaded.
+    """
+    if timeout is None:
+        timeout = PARSE_TIMEOUT
+    if timeout and sentences and not parser_disabled():
+        try:
+            _load_grammar()
+        except ParserUnavailable:
+            return [None] * len(sentences)
+    deadline = timeout and time.time() + timeout
+    trees = [None] * len(sentences)
+    # The fallbacks in, and Py4J calls by, the threads parsing each sentence,
+    # which are recorded for the calling thread afterwards.
+    thread_fallbacks = []
+    thread_calls = []
+
+    def parse(i):
+        remaining = 0
+        if deadline:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                _count_fallback('timeout')
+                return
+        try:
+            trees[i] = get_parse_tree(sentences[i], timeout=remaining,
+                                      max_tokens=max_tokens)
+        except ParserUnavailable:
+            pass
+
+    def parse_in_thread(i):
+        calls = get_call_count()
+        with recording_fallbacks() as reasons:
+            parse(i)
+        thread_fallbacks.extend(reasons)
+        thread_calls.append(get_call_count() - calls)
+    if PARSER_POOL_SIZE == 1 or len(sentences) <= 1:
+        for i in range(len(sentences)):
+            parse(i)
+    else:
+        threads = [threading.Thread(target=parse_in_thread, args=(i,),
+                                    name='parser')
+                   for i in range(len(sentences))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for reason in thread_fallbacks:
+            record_fallback(reason)
+        add_call_count(sum(thread_calls))
+    return trees
 
 def get_nodes_by_type(parse_tree, node_type):
     """
@@ -113,7 +494,7 @@ def extract_subject_nodes(parse_tree):
                     return npNode.getLeaves().iterator()
     return []
                 
-def extract_sentence_type(tokenized_string, lexical_parser=lexical_parser):
+def extract_sentence_type(tokenized_string, lexical_parser=None):
     """
     >>> import nltk
     >>> raw_input_string = "What can I make with carrots?"
@@ -123,15 +504,42 @@ def extract_sentence_type(tokenized_string, lexical_parser=lexical_parser):
     >>> print extract_sentence_type(tokenized_string)
     ('question', u'What')
     """
+    try:
+        tree = get_parse_tree(tokenized_string, lexical_parser)
+    except ParserUnavailable:
+        return extract_sentence_type_from_tokens(tokenized_string)
+    return extract_sentence_type_from_tree(tree)
+
+
+def extract_sentence_type_from_tree(tree):
+    """
+    Returns ('question', question word) if the parse tree contains a question
+    word, otherwise (None, None).
+    """
     question_grammar = ['WRB', 'WP'] #['WHADVP', 'WHNP']
-    
-    tree = get_parse_tree(tokenized_string)
+
     for qg in question_grammar:
         question_nodes = get_nodes_by_type(tree, qg)
         question_node = _iterator_first(question_nodes)
         if question_node: # sentence is a question
             return ('question', question_node.getLeaves()[0].value())
     return (None,None)
+
+
+def extract_sentence_type_from_tokens(tokenized_string):
+    """
+    Token-based version of extract_sentence_type, used when the sentence
+    can't be parsed.
+
+    >>> extract_sentence_type_from_tokens(['What', 'can', 'I', 'make', '?'])
+    ('question', 'What')
+    >>> extract_sentence_type_from_tokens(['I', 'like', 'fish', '.'])
+    (None, None)
+    """
+    for token in tokenized_string:
+        if token.lower() in QUESTION_WORDS:
+            return ('question', token)
+    return (None, None)
     
     
 def extract_junction_node(parse_tree, node):
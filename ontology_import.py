@@ -2,40 +2,85 @@
 Import the ontology into the database.  This should be run before the recipes
 are added to the database, so that ingredients can be properly linked to nodes
 in the ingredient ontology.
+
+Each line of the files in the ontology directory is a tuple of strings giving
+the path from a root of the ontology to a node.  The whole ontology is loaded
+in a single transaction, and nodes that are already in the database are
+skipped, so it's cheap to run this again after editing the ontology files.
 """
-from database import Database, DuplicateOntologyNodeException, OntologyNode
+from ast import literal_eval
+from database import Database, OntologyNode
 from nlu import normalize_ingredient_name
 import os
 import logging
 from optparse import OptionParser
 
 ONTOLOGY_DIR = os.path.join(os.path.dirname(__file__), 'ontology')
-ONTOLOGY_FILENAMES =  os.listdir(ONTOLOGY_DIR)
 
 
 def normalize_ontology_name(name):
     return normalize_ingredient_name(name).replace('_', ' ')
 
 
+def read_ontology_lines(lines, source='<input>'):
+    """
+    Parse lines from an ontology file into tuples of names.  Comments, blank
+    lines, and lines that aren't tuples of strings are skipped.  The names
+    aren't normalized.
+
+    >>> list(read_ontology_lines(["# Fruit", "", "('ingredient', 'Fruit')",
+    ...                           "__import__('os')"]))
+    [('ingredient', 'Fruit')]
+    """
+    for (line_number, line) in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] == '#':
+            logging.warn("Skipping comment: '%s'" % line)
+            continue
+        try:
+            node = literal_eval(line)
+        except (ValueError, SyntaxError):
+            node = None
+        if not isinstance(node, tuple) or not node or \
+                not all(isinstance(x, basestring) for x in node):
+            logging.warn("Skipping invalid line %s:%i: '%s'" %
+                (source, line_number + 1, line))
+            continue
+        yield node
+
+
+def read_ontology(ontology_dir=ONTOLOGY_DIR):
+    """
+    Yield normalized tuples for every node in the ontology files.
+    """
+    for filename in sorted(os.listdir(ontology_dir)):
+        with open(os.path.join(ontology_dir, filename)) as ontology_file:
+            for node in read_ontology_lines(ontology_file, filename):
+                yield tuple(normalize_ontology_name(x) for x in node)
+
+
 def main():
     parser = OptionParser()
     parser.add_option("--database", dest="database_url",
                       default='sqlite:///test_database.sqlite')
+    parser.add_option("--relink", action="store_true", dest="relink",
+        help="relink the ingredients that may match the new nodes")
     (options, args) = parser.parse_args()
     db = Database(options.database_url)
 
-    for filename in ONTOLOGY_FILENAMES:
-        with open(os.path.join(ONTOLOGY_DIR, filename)) as ontology_file:
-            for line in ontology_file:
-                if line.strip()[0] == '#':
-                    logging.warn("Skipping comment: '%s'" % line.strip())
-                    continue
-                node = eval(line)
-                node = [normalize_ontology_name(x) for x in node]
-                try:
-                    db.add_ontology_node(node)
-                except DuplicateOntologyNodeException:
-                    logging.warn("Skipping duplicate node %s" % node)
+    ontology_tuples = list(read_ontology())
+    existing_names = set(name for (name, ) in
+                         db._session.query(OntologyNode.name))
+    added_count = db.bulk_add_ontology_nodes(ontology_tuples)
+    logging.info("Added %i new nodes" % added_count)
+    if options.relink:
+        new_names = set(name for node in ontology_tuples for name in node)
+        coverage = db.relink_ingredients(new_names - existing_names)
+        print "%i of %i ingredients matched before relinking, %i after." % \
+            (coverage['matched_before'], coverage['ingredients'],
+             coverage['matched_after'])
     logging.info("The ontology contains %i nodes" %
         db._session.query(OntologyNode).count())
 
@@ -1,23 +1,203 @@
+import edu.stanford.nlp.parser.lexparser.LexicalizedParser;
+import py4j.DefaultGatewayServerListener;
 import py4j.GatewayServer;
 import java.io.*;
+import java.util.ArrayList;
+import java.util.HashMap;
+import java.util.Iterator;
+import java.util.List;
+import java.util.Map;
 
+/*
+ * Usage:
+ *
+ *     java Py4JServer PORT
+ *     java Py4JServer PORT --daemon PORT_FILE IDLE_TIMEOUT_SECONDS
+ *     java Py4JServer --train GRAMMAR_FILE
+ *
+ * A normal server exits when its standard input is closed, i.e. when the
+ * program that launched it exits.  A daemon server is shared by several
+ * client processes: it writes its port to PORT_FILE so that clients can find
+ * it, and exits once it has had no connections and no live clients for
+ * IDLE_TIMEOUT_SECONDS.  Clients register themselves and send heartbeats; a
+ * client that stops sending heartbeats is forgotten after the idle timeout.
+ *
+ * Clients get parsers from newParser(), which loads each grammar once and
+ * shares it between the parsers of every client, so that only the first
+ * parser takes seconds to create.
+ *
+ * The --train mode starts a server, loads the parser's grammar and parses a
+ * sentence, then exits.  It's used by "ant cds" to record the classes that a
+ * server loads, for the class data sharing archive.
+ */
 public class Py4JServer {
 
+    private long idleTimeoutMillis = 0;
+    private int connectionCount = 0;
+    private long lastActivity = System.currentTimeMillis();
+    /* Maps client ids to the time of their last heartbeat. */
+    private final Map<String, Long> clients = new HashMap<String, Long>();
+    /* Maps grammar files to a parser that has loaded them, whose grammar is
+     * shared by the parsers returned by newParser(). */
+    private final Map<String, LexicalizedParser> grammars =
+        new HashMap<String, LexicalizedParser>();
+
+    /*
+     * Return a new parser for the grammar in grammarFile.  The grammar is
+     * only loaded by the first call for each file, and shared by the parsers.
+     * A parser keeps the state of its last parse, so it must only be used by
+     * one thread at a time.
+     */
+    public LexicalizedParser newParser(String grammarFile) {
+        LexicalizedParser loaded;
+        synchronized (grammars) {
+            loaded = grammars.get(grammarFile);
+            if (loaded == null) {
+                loaded = new LexicalizedParser(grammarFile);
+                grammars.put(grammarFile, loaded);
+            }
+        }
+        return new LexicalizedParser(loaded.parserData());
+    }
+
+    public synchronized void registerClient(String clientId) {
+        clients.put(clientId, new Long(System.currentTimeMillis()));
+        lastActivity = System.currentTimeMillis();
+    }
+
+    public synchronized void heartbeat(String clientId) {
+        registerClient(clientId);
+    }
+
+    public synchronized void unregisterClient(String clientId) {
+        clients.remove(clientId);
+        lastActivity = System.currentTimeMillis();
+    }
+
+    public synchronized int getClientCount() {
+        expireClients();
+        return clients.size();
+    }
+
+    public synchronized int getConnectionCount() {
+        return connectionCount;
+    }
+
+    synchronized void connectionStarted() {
+        connectionCount++;
+        lastActivity = System.currentTimeMillis();
+    }
+
+    synchronized void connectionStopped() {
+        connectionCount--;
+        lastActivity = System.currentTimeMillis();
+    }
+
+    private synchronized void expireClients() {
+        long now = System.currentTimeMillis();
+        Iterator<Map.Entry<String, Long>> entries =
+            clients.entrySet().iterator();
+        while (entries.hasNext()) {
+            Map.Entry<String, Long> entry = entries.next();
+            if (now - entry.getValue().longValue() > idleTimeoutMillis) {
+                entries.remove();
+            }
+        }
+    }
+
+    synchronized boolean isIdle() {
+        expireClients();
+        return connectionCount <= 0 && clients.isEmpty() &&
+            System.currentTimeMillis() - lastActivity > idleTimeoutMillis;
+    }
+
+    private static void writePortFile(String filename, int port)
+            throws IOException {
+        /* Write to a temporary file and rename it, so that clients never see
+         * a partially written port file. */
+        File portFile = new File(filename);
+        File tempFile = new File(filename + ".tmp");
+        PrintWriter writer = new PrintWriter(new FileWriter(tempFile));
+        writer.println(port);
+        writer.close();
+        if (!tempFile.renameTo(portFile)) {
+            portFile.delete();
+            tempFile.renameTo(portFile);
+        }
+    }
+
+    private static void train(String grammarFile) {
+        Py4JServer server = new Py4JServer();
+        GatewayServer gatewayServer = new GatewayServer(server, 0);
+        gatewayServer.start();
+        LexicalizedParser parser = server.newParser(grammarFile);
+        List sentence = new ArrayList();
+        sentence.add("This");
+        sentence.add("is");
+        sentence.add("a");
+        sentence.add("test");
+        sentence.add(".");
+        parser.parse(sentence);
+        System.out.println(parser.getBestParse());
+        gatewayServer.shutdown();
+    }
+
     public static void main(String[] args) {
         int port;
         if (args.length == 0) {
             System.err.println("You must specify a port number.");
             System.exit(1);
         }
+        if (args[0].equals("--train") && args.length >= 2) {
+            train(args[1]);
+            System.exit(0);
+        }
         port = Integer.parseInt(args[0]);
-        GatewayServer gatewayServer = new GatewayServer(new Py4JServer(),
-                                                        port);
+        boolean daemon = args.length >= 4 && args[1].equals("--daemon");
+        final Py4JServer server = new Py4JServer();
+        GatewayServer gatewayServer = new GatewayServer(server, port);
+        gatewayServer.addListener(new DefaultGatewayServerListener() {
+            public void connectionStarted() {
+                server.connectionStarted();
+            }
+
+            public void connectionStopped() {
+                server.connectionStopped();
+            }
+        });
         gatewayServer.start();
         /* Print out the listening port so that clients can discover it. */
         int listening_port = gatewayServer.getListeningPort();
         System.out.println("" + listening_port);
         System.out.println("Py4J Gateway Server started on port " +
             listening_port);
+        System.out.flush();
+
+        if (daemon) {
+            String portFile = args[2];
+            server.idleTimeoutMillis = Long.parseLong(args[3]) * 1000;
+            try {
+                writePortFile(portFile, listening_port);
+                while (!server.isIdle()) {
+                    Thread.sleep(1000);
+                }
+            } catch (Exception e) {
+                e.printStackTrace();
+            }
+            /* Only remove the port file if it still describes this server. */
+            try {
+                BufferedReader reader = new BufferedReader(
+                    new FileReader(portFile));
+                String line = reader.readLine();
+                reader.close();
+                if (line != null &&
+                        line.trim().equals("" + listening_port)) {
+                    new File(portFile).delete();
+                }
+            } catch (IOException e) {
+            }
+            System.exit(0);
+        }
 
         /* Exit on EOF or broken pipe.  This ensures that the server dies if
          * the program that launched the server dies. */
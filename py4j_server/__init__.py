@@ -1,20 +1,287 @@
 """
 Utilities for starting Py4J servers.
+
+The Stanford parser and SimpleNLG share a single JVM per process, obtained
+from get_shared_gateway().  The JVM's command line options can be set with
+configure_jvm() or the PY4J_JVM_OPTIONS environment variable.
+
+If the PY4J_DAEMON environment variable is set, processes connect to a shared,
+long-lived daemon JVM instead of each launching their own.  The daemon is
+found through a port file (PY4J_DAEMON_PORT_FILE) and started by the first
+process that needs it; it exits after PY4J_DAEMON_IDLE_TIMEOUT seconds
+without clients.
+
+The Py4JServer class is compiled by running ``ant`` in this directory.  JVMs
+start faster with a class data sharing archive, built by running ``ant cds``;
+it's used automatically when present.
 """
 import atexit
+import errno
+import fcntl
 import os
 import glob
+import logging
+import shlex
+import socket
+import tempfile
+import threading
+import time
 from subprocess import Popen, PIPE
 from py4j.java_gateway import JavaGateway, GatewayClient, java_import
+from py4j.protocol import Py4JNetworkError
+
+import tracing
 
 
 MODULE_DIR = os.path.dirname(__file__)
 LIB_DIR = os.path.join(MODULE_DIR, 'lib')
 JARS = ':'.join(glob.glob(LIB_DIR + '/*.jar'))
-CLASSPATH = MODULE_DIR + ':' + LIB_DIR + ':' + JARS
+BUILD_DIR = os.path.join(MODULE_DIR, 'build')
+# Py4JServer is compiled by ant into the build directory.
+CLASSPATH = BUILD_DIR + ':' + LIB_DIR + ':' + JARS
+# Class data sharing archive built by "ant cds", and the classpath it was built
+# with, which servers must be launched with for the archive to be used.
+CDS_ARCHIVE = os.path.join(BUILD_DIR, 'py4j_server.jsa')
+CDS_CLASSPATH_FILE = CDS_ARCHIVE + '.classpath'
+USE_CDS = os.environ.get('PY4J_CDS', '1') != '0'
+
+# Extra command line options for the java command, like heap size or garbage
+# collector flags.
+JVM_OPTIONS = shlex.split(os.environ.get('PY4J_JVM_OPTIONS', ''))
+
+# Shared daemon settings.
+USE_DAEMON = os.environ.get('PY4J_DAEMON', '') not in ('', '0')
+DAEMON_PORT_FILE = os.environ.get('PY4J_DAEMON_PORT_FILE',
+    os.path.join(tempfile.gettempdir(), 'py4j-daemon-%i.port' % os.getuid()))
+DAEMON_IDLE_TIMEOUT = int(os.environ.get('PY4J_DAEMON_IDLE_TIMEOUT', 600))
+
+LOG = logging.getLogger('py4j_server')
+
+# The number of calls each thread has made to Java, for tracing.
+_call_counts = threading.local()
+
+
+def configure_jvm(max_heap=None, gc=None, tiered_compilation=None,
+                  extra_options=()):
+    """
+    Set the options used when launching JVMs.  This only affects JVMs that
+    are launched afterwards.
+
+    max_heap: maximum heap size, like '512m' or '2g' (-Xmx).
+    gc: garbage collector, like 'Serial', 'Parallel' or 'G1' (-XX:+Use...GC).
+    tiered_compilation: True or False to enable or disable tiered
+                        compilation, or None to use the JVM's default.
+    extra_options: any other options to pass to the java command.
+
+    >>> configure_jvm(max_heap='1g', gc='Serial', tiered_compilation=False)
+    >>> JVM_OPTIONS
+    ['-Xmx1g', '-XX:+UseSerialGC', '-XX:-TieredCompilation']
+    >>> configure_jvm()
+    """
+    options = []
+    if max_heap:
+        options.append('-Xmx%s' % max_heap)
+    if gc:
+        options.append('-XX:+Use%sGC' % gc)
+    if tiered_compilation is not None:
+        options.append('-XX:%sTieredCompilation' %
+                       (tiered_compilation and '+' or '-'))
+    options.extend(extra_options)
+    JVM_OPTIONS[:] = options
+
+
+def _java_command(jvm_options, args):
+    """
+    Return the command line for running Py4JServer with the given arguments,
+    using the class data sharing archive if it has been built.
+    """
+    if not os.path.exists(os.path.join(BUILD_DIR, 'Py4JServer.class')):
+        raise RuntimeError("Py4JServer hasn't been compiled; run ant in %s"
+                           % MODULE_DIR)
+    if jvm_options is None:
+        jvm_options = JVM_OPTIONS
+    options = list(jvm_options)
+    classpath = CLASSPATH
+    if USE_CDS and os.path.exists(CDS_ARCHIVE):
+        try:
+            with open(CDS_CLASSPATH_FILE) as classpath_file:
+                classpath = classpath_file.read().strip()
+            options += ['-XX:SharedArchiveFile=' + CDS_ARCHIVE, '-Xshare:auto']
+        except IOError:
+            LOG.warn("Not using %s, since %s is missing" %
+                     (CDS_ARCHIVE, CDS_CLASSPATH_FILE))
+    return ["java"] + options + ["-classpath", classpath, "Py4JServer"] + \
+        list(args)
+
+
+def get_call_count():
+    """
+    Return the number of calls the current thread has made through gateways
+    returned by launch_py4j_server() or LazyGateway.
+    """
+    return getattr(_call_counts, 'count', 0)
+
+
+def add_call_count(count):
+    """
+    Add calls made on the current thread's behalf by another thread, like a
+    thread it started to make them, to the current thread's count.
+    """
+    _call_counts.count = getattr(_call_counts, 'count', 0) + count
+
+
+tracing.register_counter('py4j_calls', get_call_count)
+
+
+def _count_calls(gateway):
+    """
+    Make calls through a gateway count towards get_call_count().  Every call
+    to Java, including those made through Java objects returned by earlier
+    calls, is sent by the gateway's client.
+    """
+    client = gateway._gateway_client
+    send_command = client.send_command
+
+    def counted_send_command(*args, **kwargs):
+        _call_counts.count = getattr(_call_counts, 'count', 0) + 1
+        return send_command(*args, **kwargs)
+    client.send_command = counted_send_command
+    return gateway
+
+
+def _start_server(jvm_options=None):
+    """
+    Start a Py4JServer process on an ephemeral port, and return the process
+    and the port it's listening on.
+    """
+    # Launch the server on an ephemeral in a subprocess.
+    process = Popen(_java_command(jvm_options, ["0"]),
+                    stdout=PIPE, stdin=PIPE)
+
+    # Determine which ephemeral port the server started on.
+    port = int(process.stdout.readline())
+
+    # Configure the subprocess to be killed when the program exits.
+    def kill():
+        if process.poll() is None:
+            process.kill()
+    atexit.register(kill)
+    return (process, port)
+
+
+def _start_daemon(jvm_options=None, port_file=DAEMON_PORT_FILE,
+                  idle_timeout=DAEMON_IDLE_TIMEOUT):
+    """
+    Start a daemon Py4JServer process that outlives this process, and return
+    the port it's listening on.  The daemon writes its port to port_file and
+    exits after idle_timeout seconds without clients.
+    """
+    devnull = open(os.devnull, 'r+')
+    # Run the daemon in its own session, so that it doesn't receive signals
+    # meant for this process (like ^C).
+    process = Popen(_java_command(jvm_options, ["0", "--daemon", port_file,
+                                                str(idle_timeout)]),
+                    stdout=PIPE, stdin=devnull, stderr=devnull,
+                    close_fds=True, preexec_fn=os.setsid)
+    devnull.close()
+    port = int(process.stdout.readline())
+    process.stdout.close()
+    return port
+
+
+def _read_port_file(port_file):
+    """
+    Return the port in a daemon's port file, or None if there isn't one.
+    """
+    try:
+        with open(port_file) as port_file_obj:
+            return int(port_file_obj.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def _client_id():
+    return '%s:%i' % (socket.gethostname(), os.getpid())
 
 
-def launch_py4j_server():
+def _register_with_daemon(port):
+    """
+    Connect to the daemon on a port and register this process as a client.
+    Returns the gateway, or None if no daemon is listening on the port.
+    """
+    gateway = JavaGateway(GatewayClient(port=port))
+    client_id = _client_id()
+    try:
+        gateway.entry_point.registerClient(client_id)
+    except Exception, e:
+        LOG.info("No Py4J daemon on port %i (%s)" % (port, e))
+        return None
+    _start_heartbeat(gateway, client_id)
+
+    def unregister():
+        try:
+            gateway.entry_point.unregisterClient(client_id)
+        except Exception:
+            pass
+    atexit.register(unregister)
+    return gateway
+
+
+def _start_heartbeat(gateway, client_id, interval=None):
+    """
+    Start a background thread that tells the daemon this client is still
+    alive.  The thread stops when the daemon stops answering.
+    """
+    if interval is None:
+        interval = max(1, DAEMON_IDLE_TIMEOUT // 3)
+
+    def heartbeat():
+        while True:
+            time.sleep(interval)
+            try:
+                gateway.entry_point.heartbeat(client_id)
+            except Exception:
+                return
+    thread = threading.Thread(target=heartbeat, name='py4j-heartbeat')
+    thread.setDaemon(True)
+    thread.start()
+
+
+def connect_to_daemon(jvm_options=None, port_file=DAEMON_PORT_FILE,
+                      idle_timeout=DAEMON_IDLE_TIMEOUT):
+    """
+    Return a gateway connected to the shared daemon described by port_file,
+    starting the daemon if it isn't running.  A lock file keeps processes
+    that start at the same time from launching several daemons.  The daemon
+    keeps running after this process exits, until it's been idle for
+    idle_timeout seconds.
+    """
+    lock_file = open(port_file + '.lock', 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        port = _read_port_file(port_file)
+        if port is not None:
+            gateway = _register_with_daemon(port)
+            if gateway is not None:
+                return gateway
+            try:
+                os.remove(port_file)  # Stale; the daemon is gone.
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+        port = _start_daemon(jvm_options, port_file, idle_timeout)
+        LOG.info("Started Py4J daemon on port %i" % port)
+        gateway = _register_with_daemon(port)
+        if gateway is None:
+            raise RuntimeError("Couldn't connect to the Py4J daemon that "
+                               "was just started on port %i" % port)
+        return gateway
+    finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def launch_py4j_server(jvm_options=None, use_daemon=None):
     """
     Launch a py4j server process on an ephemeral port.  Returns a Py4J gateway
     connected to the server.  The server is configured to shut down when the
@@ -22,20 +289,234 @@ def launch_py4j_server():
     project, giving the server access to the Java libraries bundled with the
     project.
 
+    If use_daemon is True (by default, if the PY4J_DAEMON environment
+    variable is set), this connects to the shared daemon instead; see
+    connect_to_daemon().
+
+    Most code should use get_shared_gateway() instead, so that the process
+    only runs one JVM.
+
     >>> gateway = launch_py4j_server()
     >>> gateway.jvm #doctest +ELLIPSIS
     <py4j.java_gateway.JVMView object at 0x...>
     """
-    # Launch the server on an ephemeral in a subprocess.
-    _pid = Popen(["java", "-classpath", CLASSPATH, "Py4JServer", "0"],
-        stdout=PIPE, stdin=PIPE)
+    if use_daemon is None:
+        use_daemon = USE_DAEMON
+    if use_daemon:
+        return _count_calls(connect_to_daemon(jvm_options))
+    (_, port) = _start_server(jvm_options)
+    # Setup the gateway.
+    gateway = JavaGateway(GatewayClient(port=port))
+    return _count_calls(gateway)
 
-    # Determine which ephemeral port the server started on.
-    _port = int(_pid.stdout.readline())
 
-    # Configure the subprocess to be killed when the program exits.
-    atexit.register(_pid.kill)
+class LazyGateway(object):
+    """
+    A Py4J gateway whose server isn't launched until it's first used, so that
+    importing a module that talks to Java doesn't start a JVM.  The server is
+    launched at most once, even if several threads use the gateway at the same
+    time.  If the server dies, it's relaunched the next time the gateway is
+    used; code that keeps Java objects around can compare the generation
+    attribute to find out whether they belong to an earlier server.
 
-    # Setup the gateway.
-    gateway = JavaGateway(GatewayClient(port=_port))
+    When using the shared daemon, there's no local process to watch, so a
+    dead daemon is noticed when a call fails to reach it, which runs
+    check_health().  The failed call still raises its error.
+
+    >>> gateway = LazyGateway(["java.util.*"])
+    >>> gateway.is_running()
+    False
+    >>> ArrayList = gateway.java_class("ArrayList")
+    >>> gateway.is_running()
+    False
+    >>> ArrayList().size()
+    0
+    >>> gateway.is_running()
+    True
+    >>> gateway.check_health()
+    True
+    """
+
+    def __init__(self, java_imports=(), use_daemon=None):
+        """
+        Create a gateway that will import the given Java packages or classes
+        (e.g. "java.util.*") into its JVM view when it's launched.  If
+        use_daemon is None, the PY4J_DAEMON environment variable decides
+        whether to connect to the shared daemon.
+        """
+        self._java_imports = list(java_imports)
+        self._use_daemon = use_daemon
+        self._gateway = None
+        self._process = None
+        self._lock = threading.RLock()
+        # Whether this thread is running check_health() after a failed call.
+        self._checking = threading.local()
+        # The number of times the server has been launched.
+        self.generation = 0
+
+    def _launch(self):
+        """
+        Launch the server.  The caller must hold the lock.
+        """
+        use_daemon = self._use_daemon
+        if use_daemon is None:
+            use_daemon = USE_DAEMON
+        if use_daemon:
+            self._process = None
+            gateway = connect_to_daemon()
+        else:
+            (self._process, port) = _start_server()
+            gateway = JavaGateway(GatewayClient(port=port))
+        for java_import_name in self._java_imports:
+            java_import(gateway.jvm, java_import_name)
+        self._gateway = self._check_on_errors(_count_calls(gateway))
+        self.generation += 1
+
+    def _check_on_errors(self, gateway):
+        """
+        Make calls through the gateway that can't reach the server run
+        check_health(), so that a dead server is relaunched for later calls.
+        """
+        client = gateway._gateway_client
+        send_command = client.send_command
+
+        def checked_send_command(*args, **kwargs):
+            try:
+                return send_command(*args, **kwargs)
+            except (Py4JNetworkError, socket.error):
+                # check_health() makes a call too, which may fail the same way.
+                if not getattr(self._checking, 'active', False):
+                    self._checking.active = True
+                    try:
+                        self.check_health()
+                    finally:
+                        self._checking.active = False
+                raise
+        client.send_command = checked_send_command
+        return gateway
+
+    def _is_process_alive(self):
+        if self._process is None:
+            # Connected to the daemon, or not launched yet.
+            return self._gateway is not None
+        return self._process.poll() is None
+
+    def get(self):
+        """
+        Return the underlying JavaGateway, launching the server if it hasn't
+        been launched or if it has died.
+        """
+        if self._gateway is None or not self._is_process_alive():
+            with self._lock:
+                if self._gateway is None:
+                    self._launch()
+                elif not self._is_process_alive():
+                    LOG.warn("Py4J server exited with status %s; relaunching"
+                             % self._process.returncode)
+                    self._launch()
+        return self._gateway
+
+    def add_java_imports(self, java_imports):
+        """
+        Import more Java packages or classes into the gateway's JVM view.
+        """
+        with self._lock:
+            for java_import_name in java_imports:
+                if java_import_name in self._java_imports:
+                    continue
+                self._java_imports.append(java_import_name)
+                if self._gateway is not None:
+                    java_import(self._gateway.jvm, java_import_name)
+
+    def is_running(self):
+        """
+        Return True if the server has been launched and is still running.
+        """
+        return self._gateway is not None and self._is_process_alive()
+
+    def check_health(self):
+        """
+        Make a trivial call to the server, and relaunch it if the call fails.
+        Returns True if the server was healthy (or hasn't been launched yet),
+        False if it had to be relaunched.
+        """
+        if self._gateway is None:
+            return True
+        generation = self.generation
+        try:
+            self.get().jvm.java.lang.System.currentTimeMillis()
+            return True
+        except Exception, e:
+            LOG.warn("Py4J server health check failed (%s); relaunching" % e)
+        with self._lock:
+            if self.generation != generation:
+                # Another thread has relaunched it already.
+                return False
+            if self._process is not None and self._process.poll() is None:
+                self._process.kill()
+            self._launch()
+        return False
+
+    @property
+    def jvm(self):
+        """
+        The JVM view of the underlying gateway.
+        """
+        return self.get().jvm
+
+    def java_class(self, name):
+        """
+        Return a stand-in for the Java class with the given name, which can
+        be called and have its static members accessed like the class itself.
+        The gateway is launched the first time the stand-in is used.
+        """
+        return LazyJavaClass(self, name)
+
+
+class LazyJavaClass(object):
+    """
+    Stand-in for a Java class accessed through a LazyGateway.  The class is
+    looked up on every use, so it keeps working after the server is
+    relaunched.
+    """
+
+    def __init__(self, gateway, name):
+        self._gateway = gateway
+        self._name = name
+
+    def _java_class(self):
+        return getattr(self._gateway.jvm, self._name)
+
+    def __call__(self, *args):
+        return self._java_class()(*args)
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self._java_class(), name)
+
+    def __repr__(self):
+        return "<LazyJavaClass(%s)>" % self._name
+
+
+_shared_gateways = {}
+_shared_gateways_lock = threading.Lock()
+
+
+def get_shared_gateway(java_imports=(), name='default'):
+    """
+    Return the process-wide LazyGateway with the given name, after adding
+    java_imports to its JVM view.  Every module that needs Java should use
+    this, so that the parser and the realiser share one JVM.
+
+    >>> nlu_gateway = get_shared_gateway(["java.util.*"])
+    >>> nlg_gateway = get_shared_gateway(["java.io.*"])
+    >>> nlu_gateway is nlg_gateway
+    True
+    """
+    with _shared_gateways_lock:
+        if name not in _shared_gateways:
+            _shared_gateways[name] = LazyGateway()
+        gateway = _shared_gateways[name]
+    gateway.add_java_imports(java_imports)
     return gateway
@@ -0,0 +1,135 @@
+"""
+A cache of the chatbot's responses to the messages that open conversations.
+
+In the start state, what the dialogue manager plans in response to a message
+only depends on the message, the dialogue state and the contents of the
+database, and many conversations open with the same messages ("hi", "I want
+chicken").  The cache maps (normalized message, fingerprint of the state) to
+the content plans that were planned and the dialogue state that followed, so
+that repeats don't have to be parsed or searched for.  The plans are still
+realised for every response, so the wording varies as usual.
+
+The cache is cleared when the database's recipes, ingredients or ontology, or
+the wordlists, change.  These are checked at most every
+CHATBOT_RESPONSE_CACHE_REFRESH seconds.
+
+>>> class FakeDatabase(object):
+...     generation = 1
+...     def get_generation(self):
+...         return self.generation
+>>> db = FakeDatabase()
+>>> cache = ResponseCache(db, refresh_interval=0)
+>>> cache.put('I want  chicken', 'start', ['plan'], {'query': {}})
+>>> cache.get('I want chicken ', 'start')
+(['plan'], {'query': {}})
+>>> db.generation = 2
+>>> cache.get('I want chicken', 'start') is None
+True
+"""
+from copy import deepcopy
+import collections
+import os
+import threading
+import time
+
+import wordlists
+
+# The maximum number of cached responses; 0 disables the cache.
+RESPONSE_CACHE_SIZE = int(os.environ.get('CHATBOT_RESPONSE_CACHE_SIZE', 1000))
+# How often, in seconds, the database and wordlists are checked for changes.
+REFRESH_INTERVAL = float(os.environ.get('CHATBOT_RESPONSE_CACHE_REFRESH', 60))
+
+
+def normalize_input(user_input):
+    """
+    Normalize the whitespace in a message.  Case and punctuation are kept,
+    since the parser depends on them.
+
+    >>> normalize_input('  I want\\tchicken  ')
+    'I want chicken'
+    """
+    return ' '.join(user_input.split())
+
+
+class ResponseCache(object):
+    """
+    A bounded cache of content plans and the dialogue states that follow
+    them, shared by every conversation using a database.  The oldest
+    responses are evicted first.
+    """
+
+    def __init__(self, db, size=RESPONSE_CACHE_SIZE,
+                 refresh_interval=REFRESH_INTERVAL, clock=time.time):
+        self.db = db
+        self.size = size
+        self.refresh_interval = refresh_interval
+        self._clock = clock
+        self._entries = {}
+        self._order = collections.deque()
+        self._generation = None
+        self._last_refresh = None
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        """
+        Clear the cache if the database or wordlists have changed.  The
+        caller must hold the lock.
+        """
+        now = self._clock()
+        if self._last_refresh is not None and \
+                now - self._last_refresh < self.refresh_interval:
+            return
+        wordlists.refresh()
+        generation = (self.db.get_generation(), wordlists.generation)
+        if generation != self._generation:
+            self._entries.clear()
+            self._order.clear()
+            self._generation = generation
+        self._last_refresh = now
+
+    def get(self, user_input, fingerprint):
+        """
+        Return (content plans, dialogue state dictionary) for a message sent
+        in a state with the given fingerprint, or None if they aren't cached.
+        """
+        if not self.size:
+            return None
+        key = (normalize_input(user_input), fingerprint)
+        with self._lock:
+            self._refresh()
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+        return deepcopy(entry)
+
+    def put(self, user_input, fingerprint, content_plans, dialogue):
+        """
+        Cache the content plans planned in response to a message, and the
+        dictionary of the dialogue state that followed.
+        """
+        if not self.size:
+            return
+        key = (normalize_input(user_input), fingerprint)
+        entry = deepcopy((content_plans, dialogue))
+        with self._lock:
+            self._refresh()
+            if key not in self._entries:
+                self._order.append(key)
+            self._entries[key] = entry
+            while len(self._order) > self.size:
+                del self._entries[self._order.popleft()]
+
+    def get_metrics(self):
+        """
+        Return the numbers of cached responses, hits and misses.
+        """
+        with self._lock:
+            return {
+                'responses': len(self._entries),
+                'hits': self._hits,
+                'misses': self._misses,
+            }
@@ -0,0 +1,641 @@
+"""
+Stores for the per-session state of the web chat server.
+
+A session store maps session ids to state objects.  MemorySessionStore keeps
+them in memory, evicting sessions that have been idle for longer than a time
+to live, and the least recently used sessions when there are too many of
+them or they take up too much memory.  Expired sessions are also swept away
+by a background thread.
+
+To share sessions between processes, such as several pre-forked web server
+workers, SQLiteSessionStore keeps them in an SQLite database file, and
+SocketSessionStore keeps them in a MemorySessionStore served to every process
+over a local socket by start_session_store_server().
+
+Every store keeps the states serialized, with cPickle by default, so get()
+returns a copy of a state, and changes to it are only kept once it's put()
+back.  If answering a message fails part of the way through, not putting the
+state back leaves the session as it was.
+
+A session's messages are answered one at a time, even by different threads
+or processes, by holding the session's lock while its state is loaded,
+changed and saved.  Locks are leases, which expire after a while in case
+their holder has died.
+
+>>> clock = [0]
+>>> store = MemorySessionStore(ttl=60, max_sessions=2, sweep_interval=None,
+...                            clock=lambda: clock[0])
+>>> store.put('a', 'state a')
+>>> store.put('b', 'state b')
+>>> clock[0] = 1
+>>> store.get('a')
+'state a'
+>>> store.put('d', {'query': {}})
+>>> store.get('d')['query']['include_cuisines'] = ['Thai']
+>>> store.get('d')
+{'query': {}}
+>>> store.delete('d')
+>>> store.put('c', 'state c')
+>>> store.get('b') is None
+True
+>>> clock[0] = 62
+>>> store.sweep()
+2
+>>> metrics = store.get_metrics()
+>>> metrics['live_sessions'], sorted(metrics['evictions'].items())
+(0, [('bytes', 0), ('count', 1), ('expired', 2)])
+>>> token = store.lock('a')
+>>> store.lock('a', timeout=0)
+Traceback (most recent call last):
+    ...
+SessionBusy: Session a is busy
+>>> store.unlock('a', token)
+>>> with store.locked('a'):
+...     store.put('a', 'state a')
+"""
+import cPickle
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+import uuid
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+
+# Sessions idle for longer than this many seconds are evicted.
+SESSION_TTL = float(os.environ.get('CHATBOT_SESSION_TTL', 1800))
+# The maximum number of live sessions.
+MAX_SESSIONS = int(os.environ.get('CHATBOT_MAX_SESSIONS', 1000))
+# The maximum approximate size in bytes of all live sessions.
+MAX_SESSION_BYTES = int(os.environ.get('CHATBOT_MAX_SESSION_BYTES',
+                                       256 * 1024 * 1024))
+# How often, in seconds, expired sessions are swept away.
+SWEEP_INTERVAL = float(os.environ.get('CHATBOT_SESSION_SWEEP_INTERVAL', 60))
+# How long, in seconds, to wait for a session's lock.
+LOCK_TIMEOUT = float(os.environ.get('CHATBOT_SESSION_LOCK_TIMEOUT', 10))
+# How long, in seconds, a session's lock is held before it expires.
+LOCK_LEASE = float(os.environ.get('CHATBOT_SESSION_LOCK_LEASE', 60))
+# The local socket where start_session_store_server() serves sessions.
+SOCKET_ADDRESS = os.environ.get('CHATBOT_SESSION_SOCKET',
+    os.path.join(tempfile.gettempdir(),
+                 'chatbot-sessions-%d.sock' % os.getuid()))
+
+# Objects of these types are shared, so they don't count towards the size of
+# a session.
+_SHARED_TYPES = (type, types.ModuleType, types.FunctionType,
+                 types.BuiltinFunctionType, types.MethodType,
+                 logging.Logger, type(threading.Lock()))
+
+# How often, in seconds, SQLiteSessionStore checks whether a lock is free.
+_LOCK_POLL_INTERVAL = 0.01
+
+
+class SessionBusy(Exception):
+    """
+    Raised when a session's lock isn't acquired in time, because other
+    messages for the session are being answered.  The client should retry
+    after retry_after seconds.
+    """
+    retry_after = 1
+
+
+def approximate_size(obj, shared=(), max_objects=20000):
+    """
+    Return the approximate number of bytes used by an object and the objects
+    that it refers to through attributes, slots and containers, not counting the
+    objects in shared.  At most max_objects objects are counted.
+
+    >>> approximate_size([]) < approximate_size(['a' * 1000])
+    True
+    >>> big = 'a' * 1000
+    >>> approximate_size([big], shared=[big]) < 1000
+    True
+    """
+    seen = set(id(o) for o in shared)
+    stack = [obj]
+    size = 0
+    while stack and len(seen) < max_objects:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        try:
+            size += sys.getsizeof(obj)
+        except TypeError:
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for slot in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, slot):
+                stack.append(getattr(obj, slot))
+    return size
+
+
+class SessionStore(object):
+    """
+    Interface of the session stores.
+    """
+
+    def get(self, session_id):
+        """
+        Return the state of a session, or None if the session doesn't exist
+        or has expired.
+        """
+        raise NotImplementedError
+
+    def put(self, session_id, state):
+        """
+        Store the state of a session.
+        """
+        raise NotImplementedError
+
+    def delete(self, session_id):
+        """
+        Remove a session, if it exists.
+        """
+        raise NotImplementedError
+
+    def lock(self, session_id, timeout=LOCK_TIMEOUT, lease=LOCK_LEASE):
+        """
+        Acquire the session's lock, waiting for up to timeout seconds, and
+        return a token for unlock().  The lock expires after lease seconds if
+        it isn't released.  Raise SessionBusy if the lock isn't acquired in
+        time.
+        """
+        raise NotImplementedError
+
+    def unlock(self, session_id, token):
+        """
+        Release the session's lock, unless it has expired and been acquired
+        by someone else since.
+        """
+        raise NotImplementedError
+
+    @contextmanager
+    def locked(self, session_id):
+        """
+        Context manager that holds the session's lock.
+        """
+        token = self.lock(session_id)
+        try:
+            yield
+        finally:
+            self.unlock(session_id, token)
+
+    def sweep(self):
+        """
+        Remove expired sessions, returning the number removed.
+        """
+        return 0
+
+    def get_metrics(self):
+        """
+        Return a dictionary of metrics about the store.
+        """
+        return {}
+
+    def close(self):
+        """
+        Release the store's resources.
+        """
+        if getattr(self, '_closed', None) is not None:
+            self._closed.set()
+
+    def _start_sweeping(self, interval):
+        """
+        Start a background thread that calls sweep() every interval seconds
+        until the store is closed.
+        """
+        self._closed = threading.Event()
+        sweeper = threading.Thread(target=self._sweep_forever,
+                                   args=(interval, ))
+        sweeper.setDaemon(True)
+        sweeper.start()
+
+    def _sweep_forever(self, interval):
+        while not self._closed.isSet():
+            self._closed.wait(interval)
+            if self._closed.isSet():
+                break
+            try:
+                expired = self.sweep()
+            except Exception:
+                self.log.exception("Error while sweeping sessions")
+                continue
+            self.log.debug("Swept %d expired sessions: %s"
+                           % (expired, self.get_metrics()))
+
+
+def _encode(state):
+    return cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL)
+
+
+def _decode(data):
+    return cPickle.loads(data)
+
+
+class _Entry(object):
+    __slots__ = ('state', 'size', 'last_access')
+
+    def __init__(self, state, size, last_access):
+        self.state = state
+        self.size = size
+        self.last_access = last_access
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Keeps serialized sessions in memory, with an idle time to live and
+    limits on the number of sessions and their approximate size.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS,
+                 max_bytes=MAX_SESSION_BYTES, sweep_interval=SWEEP_INTERVAL,
+                 sizeof=approximate_size, clock=time.time, logger=None,
+                 encode=_encode, decode=_decode):
+        """
+        Create a store.  Sessions are evicted once they have been idle for
+        ttl seconds, or when there are more than max_sessions sessions or
+        they take up more than max_bytes bytes, as measured by sizeof.  A
+        background thread sweeps away expired sessions every sweep_interval
+        seconds, unless sweep_interval is None.  States are serialized with
+        encode, and deserialized with decode whenever they're read, so that
+        callers never share them.
+        """
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._encode = encode
+        self._decode = decode
+        self._clock = clock
+        self.log = logger or logging.getLogger('session_store')
+        self._entries = {}
+        self._bytes = 0
+        self._lock = threading.RLock()
+        # Maps the ids of locked sessions to their tokens and expiry times.
+        self._session_locks = {}
+        self._unlocked = threading.Condition(self._lock)
+        self._evictions = {'expired': 0, 'count': 0, 'bytes': 0}
+        self._hits = 0
+        self._misses = 0
+        if sweep_interval:
+            self._start_sweeping(sweep_interval)
+
+    def _remove(self, session_id, reason=None):
+        entry = self._entries.pop(session_id)
+        self._bytes -= entry.size
+        if reason:
+            self._evictions[reason] += 1
+
+    def _is_expired(self, entry, now):
+        return now - entry.last_access > self.ttl
+
+    def get(self, session_id):
+        with self._lock:
+            entry = self._entries.get(session_id)
+            now = self._clock()
+            if entry is not None and self._is_expired(entry, now):
+                self._remove(session_id, 'expired')
+                entry = None
+            if entry is None:
+                self._misses += 1
+                return None
+            self._hits += 1
+            entry.last_access = now
+            data = entry.state
+        return self._decode(data)
+
+    def put(self, session_id, state):
+        data = self._encode(state)
+        size = self._sizeof(data)
+        with self._lock:
+            if session_id in self._entries:
+                self._remove(session_id)
+            self._entries[session_id] = _Entry(data, size, self._clock())
+            self._bytes += size
+            self._evict_least_recently_used(session_id)
+
+    def _evict_least_recently_used(self, keep):
+        """
+        Evict the least recently used sessions, other than keep, until the
+        store is within its limits.
+        """
+        while len(self._entries) > 1:
+            if len(self._entries) > self.max_sessions:
+                reason = 'count'
+            elif self._bytes > self.max_bytes:
+                reason = 'bytes'
+            else:
+                break
+            oldest = min((entry.last_access, session_id)
+                         for session_id, entry in self._entries.iteritems()
+                         if session_id != keep)[1]
+            self._remove(oldest, reason)
+
+    def delete(self, session_id):
+        with self._lock:
+            if session_id in self._entries:
+                self._remove(session_id)
+
+    def lock(self, session_id, timeout=LOCK_TIMEOUT, lease=LOCK_LEASE):
+        token = uuid.uuid4().hex
+        deadline = time.time() + timeout
+        with self._lock:
+            while True:
+                now = time.time()
+                held = self._session_locks.get(session_id)
+                if held is None or held[1] <= now:
+                    self._session_locks[session_id] = (token, now + lease)
+                    return token
+                if now >= deadline:
+                    raise SessionBusy("Session %s is busy" % session_id)
+                self._unlocked.wait(min(deadline, held[1]) - now)
+
+    def unlock(self, session_id, token):
+        with self._lock:
+            held = self._session_locks.get(session_id)
+            if held is not None and held[0] == token:
+                del self._session_locks[session_id]
+                self._unlocked.notify_all()
+
+    def sweep(self):
+        with self._lock:
+            now = time.time()
+            for session_id, (_, expires) in self._session_locks.items():
+                if expires <= now:
+                    del self._session_locks[session_id]
+            now = self._clock()
+            expired = [session_id
+                       for session_id, entry in self._entries.iteritems()
+                       if self._is_expired(entry, now)]
+            for session_id in expired:
+                self._remove(session_id, 'expired')
+            return len(expired)
+
+    def get_metrics(self):
+        """
+        Return the number of live sessions, their approximate size in bytes,
+        the numbers of sessions evicted because they expired or to stay
+        within the count and bytes limits, and the numbers of lookups that
+        did and didn't find a session.
+        """
+        with self._lock:
+            return {
+                'live_sessions': len(self._entries),
+                'bytes': self._bytes,
+                'evictions': dict(self._evictions),
+                'hits': self._hits,
+                'misses': self._misses,
+            }
+
+    def close(self):
+        SessionStore.close(self)
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Keeps serialized sessions in an SQLite database file, which can be
+    shared by several processes.  Sessions that have been idle for ttl
+    seconds are evicted, and so are the least recently used sessions when
+    there are more than max_sessions.  Evictions are counted by each process
+    separately.
+
+    >>> store = SQLiteSessionStore(':memory:', max_sessions=1,
+    ...                            sweep_interval=None)
+    >>> store.put('a', {'query': {}})
+    >>> store.get('a')
+    {'query': {}}
+    >>> store.put('b', {'query': {'include_cuisines': ['Thai']}})
+    >>> store.get('a') is None
+    True
+    >>> store.get_metrics()['live_sessions']
+    1
+    >>> token = store.lock('b')
+    >>> store.lock('b', timeout=0)
+    Traceback (most recent call last):
+        ...
+    SessionBusy: Session b is busy
+    >>> store.unlock('b', token)
+    """
+
+    def __init__(self, filename, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS,
+                 sweep_interval=SWEEP_INTERVAL, encode=_encode,
+                 decode=_decode, clock=time.time, logger=None):
+        """
+        Create a store in an SQLite database file.  States are serialized
+        with encode, which returns a string, and deserialized with decode.
+        """
+        self.filename = filename
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._encode = encode
+        self._decode = decode
+        self._clock = clock
+        self.log = logger or logging.getLogger('session_store')
+        self._local = threading.local()
+        self._evictions = {'expired': 0, 'count': 0, 'bytes': 0}
+        self._hits = 0
+        self._misses = 0
+        connection = self._connection()
+        connection.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                           "id TEXT PRIMARY KEY, state BLOB NOT NULL, "
+                           "last_access REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS sessions_last_access "
+                           "ON sessions (last_access)")
+        connection.execute("CREATE TABLE IF NOT EXISTS session_locks ("
+                           "id TEXT PRIMARY KEY, token TEXT NOT NULL, "
+                           "expires REAL NOT NULL)")
+        if sweep_interval:
+            self._start_sweeping(sweep_interval)
+
+    def _connection(self):
+        """
+        Return this thread's connection to the database.  Connections aren't
+        shared by threads, or by processes forked after they were opened.
+        """
+        pid, connection = getattr(self._local, 'connection', (None, None))
+        if pid != os.getpid():
+            connection = sqlite3.connect(self.filename, timeout=30,
+                                         isolation_level=None)
+            self._local.connection = (os.getpid(), connection)
+        return connection
+
+    def get(self, session_id):
+        connection = self._connection()
+        row = connection.execute("SELECT state, last_access FROM sessions "
+                                 "WHERE id = ?", (session_id, )).fetchone()
+        now = self._clock()
+        if row is not None and now - row[1] > self.ttl:
+            connection.execute("DELETE FROM sessions WHERE id = ?",
+                               (session_id, ))
+            self._evictions['expired'] += 1
+            row = None
+        if row is None:
+            self._misses += 1
+            return None
+        self._hits += 1
+        connection.execute("UPDATE sessions SET last_access = ? WHERE id = ?",
+                           (now, session_id))
+        return self._decode(str(row[0]))
+
+    def put(self, session_id, state):
+        data = sqlite3.Binary(self._encode(state))
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO sessions "
+                           "(id, state, last_access) VALUES (?, ?, ?)",
+                           (session_id, data, self._clock()))
+        count = connection.execute("SELECT COUNT(*) FROM sessions"
+                                   ).fetchone()[0]
+        if count > self.max_sessions:
+            cursor = connection.execute("DELETE FROM sessions WHERE id IN ("
+                "SELECT id FROM sessions WHERE id != ? "
+                "ORDER BY last_access LIMIT ?)",
+                (session_id, count - self.max_sessions))
+            self._evictions['count'] += cursor.rowcount
+
+    def delete(self, session_id):
+        self._connection().execute("DELETE FROM sessions WHERE id = ?",
+                                   (session_id, ))
+
+    def lock(self, session_id, timeout=LOCK_TIMEOUT, lease=LOCK_LEASE):
+        """
+        Acquire the session's lock, polling the database until it's free.
+        """
+        connection = self._connection()
+        token = uuid.uuid4().hex
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            connection.execute("DELETE FROM session_locks "
+                               "WHERE id = ? AND expires <= ?",
+                               (session_id, now))
+            try:
+                connection.execute("INSERT INTO session_locks "
+                                   "(id, token, expires) VALUES (?, ?, ?)",
+                                   (session_id, token, now + lease))
+                return token
+            except sqlite3.IntegrityError:
+                if now >= deadline:
+                    raise SessionBusy("Session %s is busy" % session_id)
+                time.sleep(_LOCK_POLL_INTERVAL)
+
+    def unlock(self, session_id, token):
+        self._connection().execute("DELETE FROM session_locks "
+                                   "WHERE id = ? AND token = ?",
+                                   (session_id, token))
+
+    def sweep(self):
+        self._connection().execute("DELETE FROM session_locks "
+                                   "WHERE expires <= ?", (time.time(), ))
+        cursor = self._connection().execute(
+            "DELETE FROM sessions WHERE last_access < ?",
+            (self._clock() - self.ttl, ))
+        self._evictions['expired'] += cursor.rowcount
+        return cursor.rowcount
+
+    def get_metrics(self):
+        """
+        Return the number of live sessions and their size in bytes, and this
+        process's numbers of evictions and of lookups that did and didn't
+        find a session.
+        """
+        count, size = self._connection().execute(
+            "SELECT COUNT(*), SUM(LENGTH(state)) FROM sessions").fetchone()
+        return {
+            'live_sessions': count,
+            'bytes': size or 0,
+            'evictions': dict(self._evictions),
+            'hits': self._hits,
+            'misses': self._misses,
+        }
+
+
+class SessionStoreManager(BaseManager):
+    """
+    Serves a MemorySessionStore to other processes over a local socket.
+    """
+
+
+_served_store = None
+
+
+def _get_served_store():
+    global _served_store
+    if _served_store is None:
+        # The clients send serialized states already.
+        _served_store = MemorySessionStore(encode=str, decode=str)
+    return _served_store
+
+SessionStoreManager.register('get_store', callable=_get_served_store)
+
+
+def start_session_store_server(address=SOCKET_ADDRESS, authkey=None):
+    """
+    Start a process that serves a MemorySessionStore on a local socket, and
+    return its SessionStoreManager; call the manager's shutdown() method to
+    stop it.  The processes using it must have the same authkey, which
+    defaults to the authkey of the current process and of processes forked
+    from it.
+    """
+    if os.path.exists(address):
+        # Left behind by a server that didn't shut down.
+        os.unlink(address)
+    manager = SessionStoreManager(address=address, authkey=authkey)
+    manager.start()
+    return manager
+
+
+class SocketSessionStore(SessionStore):
+    """
+    Keeps serialized sessions in the MemorySessionStore served by
+    start_session_store_server(), so that several processes share them.
+    """
+
+    def __init__(self, address=SOCKET_ADDRESS, authkey=None, encode=_encode,
+                 decode=_decode):
+        """
+        Connect to the store served at address.  States are serialized with
+        encode, which returns a string, and deserialized with decode.
+        """
+        manager = SessionStoreManager(address=address, authkey=authkey)
+        manager.connect()
+        self._store = manager.get_store()
+        self._encode = encode
+        self._decode = decode
+
+    def get(self, session_id):
+        data = self._store.get(session_id)
+        if data is None:
+            return None
+        return self._decode(data)
+
+    def put(self, session_id, state):
+        self._store.put(session_id, self._encode(state))
+
+    def delete(self, session_id):
+        self._store.delete(session_id)
+
+    def lock(self, session_id, timeout=LOCK_TIMEOUT, lease=LOCK_LEASE):
+        return self._store.lock(session_id, timeout, lease)
+
+    def unlock(self, session_id, token):
+        self._store.unlock(session_id, token)
+
+    def sweep(self):
+        return self._store.sweep()
+
+    def get_metrics(self):
+        return self._store.get_metrics()
@@ -0,0 +1,96 @@
+"""
+Tests for the AllRecipes.com page extractors.  Run with py.test.
+"""
+from StringIO import StringIO
+import unittest
+
+from allrecipes import extract_recipe_parts, \
+    extract_recipe_parts_single_pass, extract_canonical_url
+
+
+# A trimmed-down recipe detail page, laid out like the saved AllRecipes.com
+# pages, with some of the markup around the parts that are extracted.
+SAMPLE_PAGE = """<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+    "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head>
+<title>Baked Ziti I - Allrecipes.com</title>
+<link id="ctl00_canonicalUrl" rel="canonical"
+      href="http://allrecipes.com/Recipe/Baked-Ziti-I/Detail.aspx" />
+<script type="text/javascript">var items = "<li>not a step</li>";</script>
+</head>
+<body>
+<!-- Recipe -->
+<div id="content">
+  <h1 id="itemTitle" class="fn">Baked Ziti I</h1>
+  <div id="ctl00_CenterColumnPlaceHolder_recipe_divSubmitter">
+    <span class="author-name">Submitted By:
+      <span id="ctl00_CenterColumnPlaceHolder_recipe_lblSubmitter">
+        Cindy Glaser</span></span>
+    <p>
+      Simple and tasty, this baked ziti feeds a crowd.
+    </p>
+  </div>
+  <span class="yield yieldform">10 servings</span>
+  <div class="ingredients">
+    <h3>Ingredients</h3>
+    <ul>
+      <li>1 pound dry ziti pasta</li>
+      <li>1 onion, chopped</li>
+      <li> </li>
+      <li>6 ounces <b>provolone</b> cheese, sliced</li>
+    </ul>
+  </div>
+  <div class="directions">
+    <ol>
+      <li><span>Bring a large pot of lightly salted water to a boil.</span>
+          Add ziti pasta.</li>
+      <li>In a large skillet, brown onion and ground beef.</li>
+      <li>Bake for 30 minutes in the preheated oven.</li>
+    </ol>
+  </div>
+  <div class="times">
+    <span class="prepTime">Prep Time:</span><em>15 Min</em>
+    <span class="cookTime">Cook Time:</span><em>1 Hr</em>
+    <span class="totalTime">Ready In:</span><em>1 Hr 15 Min</em>
+  </div>
+</div>
+<div class="sidebar"><ul><li>Related recipes</li></ul></div>
+</body>
+</html>
+"""
+
+
+class TestExtractors(unittest.TestCase):
+
+    def test_single_pass_extractor_is_equivalent(self):
+        expected = extract_recipe_parts(StringIO(SAMPLE_PAGE))
+        actual = extract_recipe_parts_single_pass(StringIO(SAMPLE_PAGE))
+        assert dict(actual) == dict(expected)
+
+    def test_extracted_parts(self):
+        recipe = extract_recipe_parts_single_pass(StringIO(SAMPLE_PAGE))
+        assert recipe['url'] == \
+            "http://allrecipes.com/Recipe/Baked-Ziti-I/Detail.aspx"
+        assert recipe['title'] == "Baked Ziti I"
+        assert recipe['author'] == "Cindy Glaser"
+        assert recipe['servings'] == "10 servings"
+        assert recipe['ingredients'][:2] == ["1 pound dry ziti pasta",
+                                             "1 onion, chopped"]
+        assert recipe['num_steps'] == 3
+        assert (recipe['prep_time'], recipe['cook_time'],
+                recipe['total_time']) == (15, 60, 75)
+
+    def test_missing_time_labels(self):
+        page = SAMPLE_PAGE.replace('class="cookTime"', 'class="note"')
+        expected = extract_recipe_parts(StringIO(page))
+        actual = extract_recipe_parts_single_pass(StringIO(page))
+        assert dict(actual) == dict(expected)
+        assert 'cook_time' not in actual
+        assert actual['total_time'] == 75
+
+    def test_canonical_url(self):
+        assert extract_canonical_url(StringIO(SAMPLE_PAGE)) == \
+            extract_recipe_parts(StringIO(SAMPLE_PAGE))['url']
+        assert extract_canonical_url(StringIO("<html><body></body></html>")) \
+            is None
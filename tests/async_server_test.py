@@ -0,0 +1,66 @@
+"""
+Tests for the event-driven server.  Run with py.test.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib
+import urllib2
+
+import admission
+from admission import AdmissionController
+from async_server import AsyncChatServer
+from database import Database
+from web_server import WebChatServer
+
+
+class TestAsyncChatServer(unittest.TestCase):
+
+    def setUp(self):
+        # Every thread in a pool gets its own connection, so the database
+        # can't be in memory.
+        self.directory = tempfile.mkdtemp()
+        db = Database('sqlite:///' +
+                      os.path.join(self.directory, 'recipes.sqlite'))
+        db.add_from_recipe_parts({
+            'title': "Bacon Sandwich",
+            'url': "bacon_sandwich",
+            'author': "Cindy Glaser",
+            'description': "Crispy and quick.",
+            'ingredients': ['2 slices bacon', '2 slices bread'],
+            'steps': ["Fry the bacon.", "Make a sandwich."],
+        })
+        # Shed all of the JVM's work, so that messages are answered without
+        # the parser and realiser.
+        self.admission = admission._jvm_admission
+        admission._jvm_admission = AdmissionController(limit=0,
+                                                       queue_depth=0,
+                                                       deadline=0)
+        logger = logging.getLogger('async_server_test')
+        self.server = AsyncChatServer(WebChatServer(db, logger),
+                                      ('127.0.0.1', 0), logger=logger)
+        self.url = 'http://127.0.0.1:%i/' % self.server.socket.getsockname()[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        admission._jvm_admission = self.admission
+        shutil.rmtree(self.directory)
+
+    def post(self, message):
+        data = urllib.urlencode({'session_id': 'session',
+                                 'chat_message': message})
+        return urllib2.urlopen(self.url, data).read()
+
+    def test_show_recipe_after_search(self):
+        assert 'Would you like to see one?' in \
+            self.post("I want a recipe with bacon")
+        # The recipe is found by the dm pool and shown by the nlg pool.
+        response = self.post("yes")
+        assert "Bacon Sandwich by Cindy Glaser" in response
+        assert "Fry the bacon." in response
@@ -130,6 +130,43 @@ class TestDatabaseQueries(unittest.TestCase):
                 for subsubtype in subtype.subtypes:
                     assert subsubtype.depth == 2
 
+    def test_ontology_descendants(self):
+        ingredient_root = self.db._session.query(OntologyNode).filter_by(
+            name='ingredient', supertype=None).one()
+        vegetable = self.db._session.query(OntologyNode).filter_by(
+            name='vegetable', supertype=ingredient_root).one()
+        assert [n.name for n in vegetable.descendants] == \
+               ['potato', 'root vegetable', 'yam']
+
+
+class TestBulkOntologyLoading(unittest.TestCase):
+
+    ontology_tuples = [
+        ('ingredient', 'vegetable', 'root vegetable', 'potato'),
+        ('ingredient', 'vegetable', 'root vegetable', 'yam'),
+        ('ingredient', 'fruit', 'apple'),
+        ('cuisine', 'vegetable')
+    ]
+
+    def test_bulk_load(self):
+        db = Database("sqlite:///:memory:")
+        assert db.bulk_add_ontology_nodes(self.ontology_tuples) == 9
+        yam = db._session.query(OntologyNode).filter_by(name='yam').one()
+        assert yam.depth == 3
+        assert [n.name for n in yam.path_from_root] == \
+               ['ingredient', 'vegetable', 'root vegetable', 'yam']
+        ingredient = db._session.query(OntologyNode).filter_by(
+            name='ingredient').one()
+        assert len(ingredient.descendants) == 6
+
+    def test_bulk_load_is_idempotent(self):
+        db = Database("sqlite:///:memory:")
+        db.add_ontology_node(('ingredient', 'fruit', 'apple'))
+        assert db.bulk_add_ontology_nodes(self.ontology_tuples) == 6
+        assert db.bulk_add_ontology_nodes(self.ontology_tuples) == 0
+        assert db._session.query(OntologyNode).count() == 9
+
+
 class TestDatabaseExceptions(unittest.TestCase):
 
     def test_add_duplicate_recipes(self):
@@ -143,6 +180,21 @@ class TestDatabaseExceptions(unittest.TestCase):
             pass
         assert len(db.get_recipes()) == 1
 
+    def test_add_duplicate_recipes_with_url_filter(self):
+        db = Database("sqlite:///:memory:")
+        db.add_from_recipe_parts({'title': 'cake', 'url': 'cake'})
+        db.load_url_filter()
+        assert db.has_recipe_url('cake')
+        assert not db.has_recipe_url('pie')
+        db.add_from_recipe_parts({'title': 'pie', 'url': 'pie'})
+        assert db.has_recipe_url('pie')
+        try:
+            db.add_from_recipe_parts({'title': 'pie', 'url': 'pie'})
+            assert False  # Should have got an exception
+        except DuplicateRecipeException:
+            pass
+        assert len(db.get_recipes()) == 2
+
     def test_add_duplicate_ontology_nodes(self):
         db = Database("sqlite:///:memory:")
         assert db._session.query(OntologyNode).count() == 0
@@ -0,0 +1,83 @@
+"""
+Compares the speed and memory use of the AllRecipes.com page extractors on a
+corpus of saved recipe pages.
+
+Each extractor runs in its own process, so the peak RSS reported for one
+extractor isn't inflated by the other.  Run with a glob of saved pages:
+
+    python tests/extractor_benchmark.py 'pages/*.html'
+"""
+from glob import glob
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+import resource
+import sys
+import time
+
+from allrecipes import extract_recipe_parts, \
+    extract_recipe_parts_single_pass
+
+
+PARSER = OptionParser(usage="usage: %prog [options] recipe_filenames")
+PARSER.add_option("-n", "--repeat", type="int", dest="repeat", default=1,
+                  help="number of passes over the corpus")
+
+EXTRACTORS = [
+    ('extract_recipe_parts', extract_recipe_parts),
+    ('extract_recipe_parts_single_pass', extract_recipe_parts_single_pass),
+]
+
+
+def _run_extractor(extractor, filenames, repeat, results):
+    """
+    Extract every page in filenames, repeat times, and put (pages, seconds,
+    peak RSS in kilobytes, failures) on the results queue.
+    """
+    pages = 0
+    failures = 0
+    start = time.time()
+    for _ in range(repeat):
+        for filename in filenames:
+            recipe_file = open(filename)
+            try:
+                extractor(recipe_file)
+            except (KeyError, IndexError, AssertionError, AttributeError):
+                failures += 1
+            recipe_file.close()
+            pages += 1
+    elapsed = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put((pages, elapsed, peak_rss, failures))
+
+
+def main():
+    """
+    Run each extractor over the corpus and print a comparison.
+    """
+    (options, args) = PARSER.parse_args()
+    filenames = []
+    for arg in args:
+        filenames.extend(glob(arg))
+    if not filenames:
+        sys.stderr.write("Please specify one or more pages downloaded from "
+                         "AllRecipes.com\n")
+        PARSER.print_help()
+        exit(-1)
+    print "Benchmarking %i pages, %i pass(es)" % (len(filenames),
+                                                 options.repeat)
+    print
+    print "%-34s %10s %14s %9s" % ("Extractor", "Pages/sec", "Peak RSS (KB)",
+                                   "Failures")
+    for (name, extractor) in EXTRACTORS:
+        results = Queue()
+        process = Process(target=_run_extractor,
+                          args=(extractor, filenames, options.repeat, results))
+        process.start()
+        (pages, elapsed, peak_rss, failures) = results.get()
+        process.join()
+        print "%-34s %10.1f %14i %9i" % (name, pages / max(elapsed, 1e-9),
+                                         peak_rss, failures)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Measures the time from a cold start to the first parse, with and without the
+class data sharing archive and the decompressed grammar built by
+
+    cd py4j_server && ant all
+
+Each configuration runs in a fresh process with its own JVM, several times, and
+the median times are reported:
+
+    python tests/jvm_startup_benchmark.py -n 5
+"""
+from multiprocessing import Process, Queue
+from optparse import OptionParser
+import os
+import sys
+import time
+
+import py4j_server
+from nlu import stanford_utils
+
+
+PARSER = OptionParser()
+PARSER.add_option("-n", "--repeat", type="int", dest="repeat", default=3,
+                  help="number of cold starts per configuration")
+
+SENTENCE = ["This", "is", "a", "test", "."]
+
+# (name, use the class data sharing archive, use the decompressed grammar)
+CONFIGURATIONS = [
+    ('baseline', False, False),
+    ('class data sharing', True, False),
+    ('decompressed grammar', False, True),
+    ('both', True, True),
+]
+
+
+def _first_parse(use_cds, use_fast_grammar, results):
+    """
+    Launch a JVM, load the grammar and parse a sentence, and put the seconds
+    taken to launch the JVM and to reach the first parse on the results queue.
+    """
+    py4j_server.USE_CDS = use_cds
+    if not use_fast_grammar:
+        stanford_utils._fastTrainerFile = os.devnull + '.missing'
+    start = time.time()
+    stanford_utils.gateway.get()
+    launched = time.time()
+    str(stanford_utils.get_parse_tree(SENTENCE))
+    parsed = time.time()
+    results.put((launched - start, parsed - start))
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    """
+    Start the parser cold in each configuration and print a comparison.
+    """
+    (options, args) = PARSER.parse_args()
+    if not os.path.exists(py4j_server.CDS_ARCHIVE):
+        sys.stderr.write("Warning: %s hasn't been built\n" %
+                         py4j_server.CDS_ARCHIVE)
+    if not os.path.exists(stanford_utils._fastTrainerFile):
+        sys.stderr.write("Warning: %s hasn't been built\n" %
+                         stanford_utils._fastTrainerFile)
+    print "Median of %i cold start(s)" % options.repeat
+    print
+    print "%-22s %16s %20s" % ("Configuration", "JVM launch (s)",
+                               "First parse (s)")
+    for (name, use_cds, use_fast_grammar) in CONFIGURATIONS:
+        launch_times = []
+        parse_times = []
+        for _ in range(options.repeat):
+            results = Queue()
+            process = Process(target=_first_parse,
+                              args=(use_cds, use_fast_grammar, results))
+            process.start()
+            (launch_time, parse_time) = results.get()
+            process.join()
+            launch_times.append(launch_time)
+            parse_times.append(parse_time)
+        print "%-22s %16.2f %20.2f" % (name, _median(launch_times),
+                                       _median(parse_times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,449 @@
+"""
+Measures how many concurrent chat sessions the web server handles, by
+simulating users who chat with it at the same time.
+
+Each simulated user repeatedly opens a session and replays a conversation
+scripted from corpora/recipe_search.txt and INGREDIENTS.txt: a search, some
+ingredient requests, and an answer to the offer to show the recipes, pausing
+for a random think time before each message.  The server uses a generated
+SQLite database of made-up recipes, so no network access is needed:
+
+    python tests/load_benchmark.py --users 20 --duration 60
+    python tests/load_benchmark.py --users 20 --http
+    python tests/load_benchmark.py --url http://localhost:8080/ --server-pid 123
+
+By default the WebChatServer is called directly in this process, so the RSS
+reported includes the simulated users.  With --http, it's served by CherryPy's
+WSGI server in a child process and driven over local HTTP; with --url, a
+server that's already running is driven instead.
+
+The report gives the throughput, the latency percentiles and error rate of
+each type of turn, and the RSS over time of the server and of the JVM that
+runs its parser and realiser, which is a child process of the server (or the
+shared daemon, with PY4J_DAEMON set).
+"""
+from multiprocessing import Process
+from optparse import OptionParser
+from StringIO import StringIO
+import httplib
+import logging
+import os
+import random
+import re
+import socket
+import threading
+import time
+import urllib
+import urlparse
+
+from database import Database
+from ontology_import import read_ontology
+from web_server import WebChatServer
+
+
+PARSER = OptionParser()
+PARSER.add_option("--users", type="int", dest="users", default=10,
+                  help="number of simulated users chatting at once")
+PARSER.add_option("--duration", type="float", dest="duration", default=60,
+                  help="seconds to run for")
+PARSER.add_option("--think-time", type="float", dest="think_time",
+                  default=1.0,
+                  help="mean seconds a user waits before each message")
+PARSER.add_option("--http", action="store_true", dest="http",
+                  help="serve over local HTTP from a child process")
+PARSER.add_option("--server-threads", type="int", dest="server_threads",
+                  default=10, help="threads of the --http server")
+PARSER.add_option("--url", dest="url",
+                  help="drive the server running at this url instead")
+PARSER.add_option("--server-pid", type="int", dest="server_pid",
+                  help="process id of the --url server, to report its RSS")
+PARSER.add_option("--jvm-pid", type="int", dest="jvm_pid",
+                  help="process id of the server's JVM, if it isn't found")
+PARSER.add_option("--database", dest="database_url",
+                  default='sqlite:///load_benchmark.sqlite',
+                  help="database, generated if it doesn't have any recipes")
+PARSER.add_option("--recipes", type="int", dest="recipes", default=500,
+                  help="number of recipes to generate")
+PARSER.add_option("--sample-interval", type="float", dest="sample_interval",
+                  default=5, help="seconds between samples of the RSS")
+PARSER.add_option("--seed", type="int", dest="seed", default=0)
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SEARCHES_FILE = os.path.join(ROOT_DIR, 'corpora', 'recipe_search.txt')
+INGREDIENTS_FILE = os.path.join(ROOT_DIR, 'INGREDIENTS.txt')
+ANSWERS = ['yes', 'no', 'Yes, please.', 'No thanks.', 'ok']
+SESSION_ID_PATTERN = re.compile(r"var session_id = '([^']+)'")
+
+
+def read_utterances(lines):
+    """
+    Return the utterances in the lines of a corpus, skipping comments and
+    blank lines.
+
+    >>> read_utterances(['# I like series:', '', 'I like pepperoni  \\n'])
+    ['I like pepperoni']
+    """
+    utterances = []
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            utterances.append(line)
+    return utterances
+
+
+def make_conversation(rng, searches, ingredient_requests, max_requests=2):
+    """
+    Return a scripted conversation, as a list of (turn type, message) pairs:
+    a search, up to max_requests ingredient requests, and an answer.
+
+    >>> turns = make_conversation(random.Random(0), ['Find pie'],
+    ...                           ['I like pears'], max_requests=1)
+    >>> turns[0], turns[1], turns[-1][0]
+    (('search', 'Find pie'), ('ingredients', 'I like pears'), 'answer')
+    """
+    turns = [('search', rng.choice(searches))]
+    for _ in range(rng.randint(0, max_requests)):
+        turns.append(('ingredients', rng.choice(ingredient_requests)))
+    turns.append(('answer', rng.choice(ANSWERS)))
+    return turns
+
+
+def generate_database(database_url, num_recipes, seed=0):
+    """
+    Return the database at database_url, after importing the ontology and
+    num_recipes made-up recipes using its ingredients if it doesn't have
+    them yet.
+    """
+    db = Database(database_url)
+    if db.has_recipe_url('generated/0'):
+        return db
+    ontology = list(read_ontology())
+    db.bulk_add_ontology_nodes(ontology)
+    ingredients = sorted(set(node[-1] for node in ontology
+                             if node[0] == 'ingredient' and len(node) > 1))
+    rng = random.Random(seed)
+    for i in range(num_recipes):
+        chosen = rng.sample(ingredients, rng.randint(2, 8))
+        prep_time = rng.randint(5, 60)
+        cook_time = rng.randint(0, 120)
+        db._add_from_recipe_parts({
+            'title': 'Generated %s with %s' % (chosen[0], chosen[1]),
+            'url': 'generated/%i' % i,
+            'ingredients': ['%i cups %s' % (rng.randint(1, 4), name)
+                            for name in chosen],
+            'steps': ['Combine the %s.' % ', '.join(chosen), 'Serve.'],
+            'num_steps': 2,
+            'prep_time': prep_time,
+            'cook_time': cook_time,
+            'total_time': prep_time + cook_time,
+        })
+    db._session.commit()
+    return db
+
+
+class InProcessClient(object):
+    """
+    Sends requests to a WSGI application by calling it directly.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body=''):
+        """
+        Return the status code and body of the response to a request.
+        """
+        environ = {
+            'REQUEST_METHOD': method,
+            'PATH_INFO': path,
+            'QUERY_STRING': '',
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.input': StringIO(body),
+        }
+        statuses = []
+
+        def start_response(status, headers):
+            statuses.append(status)
+        response = ''.join(self.app(environ, start_response))
+        return (int(statuses[0].split()[0]), response)
+
+
+class HTTPClient(object):
+    """
+    Sends requests to a server over HTTP.
+    """
+
+    def __init__(self, url):
+        parts = urlparse.urlparse(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path.rstrip('/')
+
+    def request(self, method, path, body=''):
+        connection = httplib.HTTPConnection(self.host, self.port)
+        try:
+            connection.request(method, self.path + path, body, {
+                'content-type': 'application/x-www-form-urlencoded'})
+            response = connection.getresponse()
+            return (response.status, response.read())
+        finally:
+            connection.close()
+
+
+class Results(object):
+    """
+    Collects the latencies and errors of the turns taken by every user.
+    """
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def add(self, turn_type, seconds, error):
+        with self.lock:
+            self.latencies.setdefault(turn_type, []).append(seconds)
+            self.errors.setdefault(turn_type, 0)
+            if error:
+                self.errors[turn_type] += 1
+
+
+def _percentile(sorted_values, fraction):
+    """
+    Return the value at the given fraction of a sorted list.
+
+    >>> _percentile(range(1, 101), 0.95)
+    95
+    """
+    index = int(round(fraction * len(sorted_values))) - 1
+    return sorted_values[max(0, min(index, len(sorted_values) - 1))]
+
+
+def simulate_user(client, rng, corpora, think_time, deadline, results):
+    """
+    Chat in new sessions until the deadline, adding each turn to results.
+    """
+    while time.time() < deadline:
+        started = time.time()
+        try:
+            (status, page) = client.request('GET', '/')
+            session_id = SESSION_ID_PATTERN.search(page).group(1)
+            error = status != 200
+        except Exception, e:
+            logging.warn("Couldn't start a session: %s" % e)
+            results.add('greeting', time.time() - started, True)
+            time.sleep(think_time)
+            continue
+        results.add('greeting', time.time() - started, error)
+        for (turn_type, message) in make_conversation(rng, *corpora):
+            time.sleep(rng.expovariate(1.0 / think_time) if think_time else 0)
+            if time.time() >= deadline:
+                return
+            body = urllib.urlencode({'session_id': session_id,
+                                     'chat_message': message})
+            started = time.time()
+            try:
+                (status, response) = client.request('POST', '/', body)
+                error = status != 200
+            except Exception, e:
+                logging.warn("Error answering %r: %s" % (message, e))
+                error = True
+            results.add(turn_type, time.time() - started, error)
+
+
+def rss_kilobytes(pid):
+    """
+    Return the resident set size of a process in kilobytes, or None if it
+    can't be read (it's read from /proc).
+    """
+    try:
+        with open('/proc/%i/status' % pid) as status_file:
+            for line in status_file:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def find_jvm_pid(server_pid):
+    """
+    Return the process id of the JVM running Py4JServer for a server: its
+    child process, or else the shared daemon.  Returns None if there isn't
+    one (yet; it's launched on first use).
+    """
+    daemon_pid = None
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/cmdline' % name) as cmdline_file:
+                args = cmdline_file.read().split('\0')
+            with open('/proc/%s/stat' % name) as stat_file:
+                # The parent's pid follows the command name and the state.
+                parent_pid = int(stat_file.read().rsplit(')', 1)[1].split()[1])
+        except (IOError, IndexError, ValueError):
+            continue
+        if 'Py4JServer' not in args:
+            continue
+        if parent_pid == server_pid:
+            return int(name)
+        if '--daemon' in args:
+            daemon_pid = int(name)
+    return daemon_pid
+
+
+def sample_rss(server_pid, jvm_pid=None):
+    """
+    Return the RSS in kilobytes of the server and of its JVM, which is found
+    by find_jvm_pid() unless jvm_pid is given.  Either is None if it can't
+    be read.
+    """
+    if jvm_pid is None:
+        jvm_pid = find_jvm_pid(server_pid)
+    jvm_rss = None
+    if jvm_pid is not None:
+        jvm_rss = rss_kilobytes(jvm_pid)
+    return (rss_kilobytes(server_pid), jvm_rss)
+
+
+def _serve(database_url, port, threads):
+    """
+    Serve a WebChatServer with CherryPy's WSGI server; run in a child
+    process by --http.
+    """
+    from cherrypy import wsgiserver
+    app = WebChatServer(Database(database_url), logging.getLogger('server'))
+    server = wsgiserver.CherryPyWSGIServer(('127.0.0.1', port), app,
+                                           numthreads=threads)
+    server.start()
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _wait_for_server(client, timeout=120):
+    """
+    Wait until the server answers, since it has to load the database first.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            client.request('GET', '/')
+            return
+        except socket.error:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def print_report(results, elapsed, rss_samples):
+    turns = sum(len(latencies) for latencies in results.latencies.values())
+    errors = sum(results.errors.values())
+    print "%i turns in %.1f s: %.2f turns/s, %.2f%% errors" % \
+        (turns, elapsed, turns / elapsed, 100.0 * errors / max(turns, 1))
+    print
+    print "%-12s %8s %8s %9s %9s %9s" % ("Turn type", "Turns", "Errors",
+                                         "p50 (s)", "p95 (s)", "p99 (s)")
+    for turn_type in sorted(results.latencies):
+        latencies = sorted(results.latencies[turn_type])
+        print "%-12s %8i %8i %9.3f %9.3f %9.3f" % (
+            turn_type, len(latencies), results.errors[turn_type],
+            _percentile(latencies, 0.5), _percentile(latencies, 0.95),
+            _percentile(latencies, 0.99))
+    if rss_samples:
+        print
+        print "%-12s %16s %16s %16s" % ("Elapsed (s)", "Server RSS (MB)",
+                                        "JVM RSS (MB)", "Total RSS (MB)")
+        for (seconds, server_rss, jvm_rss) in rss_samples:
+            print "%-12.0f %16s %16s %16.1f" % (
+                seconds, _megabytes(server_rss), _megabytes(jvm_rss),
+                ((server_rss or 0) + (jvm_rss or 0)) / 1024.0)
+        totals = [(server_rss or 0) + (jvm_rss or 0)
+                  for (_, server_rss, jvm_rss) in rss_samples]
+        print "RSS growth: server %s MB, JVM %s MB, total %s MB" % (
+            _megabytes(_growth([sample[1] for sample in rss_samples])),
+            _megabytes(_growth([sample[2] for sample in rss_samples])),
+            _megabytes(_growth(totals)))
+
+
+def _megabytes(kilobytes):
+    if kilobytes is None:
+        return '-'
+    return '%.1f' % (kilobytes / 1024.0)
+
+
+def _growth(samples):
+    """
+    Return the difference between the last and first samples that aren't
+    None, or None if there aren't any.
+    """
+    samples = [sample for sample in samples if sample is not None]
+    if not samples:
+        return None
+    return samples[-1] - samples[0]
+
+
+def main():
+    """
+    Simulate the users and print a report.
+    """
+    (options, args) = PARSER.parse_args()
+    logging.basicConfig(level=logging.WARN)
+    corpora = (read_utterances(open(SEARCHES_FILE)),
+               read_utterances(open(INGREDIENTS_FILE)))
+    server = None
+    if options.url:
+        client = HTTPClient(options.url)
+        server_pid = options.server_pid
+    else:
+        db = generate_database(options.database_url, options.recipes,
+                               options.seed)
+        if options.http:
+            port = _free_port()
+            server = Process(target=_serve, args=(options.database_url, port,
+                                                  options.server_threads))
+            server.daemon = True
+            server.start()
+            client = HTTPClient('http://127.0.0.1:%i/' % port)
+            server_pid = server.pid
+            _wait_for_server(client)
+        else:
+            client = InProcessClient(
+                WebChatServer(db, logging.getLogger('server')))
+            server_pid = os.getpid()
+
+    results = Results()
+    started = time.time()
+    deadline = started + options.duration
+    users = [threading.Thread(target=simulate_user, args=(
+                 client, random.Random(options.seed + i), corpora,
+                 options.think_time, deadline, results))
+             for i in range(options.users)]
+    for user in users:
+        user.setDaemon(True)
+        user.start()
+    rss_samples = []
+    while any(user.isAlive() for user in users):
+        if server_pid is not None:
+            rss_samples.append((time.time() - started, ) +
+                               sample_rss(server_pid, options.jvm_pid))
+        for user in users:
+            user.join(options.sample_interval)
+            if user.isAlive():
+                break
+    elapsed = time.time() - started
+    if server_pid is not None:
+        rss_samples.append((elapsed, ) +
+                           sample_rss(server_pid, options.jvm_pid))
+    if server is not None:
+        server.terminate()
+    print_report(results, elapsed, rss_samples)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Tests for the web server's handling of sessions.  Run with py.test.
+"""
+import logging
+import unittest
+import urllib
+
+from admission import Overloaded
+from chatbot import run_stages, stream_stages
+from web_server import WebChatServer
+
+
+class FakeChatbot(object):
+    """
+    Answers messages in stages like Chatbot, changing its state in place.
+    The message 'refuse' is refused as if the server were overloaded.
+    """
+
+    def __init__(self, state=None):
+        if state is None:
+            state = {'messages': []}
+        self.state = state
+
+    def respond_in_stages(self, user_input, incremental=False):
+        def understand():
+            if user_input == 'refuse':
+                raise Overloaded(3)
+            return user_input
+        self.state['messages'].append(user_input)
+        message = yield ('nlu', understand)
+        pieces = []
+        for i in range(2):
+            piece = yield ('nlg', lambda: '%s %i' % (message, i))
+            pieces.append(piece)
+        yield (None, '\n'.join(pieces))
+
+    def handle_input(self, user_input):
+        return run_stages(self.respond_in_stages(user_input))
+
+    def respond_incrementally(self, user_input):
+        return stream_stages(self.respond_in_stages(user_input, True))
+
+
+class FakeChatServer(WebChatServer):
+
+    def _new_chatbot(self, state=None):
+        return FakeChatbot(state)
+
+
+class TestSessions(unittest.TestCase):
+
+    def setUp(self):
+        self.app = FakeChatServer(None, logging.getLogger('web_server_test'))
+        self.app.state_datastore.put('session', {'messages': ['hi']})
+
+    def stream(self, message):
+        environ = {
+            'REQUEST_METHOD': 'GET',
+            'PATH_INFO': '/stream',
+            'QUERY_STRING': urllib.urlencode({'session_id': 'session',
+                                              'chat_message': message}),
+        }
+        return self.app(environ, lambda status, headers: None)
+
+    def test_finished_stream_is_saved(self):
+        events = list(self.stream('thai'))
+        assert events[-1].startswith('event: done')
+        assert self.app.state_datastore.get('session') == \
+            {'messages': ['hi', 'thai']}
+
+    def test_cut_off_stream_is_not_saved(self):
+        events = self.stream('thai')
+        assert events.next() == 'data: thai 0\n\n'
+        # The client goes away after the first event.
+        events.close()
+        assert self.app.state_datastore.get('session') == \
+            {'messages': ['hi']}
+        # The session isn't left locked.
+        list(self.stream('thai'))
+        assert self.app.state_datastore.get('session') == \
+            {'messages': ['hi', 'thai']}
+
+    def test_refused_batch_is_not_saved(self):
+        results = self.app.handle_batch([
+            {'session_id': 'session', 'message': 'thai'},
+            {'session_id': 'session', 'message': 'refuse'},
+            {'session_id': 'session', 'message': 'yes'},
+            {'session_id': 'other', 'message': 'hello'},
+        ])
+        assert results[0]['response'] == 'thai 0\nthai 1'
+        assert [result.get('retry_after') for result in results] == \
+            [None, 3, 3, None]
+        assert self.app.state_datastore.get('session') == \
+            {'messages': ['hi']}
+        assert self.app.state_datastore.get('other') == \
+            {'messages': ['hello']}
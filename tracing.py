@@ -0,0 +1,167 @@
+"""
+Lightweight tracing of where the time goes while answering a message.
+
+Code marks out the work it does with spans, named after the work:
+
+>>> with span('example.outer'):
+...     with span('example.inner'):
+...         pass
+>>> metrics = get_metrics()
+>>> metrics['example.inner']['seconds']['count']
+1
+
+Each span adds its duration, and the number of times that each registered
+counter (like the number of Py4J calls) went up during the span, to
+histograms named after the span.  get_metrics() returns all of the histograms
+as a dictionary that can be serialized as JSON.
+
+Set the CHATBOT_TRACING environment variable to 0 to turn tracing off.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+ENABLED = os.environ.get('CHATBOT_TRACING', '1') != '0'
+
+# The upper bounds of the histograms' buckets.
+SECONDS_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1,
+                   2, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Histogram(object):
+    """
+    Counts values in buckets, and keeps their count, total and maximum.
+
+    >>> histogram = Histogram((1, 10))
+    >>> for value in [0.5, 2, 3, 50]:
+    ...     histogram.add(value)
+    >>> metrics = histogram.as_dict()
+    >>> metrics['count'], metrics['max'], metrics['buckets']
+    (4, 50, [[1, 1], [10, 2], ['inf', 1]])
+    >>> metrics['p50']
+    10
+    """
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def percentile(self, fraction):
+        """
+        Return the upper bound of the bucket holding the given fraction of
+        the values, or the maximum if it's in the last bucket.
+        """
+        needed = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= needed:
+                return bound
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': float(self.total) / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'buckets': [[bound, count] for bound, count in
+                        zip(list(self.bounds) + ['inf'], self.counts)],
+        }
+
+
+_lock = threading.Lock()
+# Maps span names to dictionaries of histograms.
+_spans = {}
+# Maps names to functions returning the current thread's count of something.
+_counters = {}
+
+
+def register_counter(name, function):
+    """
+    Record how much function(), which returns the calling thread's count of
+    something, goes up during each span, in a histogram with the given name.
+    """
+    _counters[name] = function
+
+
+def _record(name, seconds, counts):
+    with _lock:
+        histograms = _spans.get(name)
+        if histograms is None:
+            histograms = {'seconds': Histogram(SECONDS_BUCKETS)}
+            _spans[name] = histograms
+        histograms['seconds'].add(seconds)
+        for counter, count in counts.items():
+            if counter not in histograms:
+                histograms[counter] = Histogram(COUNT_BUCKETS)
+            histograms[counter].add(count)
+
+
+@contextmanager
+def span(name):
+    """
+    Trace the work done in a with statement as a span with the given name.
+    """
+    if not ENABLED:
+        yield
+        return
+    counters = _counters.items()
+    counts = dict((counter, function()) for counter, function in counters)
+    started = time.time()
+    try:
+        yield
+    finally:
+        seconds = time.time() - started
+        for counter, function in counters:
+            counts[counter] = function() - counts[counter]
+        _record(name, seconds, counts)
+
+
+def traced(name):
+    """
+    Decorator that traces each call to a function as a span.
+    """
+    def decorator(function):
+        def traced_function(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        traced_function.__name__ = function.__name__
+        traced_function.__doc__ = function.__doc__
+        return traced_function
+    return decorator
+
+
+def get_metrics():
+    """
+    Return a dictionary mapping the names of spans to dictionaries of their
+    histograms: 'seconds' and one for each registered counter.
+    """
+    with _lock:
+        return dict((name, dict((histogram_name, histogram.as_dict())
+                                for histogram_name, histogram
+                                in histograms.items()))
+                    for name, histograms in _spans.items())
+
+
+def reset_metrics():
+    with _lock:
+        _spans.clear()
@@ -0,0 +1,152 @@
+"""
+Fast membership tests for recipe urls, used to skip duplicate pages during
+recipe import without querying the database for every page.
+
+Small databases use a plain set of urls.  For large databases, a Bloom filter
+answers "definitely not present" or "possibly present"; possible matches must
+be confirmed against the database's unique index on recipes.url.
+
+>>> bloom = BloomFilter(1000)
+>>> bloom.add('http://example.com/pbj.html')
+>>> 'http://example.com/pbj.html' in bloom
+True
+>>> 'http://example.com/blt.html' in bloom
+False
+"""
+import cPickle
+import hashlib
+import math
+import os
+import struct
+
+
+# Databases with fewer recipes than this use a set instead of a Bloom filter.
+SET_THRESHOLD = 100000
+
+
+class BloomFilter(object):
+    """
+    A Bloom filter of strings, sized for a given capacity and false positive
+    rate.  Items can be added but not removed.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        Create an empty Bloom filter that holds up to capacity items with the
+        given false positive rate.
+        """
+        capacity = max(capacity, 1)
+        num_bits = -capacity * math.log(error_rate) / (math.log(2) ** 2)
+        self.num_bits = int(math.ceil(num_bits))
+        self.num_hashes = max(1, int(round(
+            self.num_bits / float(capacity) * math.log(2))))
+        self.capacity = capacity
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _bit_positions(self, item):
+        """
+        Return the bit positions for an item, derived from two halves of its
+        MD5 digest by double hashing.
+        """
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        (hash1, hash2) = struct.unpack('<QQ', hashlib.md5(item).digest())
+        return [(hash1 + i * hash2) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def add(self, item):
+        """
+        Add an item to the filter.
+        """
+        for position in self._bit_positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        for position in self._bit_positions(item):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+
+def url_filter_filename(database_url):
+    """
+    Return the name of the file used to persist the Bloom filter for a
+    database, or None if the database isn't stored in a local file.
+
+    >>> url_filter_filename('sqlite:///test_database.sqlite')
+    'test_database.sqlite.urls'
+    >>> url_filter_filename('sqlite:///:memory:') == None
+    True
+    """
+    prefix = 'sqlite:///'
+    if not database_url.startswith(prefix):
+        return None
+    path = database_url[len(prefix):]
+    if not path or path == ':memory:':
+        return None
+    return path + '.urls'
+
+
+def build_url_filter(urls, count, fingerprint=None, filename=None,
+                     set_threshold=SET_THRESHOLD):
+    """
+    Return a filter supporting add() and the in operator for an iterable of
+    count urls.
+
+    For fewer than set_threshold urls, this is an exact set.  Otherwise, it's
+    a Bloom filter with room for the database to double in size.  If filename
+    names a saved filter whose fingerprint matches, it's loaded instead of
+    reading urls.
+
+    >>> url_filter = build_url_filter(['a', 'b'], 2)
+    >>> sorted(url_filter)
+    ['a', 'b']
+    >>> url_filter = build_url_filter(['a', 'b'], 2, set_threshold=1)
+    >>> ('a' in url_filter, 'c' in url_filter)
+    (True, False)
+    """
+    if count < set_threshold:
+        return set(urls)
+    if filename and fingerprint is not None:
+        bloom = load_url_filter(filename, fingerprint)
+        if bloom is not None:
+            return bloom
+    bloom = BloomFilter(2 * count)
+    for url in urls:
+        bloom.add(url)
+    return bloom
+
+
+def save_url_filter(url_filter, filename, fingerprint):
+    """
+    Save a Bloom filter, tagged with a fingerprint of the database contents
+    that it describes.  Sets aren't saved, since they're cheap to rebuild.
+    """
+    if not isinstance(url_filter, BloomFilter) or not filename:
+        return
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as pickle_file:
+        cPickle.dump((fingerprint, url_filter), pickle_file, -1)
+    os.rename(temp_filename, filename)
+
+
+def load_url_filter(filename, fingerprint):
+    """
+    Load a saved Bloom filter, or return None if there isn't one or if it was
+    saved for different database contents.
+    """
+    try:
+        with open(filename, 'rb') as pickle_file:
+            (saved_fingerprint, bloom) = cPickle.load(pickle_file)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+    if saved_fingerprint != fingerprint:
+        return None
+    if len(bloom) > bloom.capacity:
+        return None  # Too full; rebuild it with a larger capacity.
+    return bloom
@@ -3,17 +3,48 @@
 Simple WSGI application that provides web-based chat interface.
 
 For a demo, run this program and point your browser to
-http://localhost:8080
+http://localhost:8080.  Run it with --help for its options, which include
+serving from several worker processes that share their sessions.
 """
 
 import os
+import json
 import logging
+import signal
+import threading
+import time
 import uuid
 import urlparse
 import gc
+import Queue
+from optparse import OptionParser
 
-from chatbot import Chatbot
+import tracing
+from admission import Overloaded, get_jvm_admission
+from chatbot import Chatbot, encode_state, decode_state, run_stages, \
+    get_services
 from database import Database, Base
+from nlg import ContentPlanMessage, warm_up as warm_up_nlg
+from nlu.stanford_utils import warm_up as warm_up_nlu, get_fallback_counts
+from session_store import MemorySessionStore, SQLiteSessionStore, \
+    SocketSessionStore, SessionBusy, start_session_store_server
+
+# The maximum number of sessions of a batch that are answered at once.
+BATCH_THREADS = int(os.environ.get('CHATBOT_BATCH_THREADS', 4))
+
+
+def server_sent_event(data, event=None):
+    """
+    Format a server-sent event.
+
+    >>> server_sent_event('Hello\\nWorld')
+    'data: Hello\\ndata: World\\n\\n'
+    """
+    lines = []
+    if event is not None:
+        lines.append('event: %s\n' % event)
+    lines.extend('data: %s\n' % line for line in data.split('\n'))
+    return ''.join(lines) + '\n'
 
 
 class WebChatServer(object):
@@ -21,42 +52,314 @@ class WebChatServer(object):
     Provides web-based chat interface.  Instances of this class are
     callable WSGI applications.
 
-    Note: in a real server, you would want sessions to expire after some amount
-    of inactivity.
+    Sessions are kept in a session store, which expires them after some amount
+    of inactivity.  A message for an expired session starts a new
+    conversation.  The session's lock is held while a message is answered,
+    so that messages for the same session, even in different processes,
+    don't overwrite each other's changes.
     """
 
-    def __init__(self, db, logger):
+    def __init__(self, db, logger, session_store=None):
         """
         Create a new WSGI application providing a web-based chat
-        interface to the given chatbot.
+        interface to the given chatbot.  By default, sessions are kept in a
+        MemorySessionStore.
         """
-        self.state_datastore = {}
+        if session_store is None:
+            session_store = MemorySessionStore(
+                logger=logger.getChild('sessions'))
+        self.state_datastore = session_store
         self.db = db
         self.logger = logger
+        # Maps names to functions returning more metrics for get_metrics(),
+        # like those of the server running this application.
+        self.metrics_sources = {}
 
     def _save_chatbot(self, chatbot, session_id):
         """
-        Store the chatbot in the key-value store.
+        Store the chatbot's session state in the key-value store.
         """
-        self.state_datastore[session_id] = chatbot
+        self.state_datastore.put(session_id, chatbot.state)
 
     def _load_chatbot(self, session_id):
         """
-        Load the chatbot from the key-value store.
+        Load a chatbot continuing the session from the key-value store, or
+        return None if the session has expired.
+        """
+        state = self.state_datastore.get(session_id)
+        if state is None:
+            return None
+        return self._new_chatbot(state)
+
+    def _new_chatbot(self, state=None):
+        return Chatbot(self.db, self.logger, enable_debug=False, state=state)
+
+    def _continue_session(self, session_id):
+        """
+        Return a chatbot continuing a session, or starting a new conversation
+        if the session has expired.
+        """
+        chatbot = self._load_chatbot(session_id)
+        if chatbot is None:
+            self.logger.info("Session %s has expired; starting a new "
+                             "conversation." % session_id)
+            chatbot = self._new_chatbot()
+        return chatbot
+
+    def _answer_session_messages(self, session_id, messages):
+        """
+        Answer a session's messages in order, returning a result dictionary
+        for each of them.  If a message is refused because the server is
+        overloaded or the session is busy, it and the messages after it
+        aren't answered, and the session isn't saved.
+        """
+        results = []
+        refused = None
+        try:
+            with self.state_datastore.locked(session_id):
+                chatbot = self._continue_session(session_id)
+                for message in messages:
+                    result = self._answer_session_message(chatbot, session_id,
+                                                          message)
+                    results.append(result)
+                    if 'retry_after' in result:
+                        refused = result
+                        break
+                else:
+                    self._save_chatbot(chatbot, session_id)
+        except SessionBusy, e:
+            refused = {'error': str(e), 'retry_after': e.retry_after}
+        for message in messages[len(results):]:
+            results.append({'session_id': session_id, 'message': message,
+                            'error': refused['error'],
+                            'retry_after': refused['retry_after']})
+        return results
+
+    def _answer_session_message(self, chatbot, session_id, message):
+        """
+        Answer one of a session's messages, returning its result dictionary.
+        """
+        result = {'session_id': session_id, 'message': message}
+        started = time.time()
+        timings = {}
+        stage_results = {}
+        try:
+            result['response'] = run_stages(
+                chatbot.respond_in_stages(message), timings, stage_results)
+        except Overloaded, e:
+            result['error'] = str(e)
+            result['retry_after'] = e.retry_after
+        except Exception, e:
+            self.logger.exception("Error while answering %r" % message)
+            result['error'] = str(e)
+        plans = stage_results.get('dm', [])
+        if isinstance(plans, ContentPlanMessage):
+            plans = [plans]
+        result['content_plan_types'] = [plan.msg_type for plan in plans]
+        timings['total'] = time.time() - started
+        result['timings'] = timings
+        return result
+
+    def handle_batch(self, items):
+        """
+        Answer a list of {'session_id': ..., 'message': ...} items, returning
+        a list with a result for each item, in the same order.  Items without
+        a session_id start a new session.  Different sessions are answered
+        concurrently by up to BATCH_THREADS threads, and each session's
+        messages are answered in order.
+
+        Each result has the item's session_id and message, the chatbot's
+        response (or an error), the types of the content plans that the
+        dialogue manager planned, and the seconds spent in each stage and in
+        total.
+
+        When the server is overloaded (see admission) or the session is busy
+        answering other messages, a session's messages from the first one
+        that's refused on have an error and retry_after instead.  The
+        session's messages are answered on a copy of its state, which isn't
+        saved, so the session is left as it was, as with a 503 response to a
+        single message.  All of the session's messages in the batch should
+        then be sent again after retry_after seconds.
+        """
+        sessions = {}
+        order = []
+        for index, item in enumerate(items):
+            session_id = str(item.get('session_id') or uuid.uuid4())
+            if session_id not in sessions:
+                sessions[session_id] = []
+                order.append(session_id)
+            sessions[session_id].append((index, item['message']))
+        pending = Queue.Queue()
+        for session_id in order:
+            pending.put(session_id)
+        results = [None] * len(items)
+
+        def work():
+            while True:
+                try:
+                    session_id = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                indexes, messages = zip(*sessions[session_id])
+                try:
+                    session_results = self._answer_session_messages(
+                        session_id, messages)
+                except Exception, e:
+                    self.logger.exception("Error in session %s" % session_id)
+                    session_results = [{'session_id': session_id,
+                                        'message': message, 'error': str(e)}
+                                       for message in messages]
+                for index, result in zip(indexes, session_results):
+                    results[index] = result
+        threads = [threading.Thread(target=work)
+                   for _ in range(min(BATCH_THREADS, len(order)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _serve_batch(self, environ, start_response):
+        """
+        Answer a JSON batch of messages; see handle_batch().
+        """
+        length = int(environ.get('CONTENT_LENGTH') or '0')
+        try:
+            items = json.loads(environ['wsgi.input'].read(length))
+            if not isinstance(items, list):
+                raise ValueError("Expected a list of messages")
+            items = [{'session_id': item.get('session_id'),
+                      'message': item['message'].encode('utf-8')}
+                     for item in items]
+        except (ValueError, KeyError, TypeError, AttributeError), e:
+            start_response('400 Bad Request',
+                           [('content-type', 'application/json')])
+            return (json.dumps({'error': 'Bad batch: %s' % e}), )
+        started = time.time()
+        results = self.handle_batch(items)
+        body = json.dumps({'results': results,
+                           'elapsed': time.time() - started})
+        start_response('200 OK', [('content-type', 'application/json')])
+        return (body, )
+
+    def get_metrics(self):
+        """
+        Return a dictionary of metrics: the histograms of the tracing spans
+        (see the tracing module), the session store's metrics, the number of
+        times the Stanford parser was skipped for each reason, the admission
+        control of work using the JVM, the hits and misses of the response
+        cache, and the metrics from each of metrics_sources.
+        """
+        response_cache = get_services(self.db, self.logger).response_cache
+        metrics = {
+            'spans': tracing.get_metrics(),
+            'sessions': self.state_datastore.get_metrics(),
+            'parser_fallbacks': get_fallback_counts(),
+            'admission': get_jvm_admission().get_metrics(),
+            'response_cache': response_cache.get_metrics(),
+        }
+        for name, source in self.metrics_sources.items():
+            metrics[name] = source()
+        return metrics
+
+    def _serve_metrics(self, environ, start_response):
+        start_response('200 OK', [('content-type', 'application/json'),
+                                  ('cache-control', 'no-cache')])
+        return (json.dumps(self.get_metrics()), )
+
+    def _serve_overloaded(self, error, start_response):
+        """
+        Ask the client to send the message again later, because the server
+        is overloaded or the session is busy.  The session isn't saved, so
+        it's as if the message hadn't been received.
+        """
+        start_response('503 Service Unavailable',
+                       [('content-type', 'text/plain'),
+                        ('retry-after', str(error.retry_after))])
+        return (str(error), )
+
+    def _serve_stream(self, environ, start_response):
+        """
+        Answer a chat message as a stream of server-sent events, sending
+        each part of the response as soon as it's ready.  The message can be
+        POSTed like the chat interface's messages, or sent in the query
+        string of a GET, which is what browsers' EventSource does.
+        """
+        if environ['REQUEST_METHOD'] == 'POST':
+            length = int(environ.get('CONTENT_LENGTH') or '0')
+            params = urlparse.parse_qs(environ['wsgi.input'].read(length))
+        else:
+            params = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+        if 'session_id' not in params or 'chat_message' not in params:
+            start_response('400 Bad Request', [('content-type', 'text/plain')])
+            return ('Expected session_id and chat_message', )
+        session_id = params['session_id'][0]
+        try:
+            token = self.state_datastore.lock(session_id)
+        except SessionBusy, e:
+            return self._serve_overloaded(e, start_response)
+        # Understand the message before starting the response, so that the
+        # message can be refused if the server is overloaded.
+        try:
+            chatbot = self._continue_session(session_id)
+            outputs = chatbot.respond_incrementally(params['chat_message'][0])
+            first_output = outputs.next()
+        except Overloaded, e:
+            self.state_datastore.unlock(session_id, token)
+            return self._serve_overloaded(e, start_response)
+        except Exception:
+            self.state_datastore.unlock(session_id, token)
+            raise
+        start_response('200 OK', [('content-type', 'text/event-stream'),
+                                  ('cache-control', 'no-cache')])
+        return self._stream_events(chatbot, session_id, token, first_output,
+                                   outputs)
+
+    def _stream_events(self, chatbot, session_id, token, first_output,
+                       outputs):
+        """
+        Generate the server-sent events of a response, saving the session
+        once all of it has been sent.  If the client goes away or answering
+        fails part of the way through, the session isn't saved, so it's as
+        if the message hadn't been received.
         """
-        return self.state_datastore[session_id]
+        finished = False
+        try:
+            yield server_sent_event(first_output)
+            for output in outputs:
+                yield server_sent_event(output)
+            finished = True
+        finally:
+            try:
+                if finished:
+                    self._save_chatbot(chatbot, session_id)
+                else:
+                    self.logger.info("Stream for session %s ended early; "
+                                     "not saving the session" % session_id)
+            finally:
+                self.state_datastore.unlock(session_id, token)
+        yield server_sent_event('', 'done')
 
     def __call__(self, environ, start_response):
         """
         WSGI application implementing a simple chat protocol.
         On a GET request, serve the chat interface.  On a POST, pass
-        the input to the chatbot and return its response as text.
+        the input to the chatbot and return its response as text.  A POST
+        to /batch answers a JSON list of messages; see handle_batch().
+        Messages sent to /stream are answered with server-sent events, and
+        a GET of /metrics returns get_metrics() as JSON.
         """
         method = environ['REQUEST_METHOD']
+        if method == 'GET' and environ.get('PATH_INFO') == '/metrics':
+            return self._serve_metrics(environ, start_response)
+        if method == 'POST' and environ.get('PATH_INFO') == '/batch':
+            return self._serve_batch(environ, start_response)
+        if environ.get('PATH_INFO') == '/stream':
+            return self._serve_stream(environ, start_response)
         if method == 'GET':
             session_id = str(uuid.uuid4())
             # Start a new conversation
-            chatbot = Chatbot(self.db, self.logger, enable_debug=False)
+            chatbot = self._new_chatbot()
             greeting = chatbot.get_greeting()
             # Save the chatbot in the key-value store
             self._save_chatbot(chatbot, session_id)
@@ -73,34 +376,125 @@ class WebChatServer(object):
             post = urlparse.parse_qs(environ['wsgi.input'].read(length))
             session_id = post['session_id'][0]
             chat_message = post['chat_message'][0]
-            # Load the saved state
-            chatbot = self._load_chatbot(session_id)
-            # Get the bot's output
-            output = chatbot.handle_input(chat_message)
-            # Save the chatbot in the key-value store
-            self._save_chatbot(chatbot, session_id)
+            try:
+                with self.state_datastore.locked(session_id):
+                    # Load the saved state
+                    chatbot = self._continue_session(session_id)
+                    # Get the bot's output
+                    output = chatbot.handle_input(chat_message)
+                    # Save the chatbot in the key-value store
+                    self._save_chatbot(chatbot, session_id)
+            except (Overloaded, SessionBusy), e:
+                return self._serve_overloaded(e, start_response)
             # Return the output as text
             start_response('200 OK', [('content-type', 'text/plain')])
             return (output, )
 
 
+def make_session_store(kind, logger, filename='sessions.sqlite'):
+    """
+    Create a session store of the given kind: 'memory' keeps the sessions in
+    this process, 'sqlite' keeps them in an SQLite database file, and 'socket'
+    keeps them in the store served by
+    session_store.start_session_store_server().  Only the last two can be
+    shared by several processes.
+    """
+    if kind == 'memory':
+        return MemorySessionStore(logger=logger.getChild('sessions'))
+    elif kind == 'sqlite':
+        return SQLiteSessionStore(filename, encode=encode_state,
+            decode=decode_state, logger=logger.getChild('sessions'))
+    elif kind == 'socket':
+        return SocketSessionStore(encode=encode_state, decode=decode_state)
+    raise ValueError("Unknown session store '%s'" % kind)
+
+
+def serve_preforked(make_app, address, workers):
+    """
+    Serve a WSGI application from several worker processes, which accept
+    connections on one listening socket.  make_app() is called in each worker
+    after it's forked, so that workers don't share database connections or
+    JVM gateways.
+    """
+    from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+    server = WSGIServer(address, WSGIRequestHandler)
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server.set_app(make_app())
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+    server.socket.close()
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+PARSER = OptionParser()
+PARSER.add_option("--database", dest="database_url",
+                  default='sqlite:///test_database.sqlite')
+PARSER.add_option("--port", dest="port", type="int", default=8080)
+PARSER.add_option("--workers", dest="workers", type="int", default=1,
+                  help="number of pre-forked worker processes")
+PARSER.add_option("--sessions", dest="session_store", default='memory',
+                  choices=['memory', 'sqlite', 'socket'],
+                  help="where to keep sessions: memory, sqlite or socket")
+PARSER.add_option("--session-file", dest="session_file",
+                  default='sessions.sqlite',
+                  help="database file of the sqlite session store")
+
+
 def demo():
     """
     Demo of how to use the WebChatServer WSGI application, using CherryPy's
-    WSGI server.
+    WSGI server, or several pre-forked workers sharing their sessions.
     """
-    from cherrypy import wsgiserver
-    db = Database('sqlite:///test_database.sqlite')
+    (options, args) = PARSER.parse_args()
+    if options.workers > 1 and options.session_store == 'memory':
+        PARSER.error("--workers needs the sqlite or socket session store")
     logger = logging.getLogger('chatbot_server')
     logging.basicConfig(level=logging.DEBUG)
-    chat_app = WebChatServer(db, logger)
-    server = wsgiserver.CherryPyWSGIServer(('0.0.0.0', 8080), chat_app)
+    session_server = None
+    if options.session_store == 'socket':
+        session_server = start_session_store_server()
+
+    def make_app():
+        db = Database(options.database_url)
+        session_store = make_session_store(options.session_store, logger,
+                                           options.session_file)
+        chat_app = WebChatServer(db, logger, session_store)
+        # Launch the parser and realiser now, so the first user doesn't wait.
+        warm_up_nlu()
+        warm_up_nlg()
+        return chat_app
     try:
-        print "Started chatbot web server."
-        server.start()
-    except KeyboardInterrupt:
-        server.stop()
-        exit()
+        if options.workers > 1:
+            print "Starting %d chatbot web server workers." % options.workers
+            serve_preforked(make_app, ('0.0.0.0', options.port),
+                            options.workers)
+        else:
+            from cherrypy import wsgiserver
+            server = wsgiserver.CherryPyWSGIServer(('0.0.0.0', options.port),
+                                                   make_app())
+            try:
+                print "Started chatbot web server."
+                server.start()
+            except KeyboardInterrupt:
+                server.stop()
+    finally:
+        if session_server is not None:
+            session_server.shutdown()
+    exit()
 
 if __name__ == "__main__":
     demo()
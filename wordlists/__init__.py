@@ -5,28 +5,63 @@ module exposes these wordslists to the application as sets of strings.
 
 The dynamic creation of the module attributes relies on a trick
 described at http://stackoverflow.com/questions/2933470
+
+Code that precomputes data from the wordlists can call refresh() to reload
+wordlists whose files have changed, and compare the generation attribute,
+which is incremented by every reload, to find out whether to recompute it.
 """
 
 from glob import iglob
 import os
+import time
 
 __all__ = []
 MODULE_PATH = os.path.abspath(os.path.dirname(__file__))
 
-# The del statements clean up variables so that they're not accessible
-# after the module loads.
-
-for wordlist_path in iglob(MODULE_PATH + '/*.txt'):
-    name = os.path.splitext(os.path.split(wordlist_path)[1])[0]
-    wordlist = set()
-    with open(wordlist_path) as wordlist_file:
-        for line in wordlist_file:
-            wordlist.add(line.strip())
-            del line
-    __all__.append(name)
-    globals()[name] = wordlist
-    del wordlist_file
-    del wordlist_path
-    del wordlist
-    del name
-del MODULE_PATH
+# The number of times the wordlists have been reloaded.
+generation = 0
+# Maps wordlist filenames to their modification times when they were loaded.
+_mtimes = {}
+_last_refresh = 0
+
+
+def _wordlist_paths():
+    return dict((path, os.path.getmtime(path))
+                for path in iglob(MODULE_PATH + '/*.txt'))
+
+
+def _load(paths):
+    for wordlist_path in paths:
+        name = os.path.splitext(os.path.split(wordlist_path)[1])[0]
+        wordlist = set()
+        with open(wordlist_path) as wordlist_file:
+            for line in wordlist_file:
+                wordlist.add(line.strip())
+        if name not in __all__:
+            __all__.append(name)
+        globals()[name] = wordlist
+    _mtimes.clear()
+    _mtimes.update(paths)
+
+
+def refresh(max_age=5):
+    """
+    Reload the wordlists if any of their files have changed.  The files are
+    checked at most once every max_age seconds.  Returns True if the
+    wordlists were reloaded.
+    """
+    global generation, _last_refresh
+    now = time.time()
+    if now - _last_refresh < max_age:
+        return False
+    _last_refresh = now
+    paths = _wordlist_paths()
+    if paths == _mtimes:
+        return False
+    _load(paths)
+    generation += 1
+    return True
+
+
+_load(_wordlist_paths())
+_last_refresh = time.time()